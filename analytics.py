@@ -0,0 +1,338 @@
+""" Vectorized derived metrics over network status history. """
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import io
+import logging
+import math
+import pg
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Configuration
+# Width of the trailing window the hash rate trend is averaged over
+trendWindow = timedelta(hours=24)
+
+# Loaded columns, all held as float64 (NULLs are NaN). scrape_time is
+# microseconds since the epoch, which float64 holds exactly.
+columns = ('scrape_time', 'current_blocks', 'difficulty', 'reward',
+           'hash_rate')
+# Derived series, aligned with the loaded rows:
+#   block_rate        blocks per hour since the previous known block count
+#   difficulty_delta  relative difficulty change since the previous known
+#                     difficulty (0 between retargets)
+#   hash_rate_mean    mean hash rate over the trailing trendWindow
+#   hash_rate_trend   relative change of hash_rate_mean over trendWindow
+#   coins_per_mhs_day expected coins per day for 1 MH/s of hashing
+derived = ('block_rate', 'difficulty_delta', 'hash_rate_mean',
+           'hash_rate_trend', 'coins_per_mhs_day')
+
+_epoch = datetime(1970, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+
+def _requireNumpy():
+    """Fail early when numpy is missing."""
+    if numpy is None:
+        raise Exception("Analytics require numpy.")
+
+
+def _micros(value):
+    """Microseconds since the epoch of a naive UTC datetime."""
+    delta = value - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+        delta.microseconds
+
+
+class History(object):
+
+    """One symbol's network status history and its derived series.
+
+    Rows are appended in time order. Arrays grow geometrically and derived
+    series are only computed for the appended rows, carrying forward the
+    few values they depend on, so appending a scrape costs O(1) amortized
+    (plus a binary search for the trend window).
+    """
+
+    def __init__(self, symbol, capacity=64):
+        """Start with no rows."""
+        _requireNumpy()
+        self.symbol = symbol
+        self.size = 0
+        self._data = dict(
+            (name, numpy.empty(capacity)) for name in columns + derived)
+        # Running sum and count of known hash rates, one longer than rows
+        self._hashSum = numpy.zeros(capacity + 1)
+        self._hashCount = numpy.zeros(capacity + 1)
+        # Index of the last row with a known block count and difficulty
+        self._lastBlocks = -1
+        self._lastDifficulty = -1
+
+    def __len__(self):
+        """Number of rows."""
+        return self.size
+
+    def __getitem__(self, name):
+        """View of a loaded or derived column."""
+        return self._data[name][:self.size]
+
+    def lastScrapeTime(self):
+        """The newest scrape time, as a datetime, or None."""
+        if not self.size:
+            return None
+        return _epoch + timedelta(
+            microseconds=int(self._data['scrape_time'][self.size - 1]))
+
+    def _grow(self, size):
+        """Make room for at least size rows."""
+        capacity = len(self._data['scrape_time'])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, values in self._data.items():
+            grown = numpy.empty(capacity)
+            grown[:self.size] = values[:self.size]
+            self._data[name] = grown
+        for name in ('_hashSum', '_hashCount'):
+            grown = numpy.zeros(capacity + 1)
+            grown[:self.size + 1] = getattr(self, name)[:self.size + 1]
+            setattr(self, name, grown)
+
+    def append(self, data):
+        """Append rows given as a dict of equal-length column arrays.
+
+        Rows must be ordered by scrape time; rows not newer than the last
+        one held are ignored.
+        """
+        times = numpy.asarray(data['scrape_time'], dtype=numpy.float64)
+        keep = slice(None)
+        if self.size:
+            first = numpy.searchsorted(
+                times, self._data['scrape_time'][self.size - 1],
+                side='right')
+            keep = slice(first, None)
+            times = times[keep]
+        count = len(times)
+        if not count:
+            return 0
+        start = self.size
+        self._grow(start + count)
+        for name in columns:
+            self._data[name][start:start + count] = numpy.asarray(
+                data[name], dtype=numpy.float64)[keep]
+        self.size = start + count
+        self._derive(start)
+        return count
+
+    def _previousKnown(self, values, start, carry):
+        """Index of the last known value strictly before each new row.
+
+        Returns the indexes (-1 where there is none) and the carry for the
+        next append.
+        """
+        end = self.size
+        known = numpy.where(
+            numpy.isnan(values[start:end]), -1, numpy.arange(start, end))
+        last = numpy.maximum.accumulate(
+            numpy.concatenate(([carry], known)))
+        return last[:-1].astype(numpy.intp), int(last[-1])
+
+    def _derive(self, start):
+        """Compute derived series for rows from start on."""
+        end = self.size
+        data = self._data
+        times = data['scrape_time'][start:end] / 1e6
+        blocks = data['current_blocks'][start:end]
+        difficulty = data['difficulty'][start:end]
+        hashRate = data['hash_rate'][start:end]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Block rate over the gap to the last known block count, however
+            # long it was; block counts going backwards (a chain reset) give
+            # NaN rather than a negative rate
+            previous, self._lastBlocks = self._previousKnown(
+                data['current_blocks'], start, self._lastBlocks)
+            known = previous >= 0
+            safe = numpy.where(known, previous, 0)
+            advanced = blocks - data['current_blocks'][safe]
+            elapsed = times - data['scrape_time'][safe] / 1e6
+            rate = advanced / elapsed * 3600
+            data['block_rate'][start:end] = numpy.where(
+                known & (elapsed > 0) & (advanced >= 0), rate, numpy.nan)
+
+            # Retarget deltas against the last known difficulty
+            previous, self._lastDifficulty = self._previousKnown(
+                data['difficulty'], start, self._lastDifficulty)
+            known = previous >= 0
+            safe = numpy.where(known, previous, 0)
+            data['difficulty_delta'][start:end] = numpy.where(
+                known, difficulty / data['difficulty'][safe] - 1,
+                numpy.nan)
+
+            # Mean hash rate over a trailing time window, from running sums
+            # of the known values so NULLs and irregular gaps just shrink
+            # the sample
+            present = ~numpy.isnan(hashRate)
+            self._hashSum[start + 1:end + 1] = self._hashSum[start] + \
+                numpy.cumsum(numpy.where(present, hashRate, 0))
+            self._hashCount[start + 1:end + 1] = self._hashCount[start] + \
+                numpy.cumsum(present)
+            window = trendWindow.days * 86400 + trendWindow.seconds
+            cutoff = data['scrape_time'][start:end] - window * 1e6
+            low = numpy.searchsorted(
+                data['scrape_time'][:end], cutoff, side='left')
+            high = numpy.arange(start + 1, end + 1)
+            mean = (self._hashSum[high] - self._hashSum[low]) / \
+                (self._hashCount[high] - self._hashCount[low])
+            data['hash_rate_mean'][start:end] = mean
+
+            # The trend compares against the mean as of the window's start,
+            # so it is unknown until a full window of history is held
+            before = numpy.searchsorted(
+                data['scrape_time'][:end], cutoff, side='right') - 1
+            data['hash_rate_trend'][start:end] = numpy.where(
+                before >= 0,
+                mean / data['hash_rate_mean'][numpy.maximum(before, 0)] - 1,
+                numpy.nan)
+
+            # Coins per day for 1 MH/s: reward * hashes per day / expected
+            # hashes per block (difficulty * 2^32)
+            data['coins_per_mhs_day'][start:end] = numpy.where(
+                difficulty > 0,
+                data['reward'][start:end] * 1e6 * 86400 /
+                (difficulty * math.pow(2, 32)),
+                numpy.nan)
+
+
+def _fromText(text):
+    """Split COPY text output (symbol, then columns) into per-symbol arrays.
+
+    Rows must be ordered by symbol and scrape time.
+    """
+    lines = text.replace(u"\\N", u"nan").splitlines()
+    if not lines:
+        return {}
+    symbols = numpy.array([line[:line.index(u"\t")] for line in lines])
+    values = numpy.loadtxt(
+        io.StringIO(u"\n".join(line[line.index(u"\t") + 1:]
+                              for line in lines)),
+        delimiter=u"\t", dtype=numpy.float64, ndmin=2)
+    bounds = numpy.concatenate((
+        [0], numpy.flatnonzero(symbols[1:] != symbols[:-1]) + 1,
+        [len(lines)]))
+    groups = {}
+    for lower, upper in zip(bounds[:-1], bounds[1:]):
+        groups[symbols[lower]] = dict(
+            (name, values[lower:upper, index])
+            for index, name in enumerate(columns))
+    return groups
+
+
+def _copyRows(symbols, since):
+    """COPY history newer than since (microseconds) out of Postgres."""
+    cursor = pg.cursor()
+    where = ["TRUE"]
+    params = {}
+    if symbols is not None:
+        where.append("symbol = ANY(%(symbols)s::varchar[])")
+        params['symbols'] = list(symbols)
+    if since is not None:
+        where.append("scrape_time > %(since)s")
+        params['since'] = _epoch + timedelta(microseconds=since)
+    buf = io.BytesIO()
+    cursor.copy_expert(cursor.mogrify("""COPY (
+        SELECT symbol,
+            (extract(epoch FROM scrape_time) * 1000000)::float8,
+            current_blocks::float8, difficulty::float8, reward::float8,
+            hash_rate::float8
+        FROM {0}
+        WHERE {1}
+        ORDER BY symbol, scrape_time) TO STDOUT""".format(
+        pg.tables['network_status'], " AND ".join(where)), params), buf)
+    cursor.connection.commit()
+    return _fromText(buf.getvalue().decode('utf-8'))
+
+
+def load(symbols=None):
+    """Load full history (for some symbols, or all) as History objects.
+
+    Returns a dict of History keyed by symbol.
+    """
+    _requireNumpy()
+    histories = {}
+    for symbol, data in _copyRows(symbols, None).items():
+        histories[symbol] = History(symbol, capacity=max(64, len(
+            data['scrape_time'])))
+        histories[symbol].append(data)
+    logger.info("Loaded history for {0} symbols.".format(len(histories)))
+    return histories
+
+
+def refresh(histories, symbols=None):
+    """Append history stored since the histories were last loaded.
+
+    Only rows newer than the oldest last scrape time held are read, and
+    each history ignores rows it already has. Symbols seen for the first
+    time get new histories. Returns the number of rows appended.
+    """
+    _requireNumpy()
+    lasts = [history['scrape_time'][-1] for history in histories.values()
+             if len(history)]
+    since = int(min(lasts)) if lasts else None
+    appended = 0
+    for symbol, data in _copyRows(symbols, since).items():
+        if symbol not in histories:
+            histories[symbol] = History(symbol)
+        appended += histories[symbol].append(data)
+    return appended
+
+
+def update(histories, data):
+    """Append one scrape's parsed network status rows to the histories."""
+    _requireNumpy()
+    for datum in data:
+        history = histories.get(datum['symbol'])
+        if history is None:
+            history = histories[datum['symbol']] = History(datum['symbol'])
+        history.append(dict(
+            (name, [float('nan') if datum[name] is None else float(
+                _micros(datum[name]) if name == 'scrape_time'
+                else datum[name])])
+            for name in columns))
+
+
+def summary(histories):
+    """Latest derived values per symbol, as a dict of dicts."""
+    result = {}
+    for symbol, history in histories.items():
+        if len(history):
+            result[symbol] = dict(
+                (name, float(history[name][-1])) for name in derived)
+            result[symbol]['scrape_time'] = history.lastScrapeTime()
+    return result
+
+
+def main(argv=None):
+    """Print the latest derived metrics from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "symbols", nargs="*", help="symbols to report (default all)")
+    args = parser.parse_args(argv)
+    latest = summary(load(args.symbols or None))
+    for symbol in sorted(latest):
+        print("{0}\t{1}".format(symbol, "\t".join(
+            "{0}={1:.6g}".format(name, latest[symbol][name])
+            for name in derived)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    main(sys.argv[1:])
@@ -0,0 +1,211 @@
+""" Streaming per-symbol statistics and anomaly detection on ingest. """
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import math
+import metrics
+import os
+import threading
+import traceback
+
+# Configuration variables
+snapshotPath = "{0}/data/anomaly.json".format(
+    os.path.dirname(os.path.abspath(__file__)))
+# Weight of each new sample in the running means and variances; the first
+# 1/alpha samples are averaged evenly (Welford), later ones decay (EWMA)
+alpha = 0.05
+# Samples a symbol needs before its values are judged
+warmup = 10
+# A value is anomalous when it is more than threshold standard deviations
+# and more than minChange (relative to the mean) away from the mean
+threshold = 4.0
+minChange = {'difficulty': 0.5, 'hash_rate': 0.8}
+# Seconds without current_blocks advancing before a symbol counts as stalled
+stallSeconds = 3600
+
+# Judged metrics and the event each raises; a hash rate is only anomalous
+# when it falls
+rules = [
+    ('difficulty', 'difficulty_jump', False),
+    ('hash_rate', 'hash_rate_collapse', True)
+]
+
+
+def logSink(event):
+    """Default sink: log each event as a warning."""
+    logging.warning("Anomaly: {0} for {1} at {2} (value {3}, expected "
+                    "{4}).".format(event['kind'], event['symbol'],
+                                   event['scrape_time'], event['value'],
+                                   event['expected']))
+
+# Functions called with each anomaly event, a dict with kind, symbol,
+# scrape_time, value and expected. A failing sink does not stop the others.
+sinks = [logSink]
+
+_epoch = datetime(1970, 1, 1)
+_lock = threading.Lock()
+# Per-symbol state, loaded from the snapshot on first use
+_state = None
+
+
+def _seconds(value):
+    """Seconds since the epoch of a naive UTC datetime."""
+    delta = value - _epoch
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _load():
+    """Read the state snapshot, starting empty if there is none."""
+    global _state
+    if _state is not None:
+        return _state
+    _state = {}
+    if os.path.exists(snapshotPath):
+        try:
+            f = open(snapshotPath, 'r')
+            _state = json.load(f)
+            f.close()
+        except ValueError:
+            logging.error("Ignoring unreadable anomaly snapshot {0}.".format(
+                snapshotPath))
+    return _state
+
+
+def save():
+    """Atomically write the state snapshot."""
+    with _lock:
+        state = _load()
+        directory = os.path.dirname(snapshotPath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = open("{0}.tmp".format(snapshotPath), 'w')
+        json.dump(state, f, separators=(',', ':'), sort_keys=True)
+        f.close()
+        os.rename("{0}.tmp".format(snapshotPath), snapshotPath)
+
+
+def _emit(events):
+    """Count events and hand them to every sink."""
+    for event in events:
+        metrics.increment("anomalies_total", kind=event['kind'])
+        for sink in sinks:
+            try:
+                sink(event)
+            except Exception:
+                logging.error("Anomaly sink failed:\n{0}".format(
+                    traceback.format_exc()))
+
+
+def _judge(stats, value, falling):
+    """Whether a value is anomalous against [count, mean, variance]."""
+    count, mean, variance = stats
+    if count < warmup:
+        return False
+    deviation = mean - value if falling else abs(value - mean)
+    return deviation > threshold * math.sqrt(variance)
+
+
+def _update(stats, value):
+    """Fold a value into [count, mean, variance] in place."""
+    stats[0] += 1
+    weight = max(alpha, 1.0 / stats[0])
+    delta = value - stats[1]
+    stats[1] += weight * delta
+    stats[2] = (1 - weight) * (stats[2] + weight * delta * delta)
+
+
+def _stall(symbol, entry, now, events):
+    """Raise a stall event once a symbol's blocks stop advancing."""
+    if entry['advanced'] is not None and not entry['stalled'] and \
+            now - entry['advanced'] > stallSeconds:
+        entry['stalled'] = True
+        events.append({
+            'kind': 'blocks_stalled',
+            'symbol': symbol,
+            'scrape_time': _epoch + timedelta(seconds=now),
+            'value': entry['blocks'],
+            'expected': None
+        })
+
+
+def observe(data):
+    """Update statistics with one scrape's parsed network status rows.
+
+    Each row is judged against its symbol's statistics before they are
+    updated, so a jump is reported by the scrape that shows it. Rows no
+    newer than the last one seen for their symbol are ignored. Returns the
+    events raised.
+    """
+    events = []
+    with _lock:
+        state = _load()
+        for datum in data:
+            symbol = datum['symbol']
+            now = _seconds(datum['scrape_time'])
+            entry = state.get(symbol)
+            if entry is None:
+                entry = state[symbol] = {
+                    'seen': None, 'blocks': None, 'advanced': None,
+                    'stalled': False}
+                for metric, kind, falling in rules:
+                    entry[metric] = [0, 0.0, 0.0]
+            if entry['seen'] is not None and now <= entry['seen']:
+                continue
+            entry['seen'] = now
+            for metric, kind, falling in rules:
+                if datum[metric] is None:
+                    continue
+                value = float(datum[metric])
+                stats = entry[metric]
+                if _judge(stats, value, falling) and \
+                        abs(value - stats[1]) > \
+                        minChange[metric] * abs(stats[1]):
+                    events.append({
+                        'kind': kind,
+                        'symbol': symbol,
+                        'scrape_time': datum['scrape_time'],
+                        'value': value,
+                        'expected': stats[1]
+                    })
+                _update(stats, value)
+            blocks = datum['current_blocks']
+            if blocks is not None and blocks != entry['blocks']:
+                if entry['stalled']:
+                    events.append({
+                        'kind': 'blocks_resumed',
+                        'symbol': symbol,
+                        'scrape_time': datum['scrape_time'],
+                        'value': blocks,
+                        'expected': None
+                    })
+                entry['blocks'] = blocks
+                entry['advanced'] = now
+                entry['stalled'] = False
+            else:
+                _stall(symbol, entry, now, events)
+    _emit(events)
+    return events
+
+
+def checkStalls(scrapeTime):
+    """Check for stalled blocks on a scrape whose payloads were unchanged.
+
+    Such scrapes are not parsed, but a chain that stops producing blocks
+    often looks exactly like that.
+    """
+    events = []
+    now = _seconds(scrapeTime)
+    with _lock:
+        state = _load()
+        for symbol in sorted(state):
+            _stall(symbol, state[symbol], now, events)
+    _emit(events)
+    return events
+
+
+def reset():
+    """Forget all statistics (the snapshot is left alone)."""
+    global _state
+    with _lock:
+        _state = {}
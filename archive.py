@@ -0,0 +1,234 @@
+""" Module for archiving raw API payloads in compressed segments. """
+import collections
+from datetime import datetime
+from datetime import timedelta
+import glob
+import hashlib
+import logging
+import os
+import re
+import struct
+import zlib
+
+# Configuration variables
+archiveDir = "{0}/data/archive".format(
+    os.path.dirname(os.path.abspath(__file__)))
+# Start a new segment once the current one reaches this size
+segmentMaxBytes = 64 * 1024 * 1024
+compressLevel = 6
+# fsync segments and index after every append
+syncWrites = False
+
+# Each index entry is a fixed-width record of the scrape time (microseconds
+# since the epoch), the SHA-1 of the payload, and the segment number, offset
+# and length of its gzip member. Fixed width lets readers binary search the
+# index by time without loading it.
+_indexFormat = struct.Struct("<q20sIQI")
+Record = collections.namedtuple(
+    "Record", ["scrape_time", "digest", "segment", "offset", "length"])
+_epoch = datetime(1970, 1, 1)
+
+# Last record written to each stream, loaded from the index on first use
+_lastRecords = {}
+
+
+def _streamDir(name):
+    """Directory holding a stream's index and segments."""
+    return "{0}/{1}".format(archiveDir, name)
+
+
+def _indexPath(name):
+    """Path of a stream's index."""
+    return "{0}/index".format(_streamDir(name))
+
+
+def _segmentPath(name, segment):
+    """Path of one of a stream's segments."""
+    return "{0}/segment_{1:06d}.gz".format(_streamDir(name), segment)
+
+
+def _toMicros(scrapeTime):
+    """Convert a naive UTC datetime to microseconds since the epoch."""
+    delta = scrapeTime - _epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _fromMicros(micros):
+    """Convert microseconds since the epoch to a naive UTC datetime."""
+    return _epoch + timedelta(microseconds=micros)
+
+
+def _encode(payload):
+    """Get the bytes stored for a payload."""
+    return payload.encode('utf-8') if not isinstance(payload, bytes) \
+        else payload
+
+
+def payloadDigest(payload):
+    """Content hash used to recognise repeated payloads."""
+    return hashlib.sha1(_encode(payload)).digest()
+
+
+def _unpack(raw):
+    """Build a record from its packed index entry."""
+    micros, digest, segment, offset, length = _indexFormat.unpack(raw)
+    return Record(_fromMicros(micros), digest, segment, offset, length)
+
+
+def _recordCount(f):
+    """Number of complete records in an open index.
+
+    A partial record left by an interrupted write is ignored.
+    """
+    f.seek(0, os.SEEK_END)
+    return f.tell() // _indexFormat.size
+
+
+def _readRecord(f, position):
+    """Read the record at a position in an open index."""
+    f.seek(position * _indexFormat.size)
+    return _unpack(f.read(_indexFormat.size))
+
+
+def _lastRecord(name):
+    """Get the last record written to a stream.
+
+    Any partial entry left at the end of the index by an interrupted write
+    is cut off so that new entries stay aligned.
+    """
+    if name not in _lastRecords:
+        record = None
+        if os.path.exists(_indexPath(name)):
+            f = open(_indexPath(name), 'r+b')
+            count = _recordCount(f)
+            f.truncate(count * _indexFormat.size)
+            if count > 0:
+                record = _readRecord(f, count - 1)
+            f.close()
+        _lastRecords[name] = record
+    return _lastRecords[name]
+
+
+def _sync(f):
+    """Flush a file to disk if synchronous writes are enabled."""
+    f.flush()
+    if syncWrites:
+        os.fsync(f.fileno())
+
+
+def append(payload, scrapeTime=None, name="api", digest=None):
+    """Append a payload to a stream of the archive.
+
+    A payload identical to the previous one in the stream only adds an index
+    entry pointing at the stored copy. Payloads should be appended in time
+    order, since readers binary search the index by time.
+    """
+    scrapeTime = scrapeTime if scrapeTime is not None else datetime.utcnow()
+    digest = digest if digest is not None else payloadDigest(payload)
+    last = _lastRecord(name)
+    if last is not None and last.digest == digest:
+        segment, offset, length = last.segment, last.offset, last.length
+    else:
+        if not os.path.isdir(_streamDir(name)):
+            os.makedirs(_streamDir(name))
+        segment = last.segment if last is not None else 1
+        segmentPath = _segmentPath(name, segment)
+        if os.path.exists(segmentPath) and \
+                os.path.getsize(segmentPath) >= segmentMaxBytes:
+            segment += 1
+        compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, 31)
+        member = compressor.compress(_encode(payload)) + compressor.flush()
+        f = open(_segmentPath(name, segment), 'ab')
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(member)
+        _sync(f)
+        f.close()
+        length = len(member)
+    record = Record(scrapeTime, digest, segment, offset, length)
+    f = open(_indexPath(name), 'ab')
+    f.write(_indexFormat.pack(
+        _toMicros(scrapeTime), digest, segment, offset, length))
+    _sync(f)
+    f.close()
+    _lastRecords[name] = record
+    return record
+
+
+def _bisect(f, count, scrapeTime):
+    """Position of the first record at or after a time."""
+    low = 0
+    high = count
+    while low < high:
+        middle = (low + high) // 2
+        if _readRecord(f, middle).scrape_time < scrapeTime:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def iterRecords(name="api", start=None, end=None):
+    """Iterate over index records with start <= scrape_time < end."""
+    if not os.path.exists(_indexPath(name)):
+        return
+    f = open(_indexPath(name), 'rb')
+    try:
+        count = _recordCount(f)
+        position = _bisect(f, count, start) if start is not None else 0
+        f.seek(position * _indexFormat.size)
+        while position < count:
+            record = _unpack(f.read(_indexFormat.size))
+            if end is not None and record.scrape_time >= end:
+                break
+            yield record
+            position += 1
+    finally:
+        f.close()
+
+
+def readPayload(record, name="api"):
+    """Read the payload an index record points to."""
+    f = open(_segmentPath(name, record.segment), 'rb')
+    f.seek(record.offset)
+    member = f.read(record.length)
+    f.close()
+    return zlib.decompress(member, 31).decode('utf-8')
+
+
+def iterPayloads(name="api", start=None, end=None):
+    """Iterate over (scrape time, payload) pairs in a time range."""
+    previous = None
+    payload = None
+    for record in iterRecords(name, start=start, end=end):
+        location = (record.segment, record.offset)
+        if location != previous:
+            payload = readPayload(record, name)
+            previous = location
+        yield record.scrape_time, payload
+
+
+def streams():
+    """List the streams in the archive."""
+    if not os.path.isdir(archiveDir):
+        return []
+    return sorted(
+        name for name in os.listdir(archiveDir)
+        if os.path.exists(_indexPath(name)))
+
+
+def importFiles(pattern, name="api"):
+    """Import legacy <prefix>_<epoch>.<ext> payload files in time order."""
+    files = []
+    for path in glob.glob(pattern):
+        match = re.search(r"_(\d+)\.[^.]+$", path)
+        if match is not None:
+            files.append((int(match.group(1)), path))
+    files.sort()
+    for epoch, path in files:
+        f = open(path, 'rb')
+        payload = f.read()
+        f.close()
+        append(payload, _epoch + timedelta(seconds=epoch), name=name)
+    logging.info("Imported {0} files into {1}.".format(len(files), name))
+    return len(files)
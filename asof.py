@@ -0,0 +1,207 @@
+""" Point-in-time (as-of) lookups of network status history. """
+import bisect
+import logging
+import pg
+import threading
+
+# Configuration variables
+# (symbol, timestamp) pairs resolved per query
+batchSize = 10000
+
+# History only holds a row when a symbol's values change, so the row as of
+# a time is the newest one at or before it. The primary key on
+# (symbol, scrape_time) answers each probe with one backward index scan.
+_lookupQuery = """SELECT q.ord, {0}
+    FROM unnest(%(symbols)s::varchar[], %(times)s::timestamp[])
+        WITH ORDINALITY AS q (symbol, at, ord)
+    JOIN LATERAL (
+        SELECT {1}
+        FROM {2} ns
+        WHERE ns.symbol = q.symbol
+        AND ns.scrape_time <= q.at
+        ORDER BY ns.scrape_time DESC
+        LIMIT 1) ns ON TRUE"""
+
+# Rows after each held symbol's newest indexed row, walking the primary key
+# per symbol so a symbol that lags the others (a replay, a spool flush) is
+# caught up as well
+_heldQuery = """SELECT {0}
+    FROM unnest(%(held)s::varchar[], %(through)s::timestamp[])
+        AS w (symbol, through)
+    JOIN LATERAL (
+        SELECT {1}
+        FROM {2} ns
+        WHERE ns.symbol = w.symbol
+        AND ns.scrape_time > coalesce(w.through, '-infinity')) ns ON TRUE"""
+
+
+@pg.transactional
+def _resolve(distinct):
+    """Resolve distinct pairs in batches, as a dict of rows keyed by pair."""
+    found = {}
+    cursor = pg.dictCursor()
+    for offset in range(0, len(distinct), batchSize):
+        batch = distinct[offset:offset + batchSize]
+        cursor.execute(_lookupQuery.format(
+            ", ".join("ns.{0}".format(column)
+                      for column in pg.networkStatusColumns),
+            ", ".join(pg.networkStatusColumns),
+            pg.tables['network_status']), {
+                'symbols': [symbol for symbol, at in batch],
+                'times': [at for symbol, at in batch]})
+        for row in cursor:
+            found[batch[row['ord'] - 1]] = dict(
+                (column, row[column]) for column in pg.networkStatusColumns)
+    cursor.connection.commit()
+    return found
+
+
+@pg.transactional
+def _read(sql, params):
+    """Run a read on this thread's connection, returning rows as dicts."""
+    cursor = pg.dictCursor()
+    cursor.execute(sql, params)
+    rows = [dict(row) for row in cursor]
+    cursor.connection.commit()
+    return rows
+
+
+def lookup(pairs):
+    """Get network status as of each (symbol, timestamp) pair.
+
+    Returns a list aligned with pairs holding a row dict, or None where the
+    symbol has no history at or before the timestamp. Each batch of
+    batchSize distinct pairs is resolved in a single query.
+    """
+    pairs = list(pairs)
+    with pg.session():
+        found = _resolve(list(set(pairs)))
+    return [found.get(pair) for pair in pairs]
+
+
+class Index(object):
+
+    """In-process as-of index over network status history.
+
+    Each symbol's rows are kept as parallel lists sorted by scrape time and
+    searched with bisect. refresh reads, for each symbol, only rows newer
+    than the newest one held for it; when indexing all symbols, those not
+    held yet are read from the newest row held for any symbol on. Rows
+    backfilled before a symbol's newest held row need clear. After watch,
+    commits made by this process mark the index stale and the next lookup
+    refreshes it.
+    """
+
+    def __init__(self, symbols=None):
+        """Start empty, indexing some symbols (or all of them)."""
+        self.symbols = set(symbols) if symbols is not None else None
+        self.times = {}
+        self.rows = {}
+        self.latest = None
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def _add(self, rows):
+        """Index rows (dicts), in any order."""
+        for row in rows:
+            symbol = row['symbol']
+            times = self.times.setdefault(symbol, [])
+            values = self.rows.setdefault(symbol, [])
+            at = row['scrape_time']
+            # Rows normally arrive in order, so this is an append
+            position = bisect.bisect_right(times, at)
+            value = tuple(
+                row.get(column) for column in pg.networkStatusColumns)
+            if position and times[position - 1] == at:
+                values[position - 1] = value
+                continue
+            times.insert(position, at)
+            values.insert(position, value)
+            if self.latest is None or at > self.latest:
+                self.latest = at
+
+    def refresh(self):
+        """Read history stored since the last refresh.
+
+        Returns the number of rows read.
+        """
+        with self.lock:
+            self.stale = False
+            held = sorted(self.times if self.symbols is None
+                          else self.symbols)
+            params = {
+                'held': held,
+                'through': [self.times[symbol][-1] if self.times.get(symbol)
+                            else None for symbol in held]}
+            queries = [_heldQuery.format(
+                ", ".join("ns.{0}".format(column)
+                          for column in pg.networkStatusColumns),
+                ", ".join(pg.networkStatusColumns),
+                pg.tables['network_status'])]
+            if self.symbols is None:
+                # Symbols new to the index, by the BRIN index on scrape_time
+                where = ["NOT (symbol = ANY(%(held)s::varchar[]))"]
+                if self.latest is not None:
+                    where.append("scrape_time > %(latest)s")
+                    params['latest'] = self.latest
+                queries.append("""SELECT {0}
+                    FROM {1}
+                    WHERE {2}""".format(
+                    ", ".join(pg.networkStatusColumns),
+                    pg.tables['network_status'], " AND ".join(where)))
+            with pg.session():
+                rows = _read("""SELECT *
+                    FROM ({0}) q
+                    ORDER BY symbol, scrape_time""".format(
+                    " UNION ALL ".join(queries)), params)
+            count = len(rows)
+            self._add(rows)
+            logging.info("Indexed {0} network status rows.".format(count))
+            return count
+
+    def clear(self):
+        """Forget every indexed row."""
+        with self.lock:
+            self.times.clear()
+            self.rows.clear()
+            self.latest = None
+            self.stale = True
+
+    def _onChange(self, tableKey, symbols, seen):
+        """pg listener marking the index stale after history changes."""
+        if tableKey != 'network_status_latest':
+            return
+        if symbols is None:
+            # A bulk load may have added rows older than those held
+            self.clear()
+        elif symbols and (self.symbols is None or self.symbols & symbols):
+            self.stale = True
+
+    def watch(self):
+        """Refresh on the next lookup after this process stores history."""
+        if self._onChange not in pg.listeners:
+            pg.listeners.append(self._onChange)
+
+    def unwatch(self):
+        """Stop following this process's commits."""
+        if self._onChange in pg.listeners:
+            pg.listeners.remove(self._onChange)
+
+    def lookup(self, symbol, at):
+        """Get the row for a symbol as of a time, or None."""
+        with self.lock:
+            if self.stale:
+                self.refresh()
+            times = self.times.get(symbol)
+            if not times:
+                return None
+            position = bisect.bisect_right(times, at)
+            if not position:
+                return None
+            return dict(zip(
+                pg.networkStatusColumns, self.rows[symbol][position - 1]))
+
+    def lookupMany(self, pairs):
+        """Get rows as of each (symbol, timestamp) pair, aligned to pairs."""
+        with self.lock:
+            return [self.lookup(symbol, at) for symbol, at in pairs]
@@ -0,0 +1,517 @@
+""" Benchmarks for the coinchoose scraper. """
+import archive
+import argparse
+import coinchoose
+import collections
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import json
+import logging
+import os
+import pg
+import platform
+import random
+import resource
+import scrape
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+# Configuration
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s:%(message)s',
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+loadSizes = [100, 1000, 10000, 100000, 1000000]
+# Symbols per synthetic payload in the stage suite
+payloadSizes = [100, 1000, 10000, 100000, 1000000]
+# Timed runs of each stage at each size
+suiteRepeat = 5
+# Share of numeric fields left null in synthetic payloads
+nullRate = 0.02
+# Share of symbols whose network status changes between synthetic scrapes
+changeRate = 0.1
+
+
+def _networkStatusRows(count):
+    """Generate synthetic network status rows."""
+    scrapeTime = datetime.utcnow()
+    return [
+        {
+            'symbol': "S{0}".format(index),
+            'scrape_time': scrapeTime,
+            'current_blocks': long(100000 + index),
+            'difficulty': Decimal("1.52109832"),
+            'reward': Decimal(50),
+            'hash_rate': long(10308452),
+            'avg_hash_rate': Decimal("10308452.0000")
+        } for index in range(count)]
+
+
+def benchStagingLoad(sizes=None, modes=("insert", "copy")):
+    """Time filling a staging table with each load mode."""
+    sizes = sizes if sizes is not None else loadSizes
+    results = []
+    cursor = pg.cursor()
+    loadModeOriginal = pg.loadMode
+    try:
+        for count in sizes:
+            data = _networkStatusRows(count)
+            for mode in modes:
+                pg.loadMode = mode
+                stagingTable = pg._staging(
+                    pg.tables['network_status'], cursor)
+                start = time.time()
+                pg._loadStaging(
+                    stagingTable, pg.networkStatusColumns, data, cursor)
+                elapsed = time.time() - start
+                cursor.connection.rollback()
+                logging.info(
+                    "{0:>6} {1:>8} rows {2:>10.3f}s {3:>12.0f} rows/s".format(
+                        mode, count, elapsed, count / elapsed))
+                results.append({
+                    'mode': mode,
+                    'rows': count,
+                    'seconds': elapsed
+                })
+    finally:
+        pg.loadMode = loadModeOriginal
+    return results
+
+
+def _server(params):
+    """Normalise connection settings to (host, port, database).
+
+    Unix sockets and loopback addresses all count as the local host.
+    """
+    params = dict(params)
+    if 'dsn' in params:
+        params.update(pg._driver().extensions.parse_dsn(params.pop('dsn')))
+    host = params.get('host') or os.environ.get('PGHOST') or ''
+    if not host or host.startswith('/') or \
+            host in ('localhost', '127.0.0.1', '::1'):
+        host = 'localhost'
+    port = "{0}".format(
+        params.get('port') or os.environ.get('PGPORT') or 5432)
+    user = params.get('user') or os.environ.get('PGUSER')
+    database = params.get('dbname') or params.get('database') or \
+        os.environ.get('PGDATABASE') or user
+    return host, port, database
+
+
+def useScratchDatabase(scratchDsn):
+    """Point pg at a throwaway database for the database benchmarks.
+
+    The benchmarks create, fill and drop tables, so they refuse to run
+    without a DSN of their own, or with one naming the database the scraper
+    is configured to use.
+    """
+    if not scratchDsn:
+        raise Exception(
+            "The database benchmarks need --dsn for a scratch database.")
+    configured = _server(pg.connectionParams())
+    if _server({'dsn': scratchDsn}) == configured:
+        raise Exception(
+            "--dsn names the scraper's own database ({0}:{1}/{2}); give it "
+            "a scratch database.".format(*configured))
+    pg.disconnect()
+    pg.closePool()
+    pg.dsn = scratchDsn
+    pg.dbcParams = None
+
+
+def _createScratchTables():
+    """Point pg at empty copies of its tables, returning the original map."""
+    tablesOriginal = pg.tables
+    pg.tables = dict(
+        (key, "{0}_bench".format(table))
+        for key, table in tablesOriginal.items())
+    pg.clearCache()
+    cursor = pg.cursor()
+    for key, table in pg.tables.items():
+        cursor.execute("""CREATE TABLE IF NOT EXISTS
+            {0} (LIKE {1} INCLUDING ALL)""".format(
+            table, tablesOriginal[key]))
+    cursor.connection.commit()
+    return tablesOriginal
+
+
+def _dropScratchTables(tablesOriginal):
+    """Drop the copies made by _createScratchTables and restore pg."""
+    cursor = pg.cursor()
+    cursor.connection.rollback()
+    for table in pg.tables.values():
+        cursor.execute("""DROP TABLE IF EXISTS {0}""".format(table))
+    cursor.connection.commit()
+    pg.tables = tablesOriginal
+    pg.clearCache()
+
+
+def benchPreparedMerge(symbols=1000, scrapes=20):
+    """Time scrapes of network status with and without prepared statements.
+
+    Each scrape changes every row so the full merge runs. The merges go to
+    scratch copies of the tables, and the difference in time per scrape is
+    the parsing and planning saved by preparing the statements.
+    """
+    useChangeCacheOriginal = pg.useChangeCache
+    usePreparedOriginal = pg.usePreparedStatements
+    pg.useChangeCache = False
+    results = []
+    tablesOriginal = _createScratchTables()
+    try:
+        data = _networkStatusRows(symbols)
+        for prepared in (False, True):
+            pg.usePreparedStatements = prepared
+            # The first scrape prepares the statements, so it is not timed
+            pg.insertLatestNetworkStatus(data)
+            start = time.time()
+            for scrape in range(scrapes):
+                for datum in data:
+                    datum['scrape_time'] = datetime.utcnow()
+                    datum['current_blocks'] += 1
+                pg.insertLatestNetworkStatus(data)
+            elapsed = (time.time() - start) / scrapes
+            logging.info("{0:>10} {1:>8} symbols {2:>10.4f}s/scrape".format(
+                "prepared" if prepared else "plain", symbols, elapsed))
+            results.append({
+                'prepared': prepared,
+                'symbols': symbols,
+                'seconds_per_scrape': elapsed
+            })
+        logging.info("Saved {0:.2f}ms per scrape.".format(
+            (results[0]['seconds_per_scrape'] -
+             results[1]['seconds_per_scrape']) * 1000))
+    finally:
+        _dropScratchTables(tablesOriginal)
+        pg.useChangeCache = useChangeCacheOriginal
+        pg.usePreparedStatements = usePreparedOriginal
+    return results
+
+
+def _maybeNull(rng, value):
+    """Replace a value with None at the configured null rate."""
+    return None if rng.random() < nullRate else value
+
+
+def syntheticPayload(count, generation=0, seed=0):
+    """Generate an API payload shaped like coinchoose's for count symbols.
+
+    Records carry the numeric duplicate keys, string-encoded numbers and
+    occasional nulls of the real API. The same seed always gives the same
+    currencies; each generation advances the blocks of about changeRate of
+    the symbols, like consecutive scrapes.
+    """
+    rng = random.Random(seed)
+    algos = ["scrypt", "SHA-256", "X11", "scrypt-n", "Quark"]
+    records = []
+    for index in range(count):
+        symbol = "S{0:07d}".format(index)
+        name = "Synthcoin{0}".format(index)
+        algo = algos[index % len(algos)]
+        blocks = rng.randint(1000, 5000000)
+        # Which symbols advance is fixed per seed, like active coins
+        if (index * 2654435761 + seed) % 1000 < changeRate * 1000:
+            blocks += generation
+        difficulty = "{0:.8f}".format(rng.uniform(0.001, 5000))
+        reward = "{0}".format(rng.choice([5, 10, 25, 50, 100, 5000]))
+        blockTime = "{0}".format(rng.choice([0.5, 1, 2.5, 10]))
+        hashRate = "{0}".format(rng.randint(0, 10 ** 12))
+        avgHash = rng.choice(
+            [0, "{0:.4f}".format(rng.uniform(0, 10 ** 12))])
+        blocks = _maybeNull(rng, "{0}".format(blocks))
+        difficulty = _maybeNull(rng, difficulty)
+        hashRate = _maybeNull(rng, hashRate)
+        avgHash = _maybeNull(rng, avgHash)
+        record = collections.OrderedDict([
+            ("0", symbol), ("symbol", symbol),
+            ("1", name), ("name", name),
+            ("2", algo), ("algo", algo),
+            ("3", blocks), ("currentBlocks", blocks),
+            ("4", difficulty), ("difficulty", difficulty),
+            ("5", reward), ("reward", reward),
+            ("6", blockTime), ("minBlockTime", blockTime),
+            ("7", hashRate), ("networkhashrate", hashRate),
+            ("price", "{0:.20f}".format(rng.uniform(0, 0.001))),
+            ("exchange", "Cryptsy"),
+            ("exchange_url",
+             "https://www.cryptsy.com/users/register?refid=213505"),
+            ("ratio", rng.uniform(0, 10000)),
+            ("adjustedratio", rng.uniform(0, 10000)),
+            ("avgProfit", "{0}".format(rng.uniform(0, 10000))),
+            ("avgHash", avgHash)
+        ])
+        records.append(record)
+    return json.dumps(records, separators=(",", ":"))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    """Serve the stub server's payload for every GET."""
+
+    def do_GET(self):
+        """Send the current payload."""
+        body = self.server.payload.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "{0}".format(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keep requests out of the benchmark output."""
+        pass
+
+
+def _startStubServer(payload):
+    """Serve a payload on a local port, returning the server."""
+    server = HTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.payload = payload
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _peakRss():
+    """Peak resident set size of this process in kilobytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def _summarise(stage, symbols, latencies):
+    """Build the result record for one stage at one size."""
+    median = _percentile(latencies, 0.5)
+    result = {
+        'stage': stage,
+        'symbols': symbols,
+        'runs': len(latencies),
+        'mean': sum(latencies) / len(latencies),
+        'p50': median,
+        'p90': _percentile(latencies, 0.9),
+        'p99': _percentile(latencies, 0.99),
+        'max': max(latencies),
+        'rows_per_second': symbols / median if median > 0 else None,
+        'peak_rss_kb': _peakRss()
+    }
+    logging.info(
+        "{0:>22} {1:>8} symbols  p50 {2:>9.4f}s  p90 {3:>9.4f}s  "
+        "{4:>10.0f} rows/s  rss {5} kB".format(
+            stage, symbols, result['p50'], result['p90'],
+            result['rows_per_second'] or 0, result['peak_rss_kb']))
+    return result
+
+
+def _time(function, repeat, before=None):
+    """Time repeat calls of a function, calling before (untimed) first."""
+    latencies = []
+    for run in range(repeat):
+        if before is not None:
+            before(run)
+        start = time.time()
+        function()
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def benchStages(sizes=None, repeat=None, database=True):
+    """Time each stage of a scrape on synthetic payloads.
+
+    requestLatest is timed against a local stub server, saveToFile against a
+    scratch archive and the inserts against scratch copies of the tables.
+    Peak RSS is cumulative, so it is the peak reached by the end of each
+    stage. Returns a JSON-serialisable report.
+    """
+    sizes = sizes if sizes is not None else payloadSizes
+    repeat = repeat if repeat is not None else suiteRepeat
+    results = []
+    baseUrlOriginal = coinchoose.baseUrl
+    requestRateOriginal = coinchoose.requestRate
+    requestBurstOriginal = coinchoose.requestBurst
+    archiveDirOriginal = archive.archiveDir
+    archive.archiveDir = tempfile.mkdtemp()
+    archive._lastRecords.clear()
+    coinchoose.requestRate = 1e9
+    coinchoose.requestBurst = 1e9
+    tablesOriginal = _createScratchTables() if database else None
+    try:
+        for symbols in sizes:
+            payloads = [syntheticPayload(symbols, generation)
+                        for generation in range(repeat)]
+            server = _startStubServer(payloads[0])
+            coinchoose.baseUrl = "http://127.0.0.1:{0}".format(
+                server.server_address[1])
+            try:
+                latencies = _time(coinchoose.requestLatest, repeat)
+            finally:
+                server.shutdown()
+                server.server_close()
+            results.append(_summarise("request_latest", symbols, latencies))
+
+            results.append(_summarise("parse_currencies", symbols, _time(
+                lambda: coinchoose.parseLatestCurrencies(payloads[0]),
+                repeat)))
+            results.append(_summarise("parse_network_status", symbols, _time(
+                lambda: coinchoose.parseLatestNetworkStatus(
+                    payloads[0], scrapeTime=datetime.utcnow()),
+                repeat)))
+
+            # Consecutive scrapes differ, so each one is stored in full
+            start = datetime.utcnow()
+            state = {}
+
+            def nextPayload(run):
+                state['payload'] = payloads[run]
+                state['scrapeTime'] = start + timedelta(minutes=run)
+            results.append(_summarise("save_to_file", symbols, _time(
+                lambda: scrape.saveToFile(
+                    state['payload'], "bench_{0}".format(symbols),
+                    scrapeTime=state['scrapeTime']),
+                repeat, nextPayload)))
+
+            if not database:
+                continue
+            currencies = coinchoose.parseLatestCurrencies(payloads[0])
+            results.append(_summarise("insert_currencies", symbols, _time(
+                lambda: pg.insertLatestCurrencies(currencies), repeat)))
+
+            def nextNetworkStatus(run):
+                state['data'] = coinchoose.parseLatestNetworkStatus(
+                    payloads[run], scrapeTime=start + timedelta(minutes=run))
+            results.append(_summarise("insert_network_status", symbols, _time(
+                lambda: pg.insertLatestNetworkStatus(state['data']),
+                repeat, nextNetworkStatus)))
+            cursor = pg.cursor()
+            for table in pg.tables.values():
+                cursor.execute("""TRUNCATE {0}""".format(table))
+            cursor.connection.commit()
+            pg.clearCache()
+    finally:
+        coinchoose.baseUrl = baseUrlOriginal
+        coinchoose.requestRate = requestRateOriginal
+        coinchoose.requestBurst = requestBurstOriginal
+        shutil.rmtree(archive.archiveDir)
+        archive.archiveDir = archiveDirOriginal
+        archive._lastRecords.clear()
+        if tablesOriginal is not None:
+            _dropScratchTables(tablesOriginal)
+    return {
+        'started': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'null_rate': nullRate,
+        'change_rate': changeRate,
+        'results': results
+    }
+
+
+def compareReports(baseline, candidate):
+    """Compare two stage suite reports, logging the change at each stage.
+
+    Returns (stage, symbols, baseline p50, candidate p50, ratio) tuples; a
+    ratio above 1 means the candidate is slower.
+    """
+    before = dict(
+        ((result['stage'], result['symbols']), result)
+        for result in baseline['results'])
+    comparison = []
+    for result in candidate['results']:
+        key = (result['stage'], result['symbols'])
+        if key not in before:
+            continue
+        old = before[key]['p50']
+        ratio = result['p50'] / old if old > 0 else None
+        comparison.append(key + (old, result['p50'], ratio))
+        logging.info(
+            "{0:>22} {1:>8} symbols  p50 {2:>9.4f}s -> {3:>9.4f}s  "
+            "{4}".format(
+                key[0], key[1], old, result['p50'],
+                "{0:+.1f}%".format((ratio - 1) * 100)
+                if ratio is not None else "n/a"))
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dsn",
+        help="libpq connection string of a scratch database for the "
+        "database benchmarks (never the scraper's own)")
+    parser.add_argument(
+        "--max-rows", type=int, default=loadSizes[-1],
+        help="largest batch to load (the insert mode is slow at 10^6)")
+    parser.add_argument(
+        "--modes", default="insert,copy",
+        help="comma separated load modes to compare")
+    parser.add_argument(
+        "--prepared", action="store_true",
+        help="compare merges with and without prepared statements instead")
+    parser.add_argument(
+        "--symbols", type=int, default=1000,
+        help="symbols per scrape when comparing prepared statements")
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="time each scrape stage on synthetic payloads instead")
+    parser.add_argument(
+        "--max-symbols", type=int, default=100000,
+        help="largest synthetic payload for the suite (up to 10^6)")
+    parser.add_argument(
+        "--repeat", type=int, default=suiteRepeat,
+        help="timed runs of each suite stage")
+    parser.add_argument(
+        "--no-db", action="store_true",
+        help="skip the database stages of the suite")
+    parser.add_argument(
+        "--output",
+        help="write the suite report to this JSON file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASELINE", "CANDIDATE"),
+        help="compare two suite reports instead of running anything")
+    args = parser.parse_args()
+    if not args.compare and not (args.suite and args.no_db):
+        try:
+            useScratchDatabase(args.dsn)
+        except Exception as e:
+            parser.error(e)
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            f = open(path, 'r')
+            reports.append(json.load(f))
+            f.close()
+        compareReports(*reports)
+    elif args.suite:
+        report = benchStages(
+            sizes=[size for size in payloadSizes if size <= args.max_symbols],
+            repeat=args.repeat, database=not args.no_db)
+        if args.output:
+            f = open(args.output, 'w')
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.close()
+        else:
+            print(json.dumps(report, indent=2, sort_keys=True))
+    elif args.prepared:
+        benchPreparedMerge(symbols=args.symbols)
+    else:
+        benchStagingLoad(
+            sizes=[size for size in loadSizes if size <= args.max_rows],
+            modes=args.modes.split(","))
@@ -0,0 +1,179 @@
+""" Command line entry point for the scraper. """
+import argparse
+import json
+import logging
+import numbers
+import os
+import re
+import sys
+import time
+
+# Configuration
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s:%(message)s',
+    datefmt='%m/%d/%Y %I:%M:%S %p')
+
+_legacyName = re.compile(r"_(\d+)\.json$")
+
+# Fallback for when the process start time cannot be read
+_imported = time.time()
+
+
+def processStart():
+    """Unix time the process started, from /proc where available.
+
+    This includes interpreter startup and imports made before this module,
+    which is what a forking orchestrator waits on.
+    """
+    try:
+        f = open("/proc/self/stat", 'r')
+        stat = f.read()
+        f.close()
+        # Fields after the parenthesised command name; starttime is the
+        # 22nd field overall, in clock ticks since boot
+        ticks = int(stat[stat.rindex(")") + 2:].split()[19])
+        f = open("/proc/uptime", 'r')
+        uptime = float(f.read().split()[0])
+        f.close()
+        return time.time() - (
+            uptime - float(ticks) / os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, IndexError, ValueError, AttributeError):
+        return _imported
+
+
+def _payloadTime(path, scrapeTime=None):
+    """Scrape time of a payload file: given, from its name, or its mtime."""
+    from datetime import datetime
+    from datetime import timedelta
+    if scrapeTime is not None:
+        return datetime.strptime(scrapeTime, "%Y-%m-%dT%H:%M:%S")
+    match = _legacyName.search(os.path.basename(path))
+    if match is not None:
+        return datetime(1970, 1, 1) + timedelta(seconds=int(match.group(1)))
+    return datetime.utcfromtimestamp(os.path.getmtime(path))
+
+
+def _readPayloads(args):
+    """Read and parse the payload files named on the command line.
+
+    Returns (path, scrape time, currencies, network status) in time order.
+    """
+    import coinchoose
+    parsed = []
+    for path in args.files:
+        f = open(path, 'r')
+        jsonDump = f.read()
+        f.close()
+        scrapeTime = _payloadTime(path, args.scrape_time)
+        currencies, networkStatus = coinchoose.parseLatest(
+            jsonDump, scrapeTime=scrapeTime)
+        parsed.append((path, scrapeTime, currencies, networkStatus))
+    parsed.sort(key=lambda payload: payload[1])
+    return parsed
+
+
+def runScrape(args):
+    """Scrape with scrape.py's options."""
+    import metrics
+    import scrape
+    metrics.setGauge("startup_seconds", args.startup)
+    scrape.main(args.options)
+
+
+def runDryRun(args):
+    """Fetch and parse one scrape without archiving or storing it."""
+    import coinchoose
+    if args.bases is not None:
+        coinchoose.bases = args.bases.split(",")
+    for base, jsonDump, scrapeTime in coinchoose.requestLatestBases():
+        currencies, networkStatus = coinchoose.parseLatest(
+            jsonDump, scrapeTime=scrapeTime)
+        print("{0}\t{1}\t{2} bytes\t{3} currencies\t{4} network status "
+              "rows".format(base, scrapeTime, len(jsonDump),
+                            len(currencies), len(networkStatus)))
+
+
+def runParseOnly(args):
+    """Parse payload files and print their rows, touching nothing else."""
+    for path, scrapeTime, currencies, networkStatus in _readPayloads(args):
+        if not args.rows:
+            print("{0}\t{1}\t{2} currencies\t{3} network status rows".format(
+                path, scrapeTime, len(currencies), len(networkStatus)))
+            continue
+        for datum in networkStatus:
+            print(json.dumps(dict(
+                (key, value if value is None or isinstance(
+                    value, (numbers.Integral, float)) else "{0}".format(value))
+                for key, value in datum.items()), sort_keys=True))
+
+
+def runLoadFile(args):
+    """Store payload files in the database, oldest first."""
+    import pg
+    for path, scrapeTime, currencies, networkStatus in _readPayloads(args):
+        pg.insertLatestCurrencies(currencies)
+        pg.insertLatestNetworkStatus(networkStatus)
+        logging.info("Loaded {0} ({1} rows).".format(
+            path, len(networkStatus)))
+    pg.disconnect()
+    pg.closePool()
+
+
+def _fileArguments(command):
+    """Add the arguments of subcommands reading payload files."""
+    command.add_argument("files", nargs="+", help="payload files")
+    command.add_argument(
+        "--scrape-time",
+        help="scrape time (YYYY-MM-DDTHH:MM:SS, UTC) for every file; by "
+        "default it is taken from <name>_<epoch>.json names or mtimes")
+
+
+def parser():
+    """Build the argument parser."""
+    result = argparse.ArgumentParser(description=__doc__)
+    result.add_argument(
+        "--timing", action="store_true",
+        help="report startup and total time on stderr")
+    commands = result.add_subparsers(dest="command")
+    command = commands.add_parser(
+        "scrape", help="scrape (options as for scrape.py)")
+    command.add_argument("options", nargs=argparse.REMAINDER)
+    command.set_defaults(run=runScrape)
+    command = commands.add_parser(
+        "dry-run", help="fetch and parse one scrape, storing nothing")
+    command.add_argument(
+        "--bases", help="comma separated list of bases to fetch")
+    command.set_defaults(run=runDryRun)
+    command = commands.add_parser(
+        "parse-only", help="parse payload files offline")
+    _fileArguments(command)
+    command.add_argument(
+        "--rows", action="store_true",
+        help="print network status rows as JSON lines")
+    command.set_defaults(run=runParseOnly)
+    command = commands.add_parser(
+        "load-file", help="store payload files in the DB")
+    _fileArguments(command)
+    command.set_defaults(run=runLoadFile)
+    return result
+
+
+def main(argv=None):
+    """Run a subcommand, importing only the modules it needs."""
+    args = parser().parse_args(argv)
+    if getattr(args, 'run', None) is None:
+        parser().error("a command is required")
+    started = processStart()
+    args.startup = time.time() - started
+    logging.debug("Started in {0:.1f} ms.".format(args.startup * 1000))
+    try:
+        args.run(args)
+    finally:
+        if args.timing:
+            sys.stderr.write("startup {0:.1f} ms, total {1:.1f} ms\n".format(
+                args.startup * 1000, (time.time() - started) * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,142 +1,461 @@
 """ Module for requesting data from coinchoose.com and parsing it. """
+from array import array
 from datetime import date
 from datetime import datetime
 from datetime import time as tm
 from decimal import Decimal
 import json
 import logging
-import requests
-import os
+import metrics
 from random import random
 import sys
+import threading
 import time
-import unittest
+import traceback
 
 baseUrl = "http://www.coinchoose.com"
 countRequested = 0
-interReqTime = 2
-lastReqTime = None
+# Bases to fetch in each scrape
+bases = ["BTC"]
+# Token bucket rate limit shared by all requests: requestRate requests per
+# second on average, with bursts of up to requestBurst requests
+requestRate = 0.5
+requestBurst = 1
+# Concurrent requests when fetching several bases
+maxWorkers = 4
+# Retries for timeouts, connection errors and 5xx responses, waiting
+# backoffBase * 2^attempt seconds (with jitter) between attempts
+maxRetries = 3
+backoffBase = 1
+requestTimeout = 30
+# Keep-alive HTTP session shared by all requests
+session = None
+# Revalidate repeated requests with If-None-Match / If-Modified-Since, so an
+# unchanged payload comes back as a bodyless 304
+conditionalRequests = True
+# Optional faster JSON module (e.g. ujson) used in place of streaming decode
+jsonBackend = None
 
+# The requests module, imported by _session when the first request is made
+requests = None
 
-def _request(payloadString):
-    """Private method for requesting an arbitrary query string."""
-    global countRequested
-    global lastReqTime
-    if lastReqTime is not None and time.time() - lastReqTime < interReqTime:
-        timeToSleep = random()*(interReqTime-time.time()+lastReqTime)*2
+# Symbols shared by every batch, so each one is only stored once
+_symbolTable = {}
+
+# Validators and body of the last 200 response for each URL
+_validators = {}
+
+# Rate limiter state
+_lock = threading.Lock()
+_tokens = None
+_tokenTime = None
+
+
+def _session():
+    """Get the shared HTTP session, opening it if needed."""
+    global session
+    global requests
+    with _lock:
+        if session is None:
+            import requests
+            import requests.adapters
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = "gzip, deflate"
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=maxWorkers, pool_maxsize=maxWorkers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+    return session
+
+
+def _acquireToken():
+    """Take a token from the rate limiter, sleeping until it is available.
+
+    Tokens are reserved under the lock and may go negative, so concurrent
+    callers queue up behind each other instead of all waking at once.
+    """
+    global _tokens
+    global _tokenTime
+    with _lock:
+        now = time.time()
+        if _tokenTime is None:
+            _tokens = requestBurst
+        else:
+            _tokens = min(
+                requestBurst, _tokens + (now - _tokenTime) * requestRate)
+        _tokenTime = now
+        _tokens -= 1
+        timeToSleep = -_tokens / requestRate if _tokens < 0 else 0
+    if timeToSleep > 0:
         logging.info("Sleeping for {0} seconds before request.".format(
             timeToSleep))
         time.sleep(timeToSleep)
-    logging.info("Issuing request for the following payload: {0}".format(
-        payloadString))
-    r = requests.get("{0}/{1}".format(baseUrl, payloadString))
-    lastReqTime = time.time()
-    countRequested += 1
-    if r.status_code == requests.codes.ok:
-        return r.text
+    return timeToSleep
+
+
+def _conditionalHeaders(url):
+    """Build revalidation headers from the last response for a URL."""
+    headers = {}
+    cached = _validators.get(url) if conditionalRequests else None
+    if cached is not None:
+        etag, lastModified, text = cached
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if lastModified is not None:
+            headers['If-Modified-Since'] = lastModified
+    return headers
+
+
+def _keepValidators(url, r):
+    """Keep the validators and body of a 200 response for revalidation."""
+    etag = r.headers.get('ETag')
+    lastModified = r.headers.get('Last-Modified')
+    if etag is None and lastModified is None:
+        _validators.pop(url, None)
     else:
-        raise Exception("Could not process request. \
-            Received status code {0}.".format(r.status_code))
+        _validators[url] = (etag, lastModified, r.text)
+
+
+def _request(payloadString):
+    """Private method for requesting an arbitrary query string.
+
+    Responses carrying an ETag or Last-Modified header are revalidated on
+    the next request for the same URL, and a 304 answer returns the body
+    of the response that was revalidated.
+    """
+    global countRequested
+    url = "{0}/{1}".format(baseUrl, payloadString)
+    _session()
+    for attempt in range(maxRetries + 1):
+        metrics.increment(
+            "request_sleep_seconds_total", _acquireToken(),
+            reason="rate_limit")
+        logging.info("Issuing request for the following payload: {0}".format(
+            payloadString))
+        try:
+            with metrics.timer("http_request"):
+                r = _session().get(
+                    url, headers=_conditionalHeaders(url),
+                    timeout=requestTimeout)
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError) as e:
+            metrics.increment("http_errors_total", error=type(e).__name__)
+            reason = repr(e)
+        else:
+            with _lock:
+                countRequested += 1
+            metrics.increment(
+                "http_responses_total", status=r.status_code)
+            metrics.increment("http_response_bytes_total", len(r.content))
+            if r.status_code == requests.codes.ok:
+                _keepValidators(url, r)
+                return r.text
+            elif r.status_code == requests.codes.not_modified and \
+                    url in _validators:
+                return _validators[url][2]
+            elif r.status_code < 500:
+                raise Exception("Could not process request. \
+                    Received status code {0}.".format(r.status_code))
+            reason = "status code {0}".format(r.status_code)
+        if attempt < maxRetries:
+            backoff = backoffBase * pow(2, attempt) * (0.5 + random())
+            logging.warning(
+                "Request for {0} failed ({1}). Retrying in {2} seconds."
+                .format(payloadString, reason, backoff))
+            time.sleep(backoff)
+            metrics.increment(
+                "request_sleep_seconds_total", backoff, reason="backoff")
+    raise Exception("Could not process request after {0} attempts. \
+        Last failure: {1}.".format(maxRetries + 1, reason))
 
 
-def requestLatest():
+def requestLatest(base="BTC"):
     """Method for requesting a the lastest set of information."""
-    return _request("api.php?base=BTC")
+    return _request("api.php?base={0}".format(base))
+
+
+def _requestBase(base):
+    """Request one base, returning None if it could not be fetched."""
+    try:
+        jsonDump = requestLatest(base)
+    except Exception:
+        logging.error("Could not fetch base {0}:\n{1}".format(
+            base, traceback.format_exc()))
+        return None
+    return (base, jsonDump, datetime.utcnow())
+
+
+def requestLatestBases(baseList=None):
+    """Request several bases concurrently.
+
+    Returns a list of (base, jsonDump, scrapeTime) tuples in the order of
+    baseList, where scrapeTime is when that base's response arrived. Bases
+    that could not be fetched are logged and left out.
+    """
+    from multiprocessing.pool import ThreadPool
+    baseList = baseList if baseList is not None else bases
+    pool = ThreadPool(max(1, min(maxWorkers, len(baseList))))
+    try:
+        results = pool.map(_requestBase, baseList)
+    finally:
+        pool.close()
+        pool.join()
+    results = [result for result in results if result is not None]
+    if baseList and not results:
+        raise Exception("Could not fetch any of the bases {0}.".format(
+            ", ".join(baseList)))
+    return results
+
+
+def _dropNumericKeys(pairs):
+    """Build a record from key/value pairs, skipping numeric duplicate keys."""
+    return dict((key, value) for key, value in pairs if not key.isdigit())
+
+
+def _skipWhitespace(jsonDump, idx):
+    """Advance an index past any JSON whitespace."""
+    while idx < len(jsonDump) and jsonDump[idx] in " \t\r\n":
+        idx += 1
+    return idx
+
+
+def iterRecords(jsonDump, backend=None):
+    """Iterate over the raw records in an API payload one at a time.
+
+    With the default backend the top-level array is decoded record by record
+    so the whole payload never has to be materialised as Python objects. Any
+    other backend (e.g. ujson or orjson) is expected to expose a loads method
+    and is used to decode the payload in one call.
+    """
+    backend = backend if backend is not None else jsonBackend
+    if backend is not None:
+        for rawDatum in backend.loads(jsonDump):
+            yield rawDatum
+        return
+    decoder = json.JSONDecoder(object_pairs_hook=_dropNumericKeys)
+    idx = _skipWhitespace(jsonDump, 0)
+    if jsonDump[idx:idx + 1] != "[":
+        raise ValueError("Expected a JSON array at position {0}.".format(idx))
+    idx = _skipWhitespace(jsonDump, idx + 1)
+    if jsonDump[idx:idx + 1] == "]":
+        return
+    while True:
+        rawDatum, idx = decoder.raw_decode(jsonDump, idx)
+        yield rawDatum
+        idx = _skipWhitespace(jsonDump, idx)
+        if jsonDump[idx:idx + 1] == ",":
+            idx = _skipWhitespace(jsonDump, idx + 1)
+        elif jsonDump[idx:idx + 1] == "]":
+            return
+        else:
+            raise ValueError(
+                "Expected ',' or ']' at position {0}.".format(idx))
+
+
+def _currencyDatum(rawDatum):
+    """Build a currency row from a raw API record."""
+    datum = {}
+    datum['symbol'] = rawDatum['symbol']
+    datum['name'] = rawDatum['name']
+    datum['algo'] = rawDatum['algo']
+    return datum
+
+
+def _networkStatusDatum(rawDatum, scrapeTime):
+    """Build a network status row from a raw API record."""
+    datum = {}
+    datum['symbol'] = rawDatum['symbol']
+    datum['scrape_time'] = scrapeTime
+    datum['current_blocks'] = long(rawDatum['currentBlocks']) if rawDatum['currentBlocks'] is not None else None
+    datum['difficulty'] = Decimal(rawDatum['difficulty']) if rawDatum['difficulty'] is not None else None
+    datum['reward'] = Decimal(rawDatum['reward']) if rawDatum['reward'] is not None else None
+    datum['hash_rate'] = long(rawDatum['networkhashrate']) if rawDatum['networkhashrate'] is not None else None
+    datum['avg_hash_rate'] = Decimal(rawDatum['avgHash']) if rawDatum['avgHash'] is not None else None
+    return datum
+
+
+def iterLatest(jsonDump, scrapeTime=None, backend=None):
+    """Iterate over (currency, network status) row pairs from an API call."""
+    scrapeTime = scrapeTime if scrapeTime is not None else datetime.utcnow()
+    for rawDatum in iterRecords(jsonDump, backend=backend):
+        yield (_currencyDatum(rawDatum),
+               _networkStatusDatum(rawDatum, scrapeTime))
+
+
+def parseLatest(jsonDump, scrapeTime=None, backend=None):
+    """Parse currencies and network status from an API call in one pass."""
+    currencies = []
+    networkStatus = []
+    for currency, status in iterLatest(
+            jsonDump, scrapeTime=scrapeTime, backend=backend):
+        currencies.append(currency)
+        networkStatus.append(status)
+    return currencies, networkStatus
 
 
 def parseLatestCurrencies(jsonDump):
     """Parse the latest currency list from an API call."""
-    data = []
-    rawData = json.loads(jsonDump)
-    for rawDatum in rawData:
-        datum = {}
-        datum['symbol'] = rawDatum['symbol']
-        datum['name'] = rawDatum['name']
-        datum['algo'] = rawDatum['algo']
-        data.append(datum)
-    return data
+    return [_currencyDatum(rawDatum) for rawDatum in iterRecords(jsonDump)]
 
 
 def parseLatestNetworkStatus(jsonDump, scrapeTime=datetime.utcnow()):
     """Parse the latest network status from API call."""
-    data = []
-    rawData = json.loads(jsonDump)
-    for rawDatum in rawData:
-        datum = {}
-        datum['symbol'] = rawDatum['symbol']
-        datum['scrape_time'] = scrapeTime
-        datum['current_blocks'] = long(rawDatum['currentBlocks']) if rawDatum['currentBlocks'] is not None else None
-        datum['difficulty'] = Decimal(rawDatum['difficulty']) if rawDatum['difficulty'] is not None else None
-        datum['reward'] = Decimal(rawDatum['reward']) if rawDatum['reward'] is not None else None
-        datum['hash_rate'] = long(rawDatum['networkhashrate']) if rawDatum['networkhashrate'] is not None else None
-        datum['avg_hash_rate'] = Decimal(rawDatum['avgHash']) if rawDatum['avgHash'] is not None else None
-        data.append(datum)
-    return data
-
-
-class CoinchooseTest(unittest.TestCase):
-
-    """"Testing suite for coinchoose module."""
-
-    def testRequestLatest(self):
-        """Test requestLatest."""
-        jsonDump = requestLatest()
-        f = open("{0}/data/test_api.json".format(
-            os.path.dirname(os.path.abspath(__file__))), 'w')
-        f.write(jsonDump)
-        f.close()
-        json.loads(jsonDump)
-
-    def testParseLatestCurrencies(self):
-        """Method for testing parseLatestCurrencies."""
-        f = open("{0}/example/api.json".format(
-            os.path.dirname(os.path.abspath(__file__))), 'r')
-        jsonDump = f.read()
-        f.close()
-        data = parseLatestCurrencies(jsonDump)
-        self.assertEqual(len(data), 59)
-        expectedFirst = {
-            'symbol': 'ALF',
-            'name': 'Alphacoin',
-            'algo': 'scrypt'
-        }
-        self.assertEqual(data[0], expectedFirst)
-        expectedLast = {
-            'symbol': 'GLC',
-            'name': 'GlobalCoin',
-            'algo': 'scrypt'
-        }
-        self.assertEqual(data[-1], expectedLast)
-
-    def testParseLatestNetworkStatus(self):
-        """Method for testing parseLatestNetworkStatus."""
-        f = open("{0}/example/api.json".format(
-            os.path.dirname(os.path.abspath(__file__))), 'r')
-        jsonDump = f.read()
-        f.close()
-        now = datetime.utcnow()
-        data = parseLatestNetworkStatus(jsonDump, scrapeTime=now)
-        self.assertEqual(len(data), 59)
-        expectedFirst = {
-            'symbol': 'ALF',
-            'scrape_time': now,
-            'current_blocks': long(655258),
-            'difficulty': Decimal("1.52109832"),
-            'reward': Decimal(50),
-            'hash_rate': long(10308452),
-            'avg_hash_rate': Decimal("10308452.0000")
-        }
-        self.assertEqual(data[0], expectedFirst)
-        expectedLast = {
-            'symbol': 'GLC',
-            'scrape_time': now,
-            'current_blocks': long(300011),
-            'difficulty': Decimal("0.768"),
-            'reward': Decimal(100),
-            'hash_rate': long(0),
-            'avg_hash_rate': Decimal("0")
-        }
-        self.assertEqual(data[-1], expectedLast)
-
-if __name__ == "__main__":
-    unittest.main()
+    return [_networkStatusDatum(rawDatum, scrapeTime)
+            for rawDatum in iterRecords(jsonDump)]
+
+
+class NetworkStatusBatch(object):
+
+    """Column-wise batch of network status rows sharing one scrape time.
+
+    Integer columns are kept in arrays and decimal columns in float64 arrays,
+    each with a null mask. With exact set, the original Decimal values are
+    kept as well and rows carry them; otherwise rows carry floats. Iterating
+    yields the same dicts parseLatestNetworkStatus returns, so a batch can be
+    handed to anything that takes a list of rows.
+    """
+
+    integerColumns = ('current_blocks', 'hash_rate')
+    decimalColumns = ('difficulty', 'reward', 'avg_hash_rate')
+    _rawKeys = {
+        'current_blocks': 'currentBlocks',
+        'hash_rate': 'networkhashrate',
+        'difficulty': 'difficulty',
+        'reward': 'reward',
+        'avg_hash_rate': 'avgHash'
+    }
+
+    def __init__(self, scrapeTime=None, exact=True):
+        """Create an empty batch."""
+        self.scrapeTime = scrapeTime if scrapeTime is not None \
+            else datetime.utcnow()
+        self.exact = exact
+        self.symbols = []
+        self.nulls = dict(
+            (column, bytearray())
+            for column in self.integerColumns + self.decimalColumns)
+        self.integers = dict(
+            (column, array('l')) for column in self.integerColumns)
+        self.floats = dict(
+            (column, array('d')) for column in self.decimalColumns)
+        self.decimals = dict(
+            (column, []) for column in self.decimalColumns) if exact else None
+
+    def append(self, rawDatum):
+        """Add a raw API record to the batch."""
+        symbol = rawDatum['symbol']
+        self.symbols.append(_symbolTable.setdefault(symbol, symbol))
+        for column in self.integerColumns:
+            raw = rawDatum[self._rawKeys[column]]
+            self.nulls[column].append(raw is None)
+            value = long(raw) if raw is not None else 0
+            try:
+                self.integers[column].append(value)
+            except (OverflowError, TypeError):
+                # Too big for a machine integer, keep Python integers instead
+                if isinstance(self.integers[column], array):
+                    self.integers[column] = self.integers[column].tolist()
+                self.integers[column].append(value)
+        for column in self.decimalColumns:
+            raw = rawDatum[self._rawKeys[column]]
+            self.nulls[column].append(raw is None)
+            value = Decimal(raw) if raw is not None else None
+            self.floats[column].append(
+                float(value) if value is not None else float('nan'))
+            if self.exact:
+                self.decimals[column].append(value)
+
+    def __len__(self):
+        """Number of rows in the batch."""
+        return len(self.symbols)
+
+    def column(self, name):
+        """Get one column as a list, with None for nulls."""
+        if name == 'symbol':
+            return list(self.symbols)
+        elif name == 'scrape_time':
+            return [self.scrapeTime] * len(self)
+        nulls = self.nulls[name]
+        if name in self.integers:
+            values = self.integers[name]
+            return [long(values[index]) if not nulls[index] else None
+                    for index in range(len(self))]
+        if self.exact:
+            return list(self.decimals[name])
+        values = self.floats[name]
+        return [values[index] if not nulls[index] else None
+                for index in range(len(self))]
+
+    def floatColumn(self, name):
+        """Get a value column as a float64 array, with NaN for nulls."""
+        if name in self.floats:
+            return self.floats[name]
+        nulls = self.nulls[name]
+        values = self.integers[name]
+        return array('d', (
+            float(values[index]) if not nulls[index] else float('nan')
+            for index in range(len(self))))
+
+    def iterValues(self, columns):
+        """Iterate over rows as tuples of the given columns."""
+        return zip(*[self.column(name) for name in columns]) \
+            if len(self) else iter([])
+
+    def select(self, indexes):
+        """Get a new batch holding the rows at the given positions."""
+        batch = NetworkStatusBatch(
+            scrapeTime=self.scrapeTime, exact=self.exact)
+        batch.symbols = [self.symbols[index] for index in indexes]
+        for column, nulls in self.nulls.items():
+            batch.nulls[column] = bytearray(nulls[index] for index in indexes)
+        for column, values in self.integers.items():
+            selected = [values[index] for index in indexes]
+            batch.integers[column] = array(values.typecode, selected) \
+                if isinstance(values, array) else selected
+        for column, values in self.floats.items():
+            batch.floats[column] = array(
+                'd', (values[index] for index in indexes))
+        if self.exact:
+            for column, values in self.decimals.items():
+                batch.decimals[column] = [values[index] for index in indexes]
+        return batch
+
+    def extend(self, other):
+        """Append the rows of another batch, keeping this scrape time."""
+        if other.exact != self.exact:
+            raise Exception("Cannot mix exact and float batches.")
+        self.symbols.extend(other.symbols)
+        for column in self.nulls:
+            self.nulls[column].extend(other.nulls[column])
+        for column in self.integers:
+            if isinstance(self.integers[column], array) and \
+                    not isinstance(other.integers[column], array):
+                self.integers[column] = self.integers[column].tolist()
+            self.integers[column].extend(other.integers[column])
+        for column in self.floats:
+            self.floats[column].extend(other.floats[column])
+        if self.exact:
+            for column in self.decimals:
+                self.decimals[column].extend(other.decimals[column])
+
+    def retimed(self, scrapeTime):
+        """Get a copy of the batch at another scrape time, sharing columns."""
+        batch = NetworkStatusBatch.__new__(NetworkStatusBatch)
+        batch.__dict__.update(self.__dict__)
+        batch.scrapeTime = scrapeTime
+        return batch
+
+    def __iter__(self):
+        """Iterate over rows as dicts."""
+        names = ('symbol', 'scrape_time') + self.integerColumns + \
+            self.decimalColumns
+        for values in self.iterValues(names):
+            yield dict(zip(names, values))
+
+
+def parseLatestBatch(jsonDump, scrapeTime=None, exact=True, backend=None):
+    """Parse the latest network status from an API call into a batch."""
+    batch = NetworkStatusBatch(scrapeTime=scrapeTime, exact=exact)
+    for rawDatum in iterRecords(jsonDump, backend=backend):
+        batch.append(rawDatum)
+    return batch
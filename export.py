@@ -0,0 +1,402 @@
+""" Module for exporting network status history to columnar files. """
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import os
+import pg
+import shutil
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Configuration
+exportDir = "{0}/data/export".format(
+    os.path.dirname(os.path.abspath(__file__)))
+
+# Exported columns and their NumPy dtypes. scrape_time is microseconds since
+# the epoch, a NULL current_blocks is stored as nullInteger and NULL decimals
+# as NaN.
+columns = [
+    ('scrape_time', '<i8'),
+    ('current_blocks', '<i8'),
+    ('difficulty', '<f8'),
+    ('reward', '<f8'),
+    ('hash_rate', '<f8'),
+    ('avg_hash_rate', '<f8')
+]
+nullInteger = -pow(2, 63)
+
+# Every column file has a fixed-size .npy header so its shape can be
+# rewritten in place when rows are appended
+_headerSize = 128
+_epoch = datetime(1970, 1, 1)
+
+# Rows to export: for each symbol exported before, those after its last
+# exported row (walking the primary key, so rows landing late for a symbol
+# that lags the others are still picked up); for other symbols, those after
+# the newest exported row of any symbol
+_newRowsQuery = """SELECT ns.*
+    FROM unnest(%(symbols)s::varchar[], %(through)s::timestamp[])
+        AS w (symbol, through)
+    JOIN LATERAL (
+        SELECT {0}
+        FROM {1} ns
+        WHERE ns.symbol = w.symbol
+        AND ns.scrape_time > w.through) ns ON TRUE
+    UNION ALL
+    SELECT {0}
+    FROM {1}
+    WHERE NOT (symbol = ANY(%(symbols)s::varchar[]))
+    AND scrape_time > coalesce(%(newest)s::timestamp, '-infinity')"""
+
+logger = logging.getLogger(__name__)
+
+
+def _header(descr, length):
+    """Build a fixed-size .npy (format 1.0) header."""
+    text = "{{'descr': '{0}', 'fortran_order': False, 'shape': ({1},), }}" \
+        .format(descr, length)
+    text = text.ljust(_headerSize - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(text)) + \
+        text.encode('latin1')
+
+
+def _rowCount(f):
+    """Read the row count from the header of an open column file."""
+    f.seek(10)
+    text = f.read(_headerSize - 10).decode('latin1')
+    shape = text[text.index("'shape': (") + 10:]
+    return int(shape[:shape.index(",")])
+
+
+def _appendColumn(path, descr, values):
+    """Append values to a column file, creating it if needed.
+
+    The header is authoritative: anything past the rows it counts (left by
+    an interrupted append) is overwritten.
+    """
+    packed = struct.pack(
+        "<{0}{1}".format(len(values), "q" if descr == '<i8' else "d"),
+        *values)
+    if os.path.exists(path):
+        f = open(path, 'r+b')
+        count = _rowCount(f)
+        f.seek(_headerSize + count * 8)
+        f.truncate()
+    else:
+        f = open(path, 'wb')
+        count = 0
+        f.write(_header(descr, count))
+    f.write(packed)
+    f.flush()
+    f.seek(0)
+    f.write(_header(descr, count + len(values)))
+    f.close()
+
+
+def _truncateColumn(path, count):
+    """Cut a column file back to its first count rows."""
+    descr = dict(columns)[os.path.basename(path)[:-len(".npy")]]
+    f = open(path, 'r+b')
+    f.truncate(_headerSize + count * 8)
+    f.seek(0)
+    f.write(_header(descr, count))
+    f.close()
+
+
+def _columnRows(path):
+    """Rows in a column file, or -1 if it does not exist."""
+    if not os.path.exists(path):
+        return -1
+    f = open(path, 'rb')
+    count = _rowCount(f)
+    f.close()
+    return count
+
+
+def _partitionPath(symbol, day):
+    """Directory holding one symbol's columns for one day."""
+    return "{0}/{1}/{2:%Y-%m-%d}".format(exportDir, symbol, day)
+
+
+class _CopyWriter(object):
+
+    """File-like sink that splits COPY text output into partitions.
+
+    Rows must arrive ordered by symbol and scrape time, so only the current
+    partition is buffered.
+    """
+
+    def __init__(self, journal=None):
+        """Start with no partition open."""
+        self.journal = journal
+        self.pending = u""
+        self.partition = None
+        self.values = None
+        self.rows = 0
+        self.last = {}
+
+    def write(self, data):
+        """Take a chunk of COPY output."""
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        lines = (self.pending + data).split(u"\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._row(line.split(u"\t"))
+
+    def _row(self, fields):
+        """Add one row to the current partition."""
+        micros = int(fields[1])
+        day = (_epoch + timedelta(microseconds=micros)).date()
+        partition = (fields[0], day)
+        if partition != self.partition:
+            self.flush()
+            self.partition = partition
+            self.values = [[] for column in columns]
+        self.values[0].append(micros)
+        self.values[1].append(
+            int(fields[2]) if fields[2] != u"\\N" else nullInteger)
+        for index in range(2, len(columns)):
+            self.values[index].append(
+                float(fields[index + 1]) if fields[index + 1] != u"\\N"
+                else float('nan'))
+        self.rows += 1
+        self.last[fields[0]] = max(self.last.get(fields[0], micros), micros)
+
+    def flush(self):
+        """Append the buffered partition to its column files."""
+        if self.partition is None:
+            return
+        path = _partitionPath(*self.partition)
+        if self.journal is not None:
+            self.journal.record(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for (column, descr), values in zip(columns, self.values):
+            _appendColumn(
+                "{0}/{1}.npy".format(path, column), descr, values)
+        self.partition = None
+        self.values = None
+
+
+def _statePath():
+    """File recording the last exported scrape time of each symbol."""
+    return "{0}/state".format(exportDir)
+
+
+def _readState():
+    """Microseconds of each symbol's last exported scrape time, as a dict."""
+    if not os.path.exists(_statePath()):
+        return {}
+    f = open(_statePath(), 'r')
+    state = json.load(f)
+    f.close()
+    return state
+
+
+def _writeState(state):
+    """Atomically record each symbol's last exported scrape time."""
+    f = open("{0}.tmp".format(_statePath()), 'w')
+    json.dump(state, f, separators=(',', ':'), sort_keys=True)
+    f.close()
+    os.rename("{0}.tmp".format(_statePath()), _statePath())
+
+
+def _journalPath():
+    """File recording what the export in progress has changed."""
+    return "{0}/journal".format(exportDir)
+
+
+class _Journal(object):
+
+    """Row counts of the column files an export appends to.
+
+    The first line holds the state the export started from, and each
+    partition's column counts are written (and synced) before its files
+    are touched. Until the state moves on, the journal is enough to put
+    every file back the way it was.
+    """
+
+    def __init__(self, state):
+        """Start a journal for an export from a state."""
+        self.seen = set()
+        self.f = open(_journalPath(), 'w')
+        self.f.write("{0}\n".format(
+            json.dumps(state, separators=(',', ':'), sort_keys=True)))
+        self._sync()
+
+    def _sync(self):
+        """Make the journal durable."""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def record(self, path):
+        """Note a partition's row counts before its first append."""
+        if path in self.seen:
+            return
+        self.seen.add(path)
+        for column, descr in columns:
+            columnPath = "{0}/{1}.npy".format(path, column)
+            self.f.write("{0}\t{1}\n".format(
+                _columnRows(columnPath), columnPath))
+        self._sync()
+
+    def close(self):
+        """Stop writing (the file stays until it is committed or undone)."""
+        self.f.close()
+
+
+def _rollBack():
+    """Undo an export that did not record its new state.
+
+    Column files are cut back to their journaled row counts and files and
+    partitions it created are removed. If the state did move on, the export
+    finished and only the journal is removed.
+    """
+    if not os.path.exists(_journalPath()):
+        return
+    f = open(_journalPath(), 'r')
+    lines = f.read().split("\n")
+    f.close()
+    if json.loads(lines[0]) == _readState():
+        for line in reversed(lines[1:]):
+            if not line:
+                continue
+            count, path = line.split("\t", 1)
+            if int(count) >= 0:
+                _truncateColumn(path, int(count))
+            elif os.path.exists(path):
+                os.remove(path)
+            for directory in (os.path.dirname(path),
+                              os.path.dirname(os.path.dirname(path))):
+                if os.path.isdir(directory) and not os.listdir(directory):
+                    os.rmdir(directory)
+        logger.warning("Rolled back an interrupted export.")
+    os.remove(_journalPath())
+
+
+def export(full=False):
+    """Export network status history newer than the last export.
+
+    Each symbol's rows after its last exported one are exported, so rows
+    stored late (by a replay or a spool flush) follow once their symbol's
+    earlier rows are out; rows stored before a symbol's last exported row
+    need a full export. History is streamed out of Postgres with COPY, so
+    memory use is bounded by one symbol-day. A full export discards earlier
+    files first. Appends are journaled, and an export that fails (or was
+    interrupted last time) is rolled back, so partitions never get ahead of
+    the recorded state.
+    """
+    if full and os.path.isdir(exportDir):
+        shutil.rmtree(exportDir)
+    if not os.path.isdir(exportDir):
+        os.makedirs(exportDir)
+    _rollBack()
+    state = _readState()
+    symbols = sorted(state)
+    cursor = pg.cursor()
+    rows = cursor.mogrify(_newRowsQuery.format(
+        "symbol, scrape_time, current_blocks, difficulty, reward, "
+        "hash_rate, avg_hash_rate", pg.tables['network_status']), {
+            'symbols': symbols,
+            'through': [_epoch + timedelta(microseconds=state[symbol])
+                        for symbol in symbols],
+            'newest': _epoch + timedelta(
+                microseconds=max(state.values())) if state else None
+        }).decode('utf-8')
+    journal = _Journal(state)
+    writer = _CopyWriter(journal)
+    try:
+        cursor.copy_expert("""COPY (
+            SELECT symbol,
+                (extract(epoch FROM scrape_time) * 1000000)::bigint,
+                current_blocks, difficulty::float8, reward::float8,
+                hash_rate::float8, avg_hash_rate::float8
+            FROM ({0}) ns
+            ORDER BY symbol, scrape_time) TO STDOUT""".format(rows), writer)
+        cursor.connection.commit()
+        writer.flush()
+    except Exception:
+        cursor.connection.rollback()
+        journal.close()
+        _rollBack()
+        raise
+    journal.close()
+    if writer.last:
+        state.update(writer.last)
+        _writeState(state)
+    os.remove(_journalPath())
+    logger.info("Exported {0} rows.".format(writer.rows))
+    return writer.rows
+
+
+def iterPartitions(symbol=None, start=None, end=None):
+    """Iterate over (symbol, day, path) for exported partitions.
+
+    start and end are dates; partitions with start <= day < end are
+    returned, ordered by symbol and day.
+    """
+    if not os.path.isdir(exportDir):
+        return
+    symbols = [symbol] if symbol is not None else sorted(
+        name for name in os.listdir(exportDir)
+        if os.path.isdir(os.path.join(exportDir, name)))
+    for name in symbols:
+        symbolDir = os.path.join(exportDir, name)
+        if not os.path.isdir(symbolDir):
+            continue
+        for dayName in sorted(os.listdir(symbolDir)):
+            day = datetime.strptime(dayName, "%Y-%m-%d").date()
+            if (start is None or day >= start) and \
+                    (end is None or day < end):
+                yield name, day, os.path.join(symbolDir, dayName)
+
+
+def openPartition(path):
+    """Memory-map a partition's columns as read-only NumPy arrays."""
+    if numpy is None:
+        raise Exception("Reading exports requires numpy.")
+    data = {}
+    for column, descr in columns:
+        data[column] = numpy.load(
+            "{0}/{1}.npy".format(path, column), mmap_mode='r')
+    data['scrape_time'] = data['scrape_time'].view('datetime64[us]')
+    return data
+
+
+def toArrow(data):
+    """Wrap memory-mapped partition columns in an Arrow table."""
+    if pyarrow is None:
+        raise Exception("Arrow tables require pyarrow.")
+    names = [column for column, descr in columns]
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(data[name]) for name in names], names=names)
+
+
+def main(argv=None):
+    """Export history from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--full", action="store_true",
+        help="discard earlier exports and export everything")
+    args = parser.parse_args(argv)
+    export(full=args.full)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    main(sys.argv[1:])
@@ -0,0 +1,264 @@
+""" Module for timing scrape stages and exporting scrape metrics. """
+import contextlib
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+import traceback
+
+# Configuration variables
+metricsDir = "{0}/data/metrics".format(
+    os.path.dirname(os.path.abspath(__file__)))
+# Write a Prometheus text file (for node_exporter's textfile collector) and
+# append one JSON line per scrape after every scrape
+writeTextfile = True
+writeJson = True
+# Capture a cProfile of every scrape into metricsDir
+profile = False
+prefix = "coinchoose"
+
+# Metric descriptions, by name
+descriptions = {
+    "stage_seconds_total": ("counter", "Seconds spent in each stage."),
+    "stage_runs_total": ("counter", "Times each stage has run."),
+    "scrapes_total": ("counter", "Scrapes by result."),
+    "pipeline_wait_seconds_total": (
+        "counter", "Seconds pipeline stages waited for the next stage."),
+    "scrapes_unchanged_total": (
+        "counter", "Scrapes whose payloads matched the previous scrape."),
+    "rows_received_total": ("counter", "Rows parsed from API payloads."),
+    "rows_changed_total": (
+        "counter", "Rows that differed from the latest stored values."),
+    "rows_inserted_total": ("counter", "Rows added to history tables."),
+    "anomalies_total": (
+        "counter", "Anomaly events raised on ingest, by kind."),
+    "http_responses_total": ("counter", "HTTP responses by status code."),
+    "http_errors_total": (
+        "counter", "HTTP requests that failed without a response."),
+    "http_response_bytes_total": ("counter", "Bytes of HTTP responses."),
+    "request_sleep_seconds_total": (
+        "counter", "Seconds slept before requests, by reason."),
+    "startup_seconds": (
+        "gauge", "Seconds from process start until the CLI ran a command."),
+    "last_scrape_timestamp_seconds": (
+        "gauge", "Unix time the last scrape finished."),
+    "last_scrape_duration_seconds": ("gauge", "Duration of the last scrape."),
+    "last_scrape_success": ("gauge", "Whether the last scrape succeeded."),
+    "last_scrape_stage_seconds": (
+        "gauge", "Seconds spent in each stage of the last scrape.")
+}
+
+# Cumulative counters and current gauges, keyed by (name, labels)
+counters = {}
+gauges = {}
+
+# State of the scrape in progress. A thread working on a particular scrape
+# (as in the pipelined runner) attaches it to itself; other threads count
+# towards the scrape started last.
+_lock = threading.Lock()
+_writeLock = threading.Lock()
+_local = threading.local()
+_scrape = None
+_profiler = None
+
+
+def _key(name, labels):
+    """Key a sample by its name and sorted labels."""
+    return (name, tuple(sorted(labels.items())))
+
+
+def _sampleName(key, withPrefix=False):
+    """Render a sample key as name{label="value",...}."""
+    name, labels = key
+    if withPrefix:
+        name = "{0}_{1}".format(prefix, name)
+    if not labels:
+        return name
+    return "{0}{{{1}}}".format(name, ",".join(
+        '{0}="{1}"'.format(label, "{0}".format(value).replace(
+            "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels))
+
+
+def _current():
+    """The scrape this thread's measurements belong to, if any."""
+    return getattr(_local, 'scrape', None) or _scrape
+
+
+def attach(scrape):
+    """Count this thread's measurements towards a scrape (None detaches)."""
+    _local.scrape = scrape
+
+
+def increment(name, value=1, **labels):
+    """Add to a counter, and to the scrape in progress if there is one."""
+    key = _key(name, labels)
+    scrape = _current()
+    with _lock:
+        counters[key] = counters.get(key, 0) + value
+        if scrape is not None:
+            sample = _sampleName(key)
+            scrape['counts'][sample] = \
+                scrape['counts'].get(sample, 0) + value
+
+
+def setGauge(name, value, **labels):
+    """Set a gauge."""
+    with _lock:
+        gauges[_key(name, labels)] = value
+
+
+def observe(stage, seconds):
+    """Record time spent in a stage."""
+    secondsKey = _key("stage_seconds_total", {'stage': stage})
+    runsKey = _key("stage_runs_total", {'stage': stage})
+    scrape = _current()
+    with _lock:
+        counters[secondsKey] = counters.get(secondsKey, 0) + seconds
+        counters[runsKey] = counters.get(runsKey, 0) + 1
+        if scrape is not None:
+            scrape['stages'][stage] = \
+                scrape['stages'].get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def timer(stage):
+    """Time the enclosed block as a stage."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(stage, time.time() - start)
+
+
+def startScrape():
+    """Start collecting a per-scrape record (and profile), returning it.
+
+    The new scrape is attached to the calling thread.
+    """
+    global _scrape
+    global _profiler
+    scrape = {'started': time.time(), 'stages': {}, 'counts': {}}
+    with _lock:
+        _scrape = scrape
+    attach(scrape)
+    if profile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    return scrape
+
+
+def finishScrape(success=True, scrape=None):
+    """Finish a scrape (by default this thread's) and export its metrics.
+
+    Returns the per-scrape record that was appended to the JSON log.
+    """
+    global _scrape
+    global _profiler
+    finished = time.time()
+    scrape = scrape if scrape is not None else _current()
+    with _lock:
+        if _scrape is scrape:
+            _scrape = None
+    if getattr(_local, 'scrape', None) is scrape:
+        attach(None)
+    if scrape is None:
+        return None
+    increment("scrapes_total", result="success" if success else "failure")
+    setGauge("last_scrape_timestamp_seconds", finished)
+    setGauge("last_scrape_duration_seconds", finished - scrape['started'])
+    setGauge("last_scrape_success", 1 if success else 0)
+    with _lock:
+        for key in [key for key in gauges
+                    if key[0] == "last_scrape_stage_seconds"]:
+            del gauges[key]
+    for stage, seconds in scrape['stages'].items():
+        setGauge("last_scrape_stage_seconds", seconds, stage=stage)
+    record = {
+        'started': datetime.utcfromtimestamp(scrape['started']).strftime(
+            "%Y-%m-%dT%H:%M:%S.%fZ"),
+        'seconds': finished - scrape['started'],
+        'success': success,
+        'stages': scrape['stages'],
+        'counts': scrape['counts']
+    }
+    if _profiler is not None:
+        _profiler.disable()
+        if not os.path.isdir(metricsDir):
+            os.makedirs(metricsDir)
+        record['profile'] = "{0}/scrape_{1}.prof".format(
+            metricsDir, int(scrape['started']))
+        _profiler.dump_stats(record['profile'])
+        _profiler = None
+    # Failing to export must not fail the scrape
+    try:
+        with _writeLock:
+            if writeTextfile:
+                writePrometheus()
+            if writeJson:
+                _appendJson(record)
+    except Exception:
+        logging.error("Could not export metrics:\n{0}".format(
+            traceback.format_exc()))
+    return record
+
+
+def prometheusText():
+    """Render all counters and gauges in Prometheus text format."""
+    with _lock:
+        samples = list(counters.items()) + list(gauges.items())
+    lines = []
+    typed = set()
+    for key, value in sorted(samples):
+        name = key[0]
+        if name not in typed:
+            kind, description = descriptions.get(name, ("untyped", name))
+            lines.append("# HELP {0}_{1} {2}".format(
+                prefix, name, description))
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, kind))
+            typed.add(name)
+        lines.append("{0} {1}".format(
+            _sampleName(key, withPrefix=True), repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+
+def textfilePath():
+    """Path of the Prometheus text file."""
+    return "{0}/{1}.prom".format(metricsDir, prefix)
+
+
+def jsonPath():
+    """Path of the per-scrape JSON log."""
+    return "{0}/scrapes.jsonl".format(metricsDir)
+
+
+def writePrometheus():
+    """Atomically replace the Prometheus text file."""
+    if not os.path.isdir(metricsDir):
+        os.makedirs(metricsDir)
+    f = open("{0}.tmp".format(textfilePath()), 'w')
+    f.write(prometheusText())
+    f.close()
+    os.rename("{0}.tmp".format(textfilePath()), textfilePath())
+
+
+def _appendJson(record):
+    """Append a per-scrape record to the JSON log."""
+    if not os.path.isdir(metricsDir):
+        os.makedirs(metricsDir)
+    f = open(jsonPath(), 'a')
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.close()
+
+
+def reset():
+    """Forget all counters and gauges."""
+    global _scrape
+    with _lock:
+        counters.clear()
+        gauges.clear()
+        _scrape = None
+    attach(None)
@@ -1,52 +1,422 @@
 """Module for storing coinchoose data in the database."""
-import coinchoose
+import contextlib
 from datetime import datetime
-from datetime import timedelta
-from decimal import Decimal
+import functools
+import hashlib
+import io
+import logging
+import metrics
 import os
-import psycopg2 as pg2
-import psycopg2.extras as pg2ext
-import random
-import unittest
+import re
+import threading
+import time
+import traceback
 
 # Configuration variables
 batchLimit = 1000
+# How staging tables are filled: "copy" streams rows through COPY FROM STDIN
+# in chunks of batchLimit rows, "insert" issues one INSERT per row
+loadMode = "copy"
+# Skip rows whose values match what was last committed for their symbol
+useChangeCache = True
+# When network status is partitioned by month, keep this many partitions
+# created ahead of the current month
+partitionsAhead = 1
+# Months of network status partitions to keep (None keeps everything);
+# older partitions are detached, and also dropped unless retentionDetachOnly
+retentionMonths = None
+retentionDetachOnly = True
+# Keep the hourly and daily network status rollups up to date on insert
+maintainRollups = False
+# Run the recurring merge statements as server-side prepared statements
+usePreparedStatements = True
 tables = {
     "currency": "currency",
     "currency_historical": "currency_historical",
     "network_status": "network_status",
-    "network_status_latest": "network_status_latest"
+    "network_status_latest": "network_status_latest",
+    "network_status_hourly": "network_status_hourly",
+    "network_status_daily": "network_status_daily"
 }
 
-# Pull in postgres configuration information
-# Pull in postgres configuration information
-dbcFile = open(
-    "{0}/.pgpass".format(os.path.dirname(os.path.abspath(__file__))),
-    'r')
-dbcRaw = dbcFile.readline().strip().split(':')
-dbcParams = {
-    'database': dbcRaw[2],
-    'user': dbcRaw[3],
-    'password': dbcRaw[4],
-    'host': dbcRaw[0],
-    'port': dbcRaw[1]
+# Connection settings, taken from the first of: dsn, the COINCHOOSE_DSN
+# environment variable, the .pgpass file next to this module, and finally
+# the standard libpq environment variables (PGHOST, PGDATABASE, ...)
+dsn = None
+pgpassFile = "{0}/.pgpass".format(os.path.dirname(os.path.abspath(__file__)))
+dbcParams = None
+
+# Connection pool: at most poolSize connections, waiting up to poolTimeout
+# seconds for a free one. Connections idle for more than healthCheckInterval
+# seconds are checked before reuse, and transactions that lose their
+# connection are retried up to maxRetries times on a fresh one.
+poolSize = 4
+poolTimeout = 30
+healthCheckInterval = 30
+maxRetries = 3
+
+# Staging columns
+currencyColumns = ('symbol', 'name', 'algo')
+networkStatusColumns = (
+    'scrape_time', 'symbol', 'current_blocks', 'difficulty',
+    'reward', 'hash_rate', 'avg_hash_rate')
+networkStatusValueColumns = (
+    'current_blocks', 'difficulty', 'reward', 'hash_rate', 'avg_hash_rate')
+
+# Recurring merge statements, keyed by name. Table names are filled in from
+# tables (and the staging table of each) the first time a statement is used
+# with a given tables map.
+statements = {
+    "verify_currency": """
+        SELECT v.symbol
+        FROM unnest(
+            %(symbols)s::varchar[],
+            %(names)s::varchar[],
+            %(algos)s::varchar[]) AS v (symbol, name, algo)
+        JOIN {currency} tgt ON
+            tgt.symbol = v.symbol AND
+            tgt.name = v.name AND
+            tgt.algo = v.algo""",
+    "verify_currency_history": """
+        SELECT v.symbol
+        FROM unnest(
+            %(symbols)s::varchar[],
+            %(names)s::varchar[],
+            %(algos)s::varchar[]) AS v (symbol, name, algo)
+        JOIN {currency} tgt ON
+            tgt.symbol = v.symbol AND
+            tgt.name = v.name AND
+            tgt.algo = v.algo
+        JOIN {currency_historical} hst ON
+            hst.symbol = v.symbol AND
+            hst.name = v.name AND
+            hst.algo = v.algo""",
+    "merge_currency": """
+        INSERT INTO {currency} (
+            symbol, name, algo, db_update_time)
+        (SELECT DISTINCT ON (symbol) symbol, name, algo, db_update_time
+        FROM {currency}_staging
+        ORDER BY symbol, ctid DESC)
+        ON CONFLICT (symbol) DO UPDATE
+        SET name = EXCLUDED.name, algo = EXCLUDED.algo,
+            db_update_time = EXCLUDED.db_update_time
+        WHERE {currency}.name <> EXCLUDED.name OR
+            {currency}.algo <> EXCLUDED.algo""",
+    "merge_currency_historical": """
+        INSERT INTO {currency_historical} (
+            symbol, name, algo, db_update_time)
+        (SELECT symbol, name, algo, db_update_time
+        FROM {currency}_staging)
+        ON CONFLICT (symbol, name, algo) DO NOTHING""",
+    "touch_network_status_latest": """
+        WITH matched AS (
+            SELECT lt.symbol, v.scrape_time
+            FROM {network_status_latest} lt
+            JOIN unnest(
+                %(symbol)s::varchar[],
+                %(scrape_time)s::timestamp[],
+                %(current_blocks)s::bigint[],
+                %(difficulty)s::numeric[],
+                %(reward)s::numeric[],
+                %(hash_rate)s::numeric[],
+                %(avg_hash_rate)s::numeric[]) AS v (
+                    symbol, scrape_time, current_blocks, difficulty,
+                    reward, hash_rate, avg_hash_rate)
+            ON lt.symbol = v.symbol
+            AND lt.current_blocks = v.current_blocks
+            AND lt.difficulty = v.difficulty
+            AND lt.reward = v.reward
+            AND lt.hash_rate = v.hash_rate
+            AND lt.avg_hash_rate = v.avg_hash_rate),
+        touched AS (
+            UPDATE {network_status_latest} lt
+            SET scrape_time = matched.scrape_time,
+                db_update_time = current_timestamp
+            FROM matched
+            WHERE lt.symbol = matched.symbol
+            AND lt.scrape_time <> matched.scrape_time)
+        SELECT symbol FROM matched""",
+    "touch_all_network_status_latest": """
+        UPDATE {network_status_latest}
+        SET scrape_time = %(scrape_time)s,
+            db_update_time = current_timestamp
+        WHERE scrape_time < %(scrape_time)s
+        RETURNING symbol""",
+    "merge_network_status": """
+        INSERT INTO {network_status}
+            (scrape_time, symbol, current_blocks, difficulty,
+            reward, hash_rate, avg_hash_rate, db_update_time)
+        (SELECT stg.*
+        FROM {network_status}_staging stg
+        LEFT JOIN {network_status_latest} lt
+            ON lt.symbol = stg.symbol
+            AND lt.current_blocks = stg.current_blocks
+            AND lt.difficulty = stg.difficulty
+            AND lt.reward = stg.reward
+            AND lt.hash_rate = stg.hash_rate
+            AND lt.avg_hash_rate = stg.avg_hash_rate
+        WHERE lt.scrape_time IS NULL)""",
+    "upsert_network_status_latest": """
+        INSERT INTO {network_status_latest}
+            (scrape_time, symbol, current_blocks, difficulty,
+            reward, hash_rate, avg_hash_rate, db_update_time)
+        (SELECT DISTINCT ON (symbol) scrape_time, symbol, current_blocks,
+            difficulty, reward, hash_rate, avg_hash_rate, db_update_time
+        FROM {network_status}_staging
+        ORDER BY symbol, scrape_time DESC, ctid DESC)
+        ON CONFLICT (symbol) DO UPDATE
+        SET scrape_time = EXCLUDED.scrape_time,
+            current_blocks = EXCLUDED.current_blocks,
+            difficulty = EXCLUDED.difficulty,
+            reward = EXCLUDED.reward,
+            hash_rate = EXCLUDED.hash_rate,
+            avg_hash_rate = EXCLUDED.avg_hash_rate,
+            db_update_time = EXCLUDED.db_update_time
+        WHERE ({network_status_latest}.current_blocks,
+            {network_status_latest}.difficulty,
+            {network_status_latest}.reward,
+            {network_status_latest}.hash_rate,
+            {network_status_latest}.avg_hash_rate)
+        IS DISTINCT FROM (EXCLUDED.current_blocks, EXCLUDED.difficulty,
+            EXCLUDED.reward, EXCLUDED.hash_rate, EXCLUDED.avg_hash_rate)
+        RETURNING symbol""",
+    "touch_staged_network_status_latest": """
+        UPDATE {network_status_latest} lt
+        SET scrape_time = stg.scrape_time,
+            db_update_time = current_timestamp
+        FROM (SELECT DISTINCT ON (symbol) symbol, scrape_time
+            FROM {network_status}_staging
+            ORDER BY symbol, scrape_time DESC, ctid DESC) stg
+        WHERE lt.symbol = stg.symbol
+        AND lt.scrape_time <> stg.scrape_time""",
+    "delete_vanished_network_status_latest": """
+        DELETE FROM {network_status_latest}
+        WHERE NOT (symbol = ANY(%(symbols)s::varchar[]))
+        RETURNING symbol"""
 }
-dbcFile.close()
 
-# Connection variable
-conn = None
+# Functions called after a commit changes stored rows, as
+# listener(table key, symbols, seen). symbols is the set of symbols whose
+# rows changed, were added or were removed (None when any may have), and
+# seen maps symbols to the scrape time now recorded for them in the latest
+# network status table.
+listeners = []
 
+# Change detection cache, keyed by symbol, warmed lazily from the database
+fingerprints = {
+    "currency": None,
+    "network_status": None
+}
+cacheStats = {
+    "hits": 0,
+    "misses": 0,
+    "stale": 0
+}
 
-def connect():
-    """Connect to the database."""
-    global conn
-    if conn is not None:
-        return conn
+# Partitioning state, filled in as tables and partitions are seen
+_partitioned = {}
+_partitions = set()
+
+# Prepared statement state: statements resolved against a tables map, and
+# the names prepared on each open connection (keyed by id of the connection)
+_resolved = {}
+_prepared = {}
+
+# psycopg2 and psycopg2.extras, imported by _driver when first needed so
+# that importing this module stays cheap
+pg2 = None
+pg2ext = None
+
+# Pool state
+_pool = []
+_poolOpen = 0
+_poolLock = threading.Condition()
+_local = threading.local()
+poolStats = {
+    "created": 0,
+    "reused": 0,
+    "health_checks": 0,
+    "discarded": 0,
+    "waits": 0,
+    "retries": 0
+}
+
+
+def _driver():
+    """Import psycopg2 (once) and return it."""
+    global pg2
+    global pg2ext
+    if pg2 is None:
+        import psycopg2
+        import psycopg2.extras
+        pg2ext = psycopg2.extras
+        pg2 = psycopg2
+    return pg2
+
+
+def connectionParams():
+    """Load the connection settings (once)."""
+    global dbcParams
+    if dbcParams is not None:
+        return dbcParams
+    if dsn is not None:
+        dbcParams = {'dsn': dsn}
+    elif os.environ.get("COINCHOOSE_DSN"):
+        dbcParams = {'dsn': os.environ["COINCHOOSE_DSN"]}
+    elif os.path.exists(pgpassFile):
+        dbcFile = open(pgpassFile, 'r')
+        dbcRaw = dbcFile.readline().strip().split(':')
+        dbcFile.close()
+        dbcParams = {
+            'database': dbcRaw[2],
+            'user': dbcRaw[3],
+            'password': dbcRaw[4],
+            'host': dbcRaw[0],
+            'port': dbcRaw[1]
+        }
     else:
-        conn = pg2.connect(**dbcParams)
+        dbcParams = {'dsn': ""}
+    return dbcParams
+
+
+def _healthy(conn):
+    """Check that an idle connection still works."""
+    poolStats['health_checks'] += 1
+    try:
+        cur = conn.cursor()
+        cur.execute("""SELECT 1""")
+        conn.rollback()
+        return True
+    except pg2.Error:
+        return False
+
+
+def _discard(conn):
+    """Close a connection and give up its pool slot."""
+    global _poolOpen
+    try:
+        if not conn.closed:
+            conn.close()
+    except pg2.Error:
+        pass
+    _prepared.pop(id(conn), None)
+    with _poolLock:
+        _poolOpen -= 1
+        poolStats['discarded'] += 1
+        _poolLock.notify()
+
+
+def _checkout():
+    """Take a working connection from the pool, opening one if allowed."""
+    global _poolOpen
+    while True:
+        with _poolLock:
+            deadline = time.time() + poolTimeout
+            while not _pool and _poolOpen >= poolSize:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for a connection.")
+                poolStats['waits'] += 1
+                _poolLock.wait(remaining)
+            if _pool:
+                conn, lastUsed = _pool.pop()
+            else:
+                conn, lastUsed = None, None
+                _poolOpen += 1
+        if conn is None:
+            try:
+                conn = _driver().connect(**connectionParams())
+            except Exception:
+                with _poolLock:
+                    _poolOpen -= 1
+                    _poolLock.notify()
+                raise
+            poolStats['created'] += 1
+            _prepared[id(conn)] = set()
+            return conn
+        if conn.closed or (
+                time.time() - lastUsed > healthCheckInterval and
+                not _healthy(conn)):
+            _discard(conn)
+            continue
+        poolStats['reused'] += 1
         return conn
 
 
+def _checkin(conn):
+    """Return a connection to the pool, discarding it if it is broken."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+        except pg2.Error:
+            pass
+    if conn.closed:
+        _discard(conn)
+        return
+    with _poolLock:
+        _pool.append((conn, time.time()))
+        _poolLock.notify()
+
+
+def poolStatistics():
+    """Get pool counters along with current usage."""
+    with _poolLock:
+        stats = dict(poolStats)
+        stats['open'] = _poolOpen
+        stats['idle'] = len(_pool)
+        stats['in_use'] = _poolOpen - len(_pool)
+    return stats
+
+
+def closePool():
+    """Close every idle connection in the pool."""
+    global _poolOpen
+    with _poolLock:
+        idle = [conn for conn, lastUsed in _pool]
+        del _pool[:]
+        _poolOpen -= len(idle)
+    for conn in idle:
+        _prepared.pop(id(conn), None)
+        if not conn.closed:
+            conn.close()
+
+
+def connect():
+    """Get this thread's database connection from the pool."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or conn.closed:
+        if conn is not None:
+            _discard(conn)
+        conn = _checkout()
+        _local.conn = conn
+    return conn
+
+
+def disconnect():
+    """Give this thread's database connection back to the pool."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        _checkin(conn)
+
+
+@contextlib.contextmanager
+def session():
+    """Hold this thread's connection for one unit of work.
+
+    The connection goes back to the pool when the block ends, unless the
+    thread already held one when it started (a writer keeping its
+    connection, or an enclosing session). Readers serving many threads use
+    this so they need no more connections than are busy at once.
+    """
+    held = getattr(_local, 'conn', None) is not None
+    try:
+        yield
+    finally:
+        if not held:
+            disconnect()
+
+
 def cursor():
     """"Pull a cursor from the connection."""
     return connect().cursor()
@@ -57,391 +427,650 @@ def dictCursor():
     return connect().cursor(cursor_factory=pg2ext.RealDictCursor)
 
 
-def _createStaging(tableName, cursor):
-    """Create staging table."""
-    stagingTable = "{0}_{1}".format(
-        tableName, str(int(pow(10, random.random()*10))).zfill(10))
-    cursor.execute("""CREATE TABLE {0} (LIKE {1}
-        INCLUDING DEFAULTS)""".format(stagingTable, tableName))
+def _connectionLost(error):
+    """Whether an error means this thread's connection has gone away."""
+    conn = getattr(_local, 'conn', None)
+    return (conn is not None and conn.closed) or \
+        getattr(error, 'pgcode', None) is None
+
+
+def transactional(function):
+    """Roll back on failure and retry if the connection was lost.
+
+    The wrapped function must run (and commit) a whole transaction on this
+    thread's connection, and must be safe to run again from the start.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        for attempt in range(maxRetries + 1):
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                conn = getattr(_local, 'conn', None)
+                lost = pg2 is not None and isinstance(
+                    e, (pg2.OperationalError, pg2.InterfaceError)) and \
+                    _connectionLost(e)
+                if not lost:
+                    if conn is not None and not conn.closed:
+                        conn.rollback()
+                    if getattr(e, 'pgcode', None) == '26000':
+                        # A prepared statement went missing; prepare
+                        # everything again next time
+                        _prepared.pop(id(conn), None)
+                    raise
+                _local.conn = None
+                if conn is not None:
+                    _discard(conn)
+                if attempt == maxRetries:
+                    raise
+                poolStats['retries'] += 1
+                logging.warning(
+                    "Lost database connection ({0}). Retrying...".format(e))
+                time.sleep(min(pow(2, attempt) * 0.1, 2))
+    return wrapper
+
+
+def _resolve(name):
+    """Fill in a statement's tables and convert it for PREPARE.
+
+    Returns the plain SQL, the name it is prepared under, the SQL with
+    positional parameters, and the parameter names in position order. The
+    prepared name includes a hash of the SQL, so a remapped tables map gets
+    statements of its own.
+    """
+    key = (name, tuple(sorted(tables.items())))
+    if key not in _resolved:
+        sql = statements[name].format(**tables)
+        params = []
+
+        def positional(match):
+            if match.group(1) not in params:
+                params.append(match.group(1))
+            return "${0}".format(params.index(match.group(1)) + 1)
+        preparedSql = re.sub(r"%\((\w+)\)s", positional, sql)
+        preparedName = "{0}_{1}".format(
+            name, hashlib.md5(sql.encode('utf-8')).hexdigest()[:12])
+        _resolved[key] = (sql, preparedName, preparedSql, params)
+    return _resolved[key]
+
+
+def _execute(name, params, cursor):
+    """Run one of the merge statements.
+
+    The statement is prepared the first time it is used on a connection and
+    executed by name after that.
+    """
+    with metrics.timer("sql:{0}".format(name)):
+        _executeStatement(name, params, cursor)
+
+
+def _executeStatement(name, params, cursor):
+    """Run a merge statement, preparing it first if needed."""
+    sql, preparedName, preparedSql, paramNames = _resolve(name)
+    if not usePreparedStatements:
+        cursor.execute(sql, params)
+        return
+    prepared = _prepared.setdefault(id(cursor.connection), set())
+    if preparedName not in prepared:
+        cursor.execute("""PREPARE {0} AS {1}""".format(
+            preparedName, preparedSql))
+        prepared.add(preparedName)
+    if paramNames:
+        cursor.execute("""EXECUTE {0} ({1})""".format(
+            preparedName, ", ".join(["%s"] * len(paramNames))),
+            [params[param] for param in paramNames])
+    else:
+        cursor.execute("""EXECUTE {0}""".format(preparedName))
+
+
+def _staging(tableName, cursor):
+    """Get the session's temporary staging table for a table.
+
+    The table is created once per session and emptied on every commit, so
+    repeated merges do not create or drop any catalog entries.
+    """
+    stagingTable = "{0}_staging".format(tableName)
+    cursor.execute("""CREATE TEMP TABLE IF NOT EXISTS {0} (LIKE {1}
+        INCLUDING DEFAULTS) ON COMMIT DELETE ROWS""".format(
+        stagingTable, tableName))
     return stagingTable
 
 
-def _dropStaging(tableName, cursor):
-    """Drop staging table."""
+def _copyValue(value):
+    """Render a value in COPY text format."""
+    if value is None:
+        return u"\\N"
+    if isinstance(value, float):
+        # str() of a Python 2 float keeps only 12 significant digits
+        value = repr(value)
+    return u"{0}".format(value).replace(
+        u"\\", u"\\\\").replace(
+        u"\t", u"\\t").replace(
+        u"\n", u"\\n").replace(
+        u"\r", u"\\r")
+
+
+def _copyBuffer(stagingTable, columns, buf, cursor):
+    """Send a buffer of COPY text rows to the staging table."""
+    buf.seek(0)
+    cursor.copy_from(buf, stagingTable, columns=columns)
+
+
+def _copyRows(stagingTable, columns, data, cursor):
+    """Stream rows into the staging table with COPY, batchLimit at a time.
+
+    Column-wise batches (see coinchoose.NetworkStatusBatch) are read column
+    by column instead of building a dict per row.
+    """
+    buf = io.StringIO()
+    count = 0
+    if hasattr(data, 'iterValues'):
+        rows = data.iterValues(columns)
+    else:
+        rows = (tuple(datum[column] for column in columns) for datum in data)
+    for values in rows:
+        buf.write(u"\t".join(_copyValue(value) for value in values))
+        buf.write(u"\n")
+        count += 1
+        if count % batchLimit == 0:
+            _copyBuffer(stagingTable, columns, buf, cursor)
+            buf = io.StringIO()
+    if count % batchLimit != 0:
+        _copyBuffer(stagingTable, columns, buf, cursor)
+    return count
+
+
+def _insertRows(stagingTable, columns, data, cursor):
+    """Insert rows into the staging table one statement at a time."""
+    cursor.executemany("""
+        INSERT INTO {0} ({1})
+        VALUES ({2})""".format(
+        stagingTable,
+        ", ".join(columns),
+        ", ".join("%({0})s".format(column) for column in columns)), data)
+
+
+def _loadStaging(stagingTable, columns, data, cursor):
+    """Move data into a staging table using the configured load mode."""
+    with metrics.timer("sql:load_staging"):
+        if loadMode == "copy":
+            _copyRows(stagingTable, columns, data, cursor)
+        elif loadMode == "insert":
+            _insertRows(stagingTable, columns, data, cursor)
+        else:
+            raise Exception("Unknown load mode {0}.".format(loadMode))
+
+
+def _monthStart(value):
+    """First instant of the month containing a time."""
+    return datetime(value.year, value.month, 1)
+
+
+def _addMonths(month, count):
+    """Move the start of a month forward (or back) by a number of months."""
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partitionName(tableName, month):
+    """Name of the monthly partition of a table."""
+    return "{0}_p{1:04d}{2:02d}".format(tableName, month.year, month.month)
+
+
+def _isPartitioned(tableName, cursor):
+    """Check (once) whether a table is partitioned."""
+    if tableName not in _partitioned:
+        cursor.execute("""
+            SELECT EXISTS (
+                SELECT 1
+                FROM pg_partitioned_table
+                WHERE partrelid = to_regclass(%s)) AS partitioned""",
+            (tableName,))
+        _partitioned[tableName] = cursor.fetchone()['partitioned']
+    return _partitioned[tableName]
+
+
+def ensurePartitions(scrapeTimes, cursor=None):
+    """Create the monthly network status partitions some rows need.
+
+    Partitions for the current month and the next partitionsAhead months are
+    always ensured. Months already covered by another partition (such as a
+    migrated legacy table) are left alone. Does nothing if network status is
+    not partitioned. Returns the partitions created.
+    """
+    cursor = cursor if cursor is not None else dictCursor()
+    tableName = tables['network_status']
+    if not _isPartitioned(tableName, cursor):
+        return []
+    months = set(_monthStart(scrapeTime) for scrapeTime in scrapeTimes)
+    currentMonth = _monthStart(datetime.utcnow())
+    for count in range(partitionsAhead + 1):
+        months.add(_addMonths(currentMonth, count))
+    created = []
+    for month in sorted(months):
+        partition = _partitionName(tableName, month)
+        if partition in _partitions:
+            continue
+        cursor.execute("""SAVEPOINT ensure_partition""")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS {0}
+                PARTITION OF {1} FOR VALUES
+                FROM ('{2:%Y-%m-%d}') TO ('{3:%Y-%m-%d}')""".format(
+                partition, tableName, month, _addMonths(month, 1)))
+        except pg2.Error:
+            # Another partition already covers this month
+            cursor.execute("""ROLLBACK TO SAVEPOINT ensure_partition""")
+        else:
+            cursor.execute("""RELEASE SAVEPOINT ensure_partition""")
+            created.append(partition)
+        _partitions.add(partition)
+    if created and retentionMonths is not None:
+        applyRetention(cursor=cursor)
+    return created
+
+
+def applyRetention(months=None, detachOnly=None, cursor=None):
+    """Detach (or drop) network status partitions past the retention.
+
+    Only monthly partitions created by ensurePartitions are considered. This
+    runs inside the caller's transaction when given a cursor, otherwise it
+    commits on its own. Returns the partitions removed.
+    """
+    months = months if months is not None else retentionMonths
+    detachOnly = detachOnly if detachOnly is not None \
+        else retentionDetachOnly
+    if months is None:
+        return []
+    ownTransaction = cursor is None
+    cursor = cursor if cursor is not None else dictCursor()
+    tableName = tables['network_status']
+    cutoff = _addMonths(_monthStart(datetime.utcnow()), -months)
     cursor.execute("""
-        DROP TABLE {0}""".format(tableName))
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)""", (tableName,))
+    removed = []
+    for row in cursor.fetchall():
+        partition = row['relname']
+        if not partition.startswith("{0}_p".format(tableName)):
+            continue
+        suffix = partition[len(tableName) + 2:]
+        if len(suffix) != 6 or not suffix.isdigit():
+            continue
+        month = datetime(int(suffix[:4]), int(suffix[4:]), 1)
+        if _addMonths(month, 1) > cutoff:
+            continue
+        cursor.execute("""ALTER TABLE {0}
+            DETACH PARTITION {1}""".format(tableName, partition))
+        if not detachOnly:
+            cursor.execute("""DROP TABLE {0}""".format(partition))
+        _partitions.discard(partition)
+        removed.append(partition)
+    if ownTransaction:
+        cursor.connection.commit()
+    return removed
+
+
+def _currencyFingerprint(datum):
+    """Fingerprint the values of a currency row."""
+    return (datum['name'], datum['algo'])
+
+
+def networkStatusFingerprint(datum):
+    """Fingerprint the values of a network status row."""
+    return tuple(datum[column] for column in networkStatusValueColumns)
+
+
+def _comparable(values):
+    """Network status values as floats, whatever type they arrived as."""
+    return tuple(
+        float(value) if value is not None else None for value in values)
+
+
+def _cachedNetworkStatus(datum):
+    """Fingerprint a network status row for the change detection cache.
+
+    Values are compared as floats, so the floats of an inexact batch match
+    the Decimals read back for them. Values differing only past float
+    precision look alike here, but the database confirms every cache hit
+    with an exact comparison.
+    """
+    return _comparable(networkStatusFingerprint(datum))
+
+
+def warmCache(cursor=None):
+    """Load the change detection cache from the current tables."""
+    cursor = cursor if cursor is not None else dictCursor()
+    cursor.execute("""SELECT symbol, name, algo
+        FROM {0}""".format(tables['currency']))
+    fingerprints['currency'] = dict(
+        (row['symbol'], _currencyFingerprint(row)) for row in cursor)
+    cursor.execute("""SELECT symbol, {0}
+        FROM {1}""".format(
+        ", ".join(networkStatusValueColumns),
+        tables['network_status_latest']))
+    fingerprints['network_status'] = dict(
+        (row['symbol'], _cachedNetworkStatus(row)) for row in cursor)
+
+
+def clearCache():
+    """Forget everything in the change detection cache."""
+    for kind in fingerprints:
+        fingerprints[kind] = None
+
+
+def _isBatch(data):
+    """Whether rows are a column-wise batch (coinchoose.NetworkStatusBatch)."""
+    return hasattr(data, 'iterValues')
+
+
+def _column(data, column):
+    """Get one column of a list of rows or a batch."""
+    if _isBatch(data):
+        return data.column(column)
+    return [datum[column] for datum in data]
+
+
+def _fingerprinted(data, fingerprint):
+    """Iterate over (symbol, fingerprint) for a list of rows or a batch.
+
+    Batches hold network status, so their fingerprints are read straight
+    from the value columns.
+    """
+    if _isBatch(data):
+        return ((values[0], _comparable(values[1:]))
+                for values in data.iterValues(
+                    ('symbol',) + networkStatusValueColumns))
+    return ((datum['symbol'], fingerprint(datum)) for datum in data)
+
 
+def _select(data, indexes):
+    """Get the rows at some positions, as a list or a batch like data."""
+    if _isBatch(data):
+        return data.select(indexes)
+    return [data[index] for index in indexes]
 
+
+def _splitChanged(kind, data, fingerprint, cursor):
+    """Split rows into those that changed and those the cache has seen.
+
+    A batch is split into two batches, so it stays column-wise all the way
+    to the staging table.
+    """
+    if not _isBatch(data):
+        data = list(data)
+    if not useChangeCache:
+        return data, _select(data, [])
+    if fingerprints[kind] is None:
+        warmCache(cursor)
+    known = fingerprints[kind]
+    changed = []
+    unchanged = []
+    for index, (symbol, values) in enumerate(
+            _fingerprinted(data, fingerprint)):
+        if None not in values and known.get(symbol) == values:
+            unchanged.append(index)
+            cacheStats['hits'] += 1
+        else:
+            changed.append(index)
+            cacheStats['misses'] += 1
+    return _select(data, changed), _select(data, unchanged)
+
+
+def _remember(kind, data, fingerprint, replace=False):
+    """Record committed rows in the change detection cache."""
+    if not useChangeCache:
+        return
+    values = dict(_fingerprinted(data, fingerprint))
+    if replace or fingerprints[kind] is None:
+        fingerprints[kind] = values
+    else:
+        fingerprints[kind].update(values)
+
+
+def _notify(tableKey, symbols, seen=None):
+    """Tell listeners about committed changes, logging their failures."""
+    for listener in listeners:
+        try:
+            listener(tableKey, symbols, seen or {})
+        except Exception:
+            logging.error("Change listener failed:\n{0}".format(
+                traceback.format_exc()))
+
+
+def _unverified(unchanged, verified):
+    """Pick out cached rows the database did not confirm and count them."""
+    stale = _select(unchanged, [
+        index for index, symbol in enumerate(_column(unchanged, 'symbol'))
+        if symbol not in verified])
+    cacheStats['stale'] += len(stale)
+    return stale
+
+
+@transactional
 def insertLatestCurrencies(data, withHistory=True):
     """Insert latest currency data."""
     cursor = dictCursor()
     targetTable = tables['currency']
 
-    # Create staging table
-    stagingTable = _createStaging(targetTable, cursor)
+    # Only send currencies the cache has not seen, after confirming the
+    # cached ones really are in the database
+    changed, unchanged = _splitChanged(
+        'currency', data, _currencyFingerprint, cursor)
+    if unchanged:
+        _execute(
+            'verify_currency_history' if withHistory else 'verify_currency', {
+                'symbols': [datum['symbol'] for datum in unchanged],
+                'names': [datum['name'] for datum in unchanged],
+                'algos': [datum['algo'] for datum in unchanged]
+            }, cursor)
+        verified = set(row['symbol'] for row in cursor)
+        changed.extend(_unverified(unchanged, verified))
+    if not changed:
+        cursor.connection.commit()
+        return
+
+    # Get staging table
+    stagingTable = _staging(targetTable, cursor)
 
     # Move data into staging table
-    cursor.executemany("""
-        INSERT INTO {0} (
-            symbol, name, algo)
-        VALUES (
-            %(symbol)s,
-            %(name)s,
-            %(algo)s
-        )""".format(stagingTable), data)
-
-    # Update any altered currencies
-    cursor.execute("""
-        UPDATE {0} tgt
-        SET name = stg.name, algo = stg.algo,
-            db_update_time = stg.db_update_time
-        FROM {1} stg
-        WHERE tgt.symbol = stg.symbol
-        AND (tgt.name <> stg.name OR
-            tgt.algo <> stg.algo)""".format(
-        targetTable, stagingTable))
-
-    # Merge any new currencies into target table
-    cursor.execute("""
-        INSERT INTO {0} (
-            symbol, name, algo, db_update_time)
-        (SELECT stg.*
-        FROM {1} stg
-        LEFT JOIN {0} tgt ON tgt.symbol = stg.symbol
-        WHERE tgt.symbol IS NULL)""".format(
-        targetTable, stagingTable))
+    _loadStaging(stagingTable, currencyColumns, changed, cursor)
+
+    # Merge new and altered currencies into target table
+    _execute('merge_currency', None, cursor)
 
     # If requested, merge data into the historical table
+    inserted = 0
     if withHistory:
-        historicalTable = tables['currency_historical']
-        cursor.execute("""
-            INSERT INTO {0} (
-                symbol, name, algo, db_update_time)
-            (SELECT stg.*
-            FROM {1} stg
-            LEFT JOIN {0} tgt ON
-                tgt.symbol = stg.symbol AND
-                tgt.name = stg.name AND
-                tgt.algo = stg.algo
-            WHERE tgt.symbol IS NULL)""".format(
-            historicalTable, stagingTable))
-
-    # Drop staging table
-    _dropStaging(stagingTable, cursor)
+        _execute('merge_currency_historical', None, cursor)
+        inserted = cursor.rowcount
 
-    # Commit
-    cursor.execute("""COMMIT""")
+    # Commit (this also empties the staging table)
+    cursor.connection.commit()
+    _remember('currency', changed, _currencyFingerprint)
+    _notify('currency', set(datum['symbol'] for datum in changed))
+    metrics.increment("rows_changed_total", len(changed), kind="currency")
+    metrics.increment(
+        "rows_inserted_total", inserted, table="currency_historical")
 
 
+@transactional
 def insertLatestNetworkStatus(data):
-    """Insert latest network status data."""
+    """Insert latest network status data (a list of rows or a batch)."""
     cursor = dictCursor()
     targetTable = tables['network_status']
-    latestTable = tables['network_status_latest']
 
-    # Create staging table
-    stagingTable = _createStaging(targetTable, cursor)
+    # Rows the cache has already seen only need their scrape time moved
+    # forward in the latest table; anything the database does not confirm
+    # goes through the full merge below
+    changed, unchanged = _splitChanged(
+        'network_status', data, _cachedNetworkStatus, cursor)
+    if unchanged:
+        params = dict(
+            (column, _column(unchanged, column))
+            for column in networkStatusColumns)
+        _execute('touch_network_status_latest', params, cursor)
+        verified = set(row['symbol'] for row in cursor)
+        changed.extend(_unverified(unchanged, verified))
+
+    # Get staging table
+    stagingTable = _staging(targetTable, cursor)
 
     # Move data into staging table
-    cursor.executemany("""
-        INSERT INTO {0}
-            (scrape_time, symbol, current_blocks, difficulty,
-            reward, hash_rate, avg_hash_rate)
-        VALUES (
-            %(scrape_time)s,
-            %(symbol)s,
-            %(current_blocks)s,
-            %(difficulty)s,
-            %(reward)s,
-            %(hash_rate)s,
-            %(avg_hash_rate)s
-        )""".format(stagingTable), data)
+    _loadStaging(stagingTable, networkStatusColumns, changed, cursor)
+
+    # Make sure partitions exist for the new data
+    ensurePartitions(set(_column(changed, 'scrape_time')), cursor)
 
     # Update target table where we have new data
+    _execute('merge_network_status', None, cursor)
+    inserted = cursor.rowcount
+
+    # Refresh rollup buckets touched by the new data
+    if maintainRollups:
+        import rollup
+        rollup.refreshFromStaging(stagingTable, cursor)
+
+    # Update changed symbols in the latest table in place and drop the ones
+    # that have left the feed
+    symbols = _column(data, 'symbol')
+    replaced = _replaceLatest(symbols, cursor)
+
+    # Commit (this also empties the staging table)
+    cursor.connection.commit()
+    _remember('network_status', data, _cachedNetworkStatus, replace=True)
+    _notify(
+        'network_status_latest', replaced | set(_column(changed, 'symbol')),
+        dict(zip(symbols, _column(data, 'scrape_time'))))
+    metrics.increment(
+        "rows_changed_total", len(changed), kind="network_status")
+    metrics.increment("rows_inserted_total", inserted, table="network_status")
+
+
+@transactional
+def touchLatestNetworkStatus(scrapeTime):
+    """Record a scrape whose network status matched the previous one.
+
+    This has the same effect as inserting the previous scrape's rows again
+    with a new scrape time: only the latest table's scrape times move.
+    """
+    cursor = dictCursor()
+    _execute(
+        'touch_all_network_status_latest', {'scrape_time': scrapeTime},
+        cursor)
+    touched = [row['symbol'] for row in cursor]
+    cursor.connection.commit()
+    _notify(
+        'network_status_latest', set(),
+        dict((symbol, scrapeTime) for symbol in touched))
+    return len(touched)
+
+
+@transactional
+def fetchLatestNetworkStatus():
+    """Get the rows currently in the latest network status table."""
+    cursor = dictCursor()
+    cursor.execute("""SELECT {0}
+        FROM {1}""".format(
+        ", ".join(networkStatusColumns), tables['network_status_latest']))
+    data = [dict(row) for row in cursor]
+    cursor.connection.commit()
+    return data
+
+
+def _replaceLatest(symbols, cursor):
+    """Upsert staged rows into the latest table and drop vanished symbols.
+
+    Rows are updated in place, and only when a value differs, so changed
+    ones can be HOT updates; rows whose values match only have their scrape
+    time moved, and rows already at the staged scrape time are left alone.
+    A symbol staged more than once takes its newest row. Returns the symbols
+    whose values were written or deleted.
+    """
+    _execute('upsert_network_status_latest', None, cursor)
+    replaced = set(row['symbol'] for row in cursor)
+    _execute('touch_staged_network_status_latest', None, cursor)
+    _execute(
+        'delete_vanished_network_status_latest', {'symbols': symbols},
+        cursor)
+    replaced.update(row['symbol'] for row in cursor)
+    return replaced
+
+
+def _loadHistory(data, latest, cursor):
+    """Add deduplicated history and replace the latest table (no commit)."""
+    targetTable = tables['network_status']
+
+    # Get staging table
+    stagingTable = _staging(targetTable, cursor)
+
+    # Move history into target table
+    _loadStaging(stagingTable, networkStatusColumns, data, cursor)
+    ensurePartitions(set(datum['scrape_time'] for datum in data), cursor)
     cursor.execute("""
         INSERT INTO {0}
             (scrape_time, symbol, current_blocks, difficulty,
             reward, hash_rate, avg_hash_rate, db_update_time)
-        (SELECT stg.*
-        FROM {1} stg
-        LEFT JOIN {2} lt
-            ON lt.symbol = stg.symbol
-            AND lt.current_blocks = stg.current_blocks
-            AND lt.difficulty = stg.difficulty
-            AND lt.reward = stg.reward
-            AND lt.hash_rate = stg.hash_rate
-            AND lt.avg_hash_rate = stg.avg_hash_rate
-        WHERE lt.scrape_time IS NULL)""".format(
-        targetTable, stagingTable, latestTable))
-
-    # Replace data in latest table with new data in staging
-    cursor.execute("""DELETE FROM {0}""".format(latestTable))
-    cursor.execute("""INSERT INTO {0}
-        SELECT *
-        FROM {1}""".format(latestTable, stagingTable))
-
-    # Drop staging table
-    _dropStaging(stagingTable, cursor)
-
-    # Commit
-    cursor.execute("""COMMIT""")
-
-
-class PgTest(unittest.TestCase):
-
-    """Testing suite for pg module."""
-
-    def setUp(self):
-        """Setup tables for test."""
-        # Swap and sub configuration variables
-        global tables
-        self.tablesOriginal = tables
-        tables = {}
-        for key, table in self.tablesOriginal.iteritems():
-            tables[key] = "{0}_test".format(table)
-        global batchLimit
-        self.batchLimitOriginal = batchLimit
-        batchLimit = 20
-
-        # Create test tables
-        cur = cursor()
-        for key, table in tables.iteritems():
-            cur.execute("""CREATE TABLE IF NOT EXISTS
-                {0} (LIKE {1} INCLUDING ALL)""".format(
-                table, self.tablesOriginal[key]))
-        cur.execute("""COMMIT""")
-
-    def tearDown(self):
-        """Teardown test tables."""
-        # Drop test tables
-        global tables
-        cur = cursor()
-        for table in tables.values():
-            cur.execute("""DROP TABLE IF EXISTS
-                {0}""".format(table))
-
-        # Undo swap / sub
-        tables = self.tablesOriginal
-        global batchLimit
-        batchLimit = self.batchLimitOriginal
-
-    def testInsertLatestCurrencies(self):
-        """Test insertLatestCurrencies function."""
-        fileString = "{0}/example/api.json"
-        f = open(fileString.format(
-            os.path.dirname(os.path.abspath(__file__))), 'r')
-        jsonDump = f.read()
-        f.close()
-        data = coinchoose.parseLatestCurrencies(jsonDump)
-        insertLatestCurrencies(data)
-
-        # Test out some basic count statistics
-        cur = dictCursor()
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['currency']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 59)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['currency_historical']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 59)
-
-        # Test out contents of first and last row
-        expectedFirst = {
-            'symbol': 'ALF',
-            'name': 'Alphacoin',
-            'algo': 'scrypt'
-        }
-        cur.execute("""SELECT symbol, name, algo
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['currency'], 'ALF'))
-        datumFirst = cur.fetchone()
-        self.assertEqual(datumFirst, expectedFirst)
-        expectedLast = {
-            'symbol': 'GLC',
-            'name': 'GlobalCoin',
-            'algo': 'scrypt'
-        }
-        cur.execute("""SELECT symbol, name, algo
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['currency'], 'GLC'))
-        datumLast = cur.fetchone()
-        self.assertEqual(datumLast, expectedLast)
-
-        # Update the data in a way that modifies what's in the DB
-        updatedData = [
-            {
-                'symbol': 'ALF',
-                'name': 'XXAlphacoinXX',
-                'algo': 'scrypt'
-            },
-            {
-                'symbol': 'GLC',
-                'name': 'GlobalCoin',
-                'algo': 'SHA-256'
-            }
-        ]
-        insertLatestCurrencies(updatedData)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['currency']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 59)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['currency_historical']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 61)
-        cur.execute("""SELECT symbol, name, algo
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['currency'], 'ALF'))
-        newDatumFirst = cur.fetchone()
-        self.assertEqual(newDatumFirst, updatedData[0])
-        cur.execute("""SELECT symbol, name, algo
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['currency'], 'GLC'))
-        newDatumFirst = cur.fetchone()
-        self.assertEqual(newDatumFirst, updatedData[1])
-
-    def testInsertLatestNetworkStatus(self):
-        """Test insertLatestNetworkStatus function."""
-        fileString = "{0}/example/api.json"
-        f = open(fileString.format(
-            os.path.dirname(os.path.abspath(__file__))), 'r')
-        jsonDump = f.read()
-        f.close()
-        now = datetime.utcnow()
-        data = coinchoose.parseLatestNetworkStatus(jsonDump, scrapeTime=now)
-        insertLatestNetworkStatus(data)
-
-        # Test out some basic count statistics
-        cur = dictCursor()
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['network_status']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 59)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['network_status_latest']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 59)
-
-        # Test out contents of first and last row
-        expectedFirst = {
-            'symbol': 'ALF',
-            'scrape_time': now,
-            'current_blocks': long(655258),
-            'difficulty': Decimal("1.52109832"),
-            'reward': Decimal(50),
-            'hash_rate': long(10308452),
-            'avg_hash_rate': Decimal("10308452.0000")
-        }
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status'], 'ALF'))
-        datumFirst = cur.fetchone()
-        self.assertEqual(datumFirst, expectedFirst)
-        expectedLast = {
-            'symbol': 'GLC',
-            'scrape_time': now,
-            'current_blocks': long(300011),
-            'difficulty': Decimal("0.768"),
-            'reward': Decimal(100),
-            'hash_rate': long(0),
-            'avg_hash_rate': Decimal("0")
-        }
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status'], 'GLC'))
-        datumLast = cur.fetchone()
-        self.assertEqual(datumLast, expectedLast)
-
-        # Update the data in a way that modifies some of  what's in the DB
-        updatedData = [
-            {
-                'symbol': 'ALF',
-                'scrape_time': now + timedelta(days=1),
-                'current_blocks': long(655258),
-                'difficulty': Decimal("1.52109832"),
-                'reward': Decimal(50),
-                'hash_rate': long(10308452),
-                'avg_hash_rate': Decimal("10308452.0000")
-            },
-            {
-                'symbol': 'GLC',
-                'scrape_time': now + timedelta(days=1),
-                'current_blocks': long(300155),
-                'difficulty': Decimal("1.234"),
-                'reward': Decimal(100),
-                'hash_rate': long(20),
-                'avg_hash_rate': Decimal("20.34")
-            }
-        ]
-        insertLatestNetworkStatus(updatedData)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['network_status']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 60)
-        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
-            tables['network_status_latest']))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 2)
-
-        cur.execute("""SELECT COUNT(*) cnt
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status'], 'ALF'))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 1)
-        cur.execute("""SELECT COUNT(*) cnt
-            FROM {0}
-            WHERE symbol ='{1}'""".format(
-            tables['network_status'], 'GLC'))
-        row = cur.fetchone()
-        self.assertEqual(row['cnt'], 2)
-
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status'], 'ALF'))
-        newDatumFirst = cur.fetchone()
-        self.assertEqual(newDatumFirst, expectedFirst)
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'
-            ORDER BY scrape_time
-            DESC LIMIT 1""".format(
-            tables['network_status'], 'GLC'))
-        newDatumLast = cur.fetchone()
-        self.assertEqual(newDatumLast, updatedData[-1])
-
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status_latest'], 'ALF'))
-        newDatumFirst = cur.fetchone()
-        self.assertEqual(newDatumFirst, updatedData[0])
-        cur.execute("""SELECT
-                symbol, scrape_time, current_blocks, difficulty,
-                reward, hash_rate, avg_hash_rate
-            FROM {0}
-            WHERE symbol = '{1}'""".format(
-            tables['network_status_latest'], 'GLC'))
-        newDatumLast = cur.fetchone()
-        self.assertEqual(newDatumLast, updatedData[-1])
-
-if __name__ == "__main__":
-    unittest.main()
+        (SELECT *
+        FROM {1})
+        ON CONFLICT DO NOTHING""".format(targetTable, stagingTable))
+    inserted = cursor.rowcount
+    if maintainRollups:
+        import rollup
+        rollup.refreshFromStaging(stagingTable, cursor)
+    cursor.execute("""DELETE FROM {0}""".format(stagingTable))
+
+    # Bring the latest table in line with latest
+    _loadStaging(stagingTable, networkStatusColumns, latest, cursor)
+    _replaceLatest([datum['symbol'] for datum in latest], cursor)
+    return inserted
+
+
+@transactional
+def loadNetworkStatusHistory(data, latest):
+    """Bulk load network status history that is already deduplicated.
+
+    Rows in data are added to the network status table, skipping any that
+    are already there, and the latest table is replaced with the rows in
+    latest, all in one transaction.
+    """
+    cursor = dictCursor()
+    _loadHistory(data, latest, cursor)
+
+    # Commit (this also empties the staging table)
+    cursor.connection.commit()
+    _remember(
+        'network_status', latest, _cachedNetworkStatus, replace=True)
+    _notify('network_status_latest', None)
+
+
+@transactional
+def loadScrapes(currencies, currencyHistory, data, latest):
+    """Store several scrapes' worth of rows in one transaction.
+
+    currencies holds the newest row for each currency and currencyHistory
+    every distinct currency row seen; data and latest are as for
+    loadNetworkStatusHistory.
+    """
+    cursor = dictCursor()
+
+    # Merge currencies the same way insertLatestCurrencies does
+    stagingTable = _staging(tables['currency'], cursor)
+    _loadStaging(stagingTable, currencyColumns, currencyHistory, cursor)
+    _execute('merge_currency_historical', None, cursor)
+    cursor.execute("""DELETE FROM {0}""".format(stagingTable))
+    _loadStaging(stagingTable, currencyColumns, currencies, cursor)
+    _execute('merge_currency', None, cursor)
+
+    inserted = _loadHistory(data, latest, cursor)
+
+    # Commit (this also empties the staging tables)
+    cursor.connection.commit()
+    _remember('currency', currencies, _currencyFingerprint)
+    _remember(
+        'network_status', latest, _cachedNetworkStatus, replace=True)
+    _notify('currency', set(datum['symbol'] for datum in currencies))
+    _notify('network_status_latest', None)
+    metrics.increment("rows_inserted_total", inserted, table="network_status")
@@ -0,0 +1,231 @@
+""" Cached queries over latest and historical network status. """
+import collections
+import pg
+import threading
+import time
+
+# Configuration variables
+cacheSize = 4096
+# Seconds a cached result may be served. Writes made by this process
+# invalidate the affected symbols straight away; the TTL bounds how stale
+# results can get when another process is the one scraping.
+cacheTtl = 60
+
+# Dependency tags for results that change when any symbol's network status
+# changes, or when any currency changes
+_ANY_STATUS = ("any", "network_status_latest")
+_ANY_CURRENCY = ("any", "currency")
+
+_latestColumns = ", ".join(pg.networkStatusColumns)
+_metrics = ('difficulty', 'reward', 'hash_rate', 'avg_hash_rate')
+
+
+class _Cache(object):
+
+    """LRU cache with a TTL whose entries can be dropped by symbol."""
+
+    def __init__(self, size, ttl):
+        """Start with an empty cache."""
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.dependents = {}
+        self.seen = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, key):
+        """Get a live entry, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.stats['misses'] += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value, dependencies):
+        """Store a value that is stale once any of its dependencies change."""
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.time() + self.ttl, value, dependencies)
+            for dependency in dependencies:
+                self.dependents.setdefault(dependency, set()).add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        """Remove an entry and its dependency links (lock held)."""
+        expires, value, dependencies = self.entries.pop(key)
+        for dependency in dependencies:
+            keys = self.dependents.get(dependency)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.dependents[dependency]
+
+    def invalidate(self, dependencies):
+        """Drop every entry depending on any of the given dependencies."""
+        with self.lock:
+            for dependency in dependencies:
+                for key in list(self.dependents.get(dependency, ())):
+                    self._drop(key)
+                    self.stats['invalidations'] += 1
+
+    def clear(self):
+        """Drop everything."""
+        with self.lock:
+            self.entries.clear()
+            self.dependents.clear()
+            self.seen.clear()
+
+
+cache = _Cache(cacheSize, cacheTtl)
+
+
+def _onChange(tableKey, symbols, seen):
+    """pg listener dropping the cached results a commit made stale."""
+    if symbols is None:
+        cache.clear()
+        return
+    if tableKey == 'currency':
+        cache.invalidate(
+            [_ANY_CURRENCY] + [("currency", symbol) for symbol in symbols])
+    elif tableKey == 'network_status_latest':
+        with cache.lock:
+            cache.seen.update(seen)
+        if symbols:
+            cache.invalidate(
+                [_ANY_STATUS] + [("status", symbol) for symbol in symbols])
+
+pg.listeners.append(_onChange)
+
+
+@pg.transactional
+def _read(sql, params):
+    """Run a read on this thread's connection, returning rows as dicts."""
+    cursor = pg.dictCursor()
+    cursor.execute(sql, params)
+    rows = [dict(row) for row in cursor]
+    cursor.connection.commit()
+    return rows
+
+
+def _fetch(sql, params=None):
+    """Run a read, giving the connection back to the pool afterwards."""
+    with pg.session():
+        return _read(sql, params)
+
+
+def _refreshed(row):
+    """Copy a cached latest row with the newest scrape time seen for it.
+
+    Scrapes that leave a symbol's values alone only move its scrape time,
+    so that is patched in rather than invalidating the row.
+    """
+    row = dict(row)
+    seen = cache.seen.get(row['symbol'])
+    if seen is not None and seen > row['scrape_time']:
+        row['scrape_time'] = seen
+    return row
+
+
+def latestBySymbol(symbols=None):
+    """Get the latest network status for some symbols (or all of them).
+
+    Returns a dict of rows keyed by symbol; symbols without a row are left
+    out.
+    """
+    if symbols is None:
+        rows = cache.get(("latest", None))
+        if rows is None:
+            rows = _fetch("""SELECT {0}
+                FROM {1}""".format(
+                _latestColumns, pg.tables['network_status_latest']))
+            cache.put(("latest", None), rows, [_ANY_STATUS])
+        return dict((row['symbol'], _refreshed(row)) for row in rows)
+    result = {}
+    missing = []
+    for symbol in symbols:
+        row = cache.get(("latest", symbol))
+        if row is None:
+            missing.append(symbol)
+        elif row:
+            result[symbol] = _refreshed(row)
+    if missing:
+        found = dict((row['symbol'], row) for row in _fetch("""SELECT {0}
+            FROM {1}
+            WHERE symbol = ANY(%(symbols)s::varchar[])""".format(
+            _latestColumns, pg.tables['network_status_latest']),
+            {'symbols': missing}))
+        for symbol in missing:
+            # Unknown symbols are cached as empty rows
+            row = found.get(symbol, {})
+            cache.put(("latest", symbol), row, [("status", symbol)])
+            if row:
+                result[symbol] = _refreshed(row)
+    return result
+
+
+def latestByAlgo(algo):
+    """Get the latest network status, with name, of every coin of an algo."""
+    rows = cache.get(("algo", algo))
+    if rows is None:
+        rows = _fetch("""SELECT {0}, cur.name, cur.algo
+            FROM {1} lt
+            JOIN {2} cur ON cur.symbol = lt.symbol
+            WHERE cur.algo = %(algo)s
+            ORDER BY lt.symbol""".format(
+            ", ".join("lt.{0}".format(column)
+                      for column in pg.networkStatusColumns),
+            pg.tables['network_status_latest'], pg.tables['currency']),
+            {'algo': algo})
+        cache.put(
+            ("algo", algo), rows,
+            [_ANY_CURRENCY] + [("status", row['symbol']) for row in rows])
+    return [_refreshed(row) for row in rows]
+
+
+def history(symbol, start, end, step=None):
+    """Get a symbol's network status history with start <= time < end.
+
+    Without a step every stored row is returned. With a step (a timedelta)
+    rows are downsampled into buckets of that width aligned to the epoch:
+    each bucket has its first scrape time, sample count, highest block
+    count and the mean of the other values.
+    """
+    key = ("history", symbol, start, end, step)
+    rows = cache.get(key)
+    if rows is None:
+        params = {'symbol': symbol, 'start': start, 'end': end}
+        if step is None:
+            rows = _fetch("""SELECT {0}
+                FROM {1}
+                WHERE symbol = %(symbol)s
+                AND scrape_time >= %(start)s AND scrape_time < %(end)s
+                ORDER BY scrape_time""".format(
+                _latestColumns, pg.tables['network_status']), params)
+        else:
+            params['step'] = step.days * 86400 + step.seconds + \
+                step.microseconds / 1e6
+            rows = _fetch("""SELECT
+                    to_timestamp(floor(extract(epoch FROM scrape_time) /
+                        %(step)s) * %(step)s) AT TIME ZONE 'UTC' AS bucket,
+                    min(scrape_time) AS scrape_time,
+                    count(*) AS samples,
+                    max(current_blocks) AS current_blocks,
+                    {0}
+                FROM {1}
+                WHERE symbol = %(symbol)s
+                AND scrape_time >= %(start)s AND scrape_time < %(end)s
+                GROUP BY 1
+                ORDER BY 1""".format(
+                ", ".join("avg({0}) AS {0}".format(metric)
+                          for metric in _metrics),
+                pg.tables['network_status']), params)
+        cache.put(key, rows, [("status", symbol)])
+    return [dict(row) for row in rows]
@@ -0,0 +1,220 @@
+""" Replay archived payloads into the database. """
+import archive
+import argparse
+import coinchoose
+import collections
+from datetime import datetime
+from datetime import timedelta
+import logging
+import multiprocessing
+import os
+import pg
+import re
+import sys
+import time
+
+# Configuration
+dataDir = "{0}/data".format(os.path.dirname(os.path.abspath(__file__)))
+checkpointFile = "{0}/replay.checkpoint".format(dataDir)
+# Rows of changed network status to collect before each bulk load
+batchRows = 100000
+# Payloads handed to each parse worker at a time
+chunkSize = 16
+# Chunks each worker may have parsed (or be parsing) ahead of the loader
+chunksAhead = 2
+
+logger = logging.getLogger(__name__)
+
+
+def discover(stream="api", since=None):
+    """Find archived payloads for a stream, in time order.
+
+    Both payload files written by older versions (<stream>_<epoch>.json in
+    dataDir) and the segmented archive are searched. Returns a list of
+    (kind, scrapeTime, location) sources. A payload identical to the one
+    before it is given the kind "repeat" so it does not need parsing.
+    """
+    sources = []
+    pattern = re.compile(r"^{0}_(\d+)\.json$".format(re.escape(stream)))
+    if os.path.isdir(dataDir):
+        for fileName in os.listdir(dataDir):
+            match = pattern.match(fileName)
+            if match is not None:
+                scrapeTime = datetime(1970, 1, 1) + timedelta(
+                    seconds=int(match.group(1)))
+                sources.append(
+                    ("file", scrapeTime, os.path.join(dataDir, fileName)))
+    for record in archive.iterRecords(stream):
+        sources.append(("archive", record.scrape_time, (stream, record)))
+    sources.sort(key=lambda source: source[1])
+    if since is not None:
+        sources = [source for source in sources if source[1] > since]
+    previousDigest = None
+    for index, (kind, scrapeTime, location) in enumerate(sources):
+        digest = location[1].digest if kind == "archive" else None
+        if digest is not None and digest == previousDigest:
+            sources[index] = ("repeat", scrapeTime, location)
+        previousDigest = digest
+    return sources
+
+
+def _parseSource(source):
+    """Parse the network status out of one source (runs in a worker)."""
+    kind, scrapeTime, location = source
+    if kind == "repeat":
+        return scrapeTime, None
+    elif kind == "file":
+        f = open(location, 'r')
+        jsonDump = f.read()
+        f.close()
+    else:
+        stream, record = location
+        jsonDump = archive.readPayload(record, stream)
+    return scrapeTime, coinchoose.parseLatestBatch(
+        jsonDump, scrapeTime=scrapeTime)
+
+
+def _parseAll(pool, sources, workers):
+    """Parse sources on the pool, yielding (scrapeTime, data) in order.
+
+    Only chunksAhead chunks per worker are in flight at once, so a slow
+    loader holds back the workers instead of piling up parsed batches.
+    """
+    pending = collections.deque()
+    limit = chunksAhead * (workers or multiprocessing.cpu_count())
+    for offset in range(0, len(sources), chunkSize):
+        chunk = sources[offset:offset + chunkSize]
+        pending.append(pool.map_async(_parseSource, chunk, len(chunk)))
+        if len(pending) >= limit:
+            for result in pending.popleft().get():
+                yield result
+    while pending:
+        for result in pending.popleft().get():
+            yield result
+
+
+def _dedupe(previous, data):
+    """Pick the rows insertLatestNetworkStatus would add to history.
+
+    previous maps each symbol to the fingerprint of its row in the latest
+    table before this scrape. Returns the changed rows and the fingerprints
+    for the next scrape.
+    """
+    changed = []
+    current = {}
+    for datum in data:
+        values = pg.networkStatusFingerprint(datum)
+        if None in values or previous.get(datum['symbol']) != values:
+            changed.append(datum)
+        current[datum['symbol']] = values
+    return changed, current
+
+
+def _readCheckpoint(path):
+    """Read the scrape time of the last loaded payload, if any."""
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'r')
+    value = f.read().strip()
+    f.close()
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f") if value \
+        else None
+
+
+def _writeCheckpoint(path, scrapeTime):
+    """Atomically record the scrape time of the last loaded payload."""
+    f = open("{0}.tmp".format(path), 'w')
+    f.write(scrapeTime.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename("{0}.tmp".format(path), path)
+
+
+def replay(stream="api", workers=None, rowsPerBatch=None, checkpoint=None,
+           resume=True):
+    """Reload archived payloads into the database.
+
+    Payloads are parsed in parallel and consumed in time order, so the dedupe
+    against the previous scrape can be done here instead of per transaction.
+    Changed rows from many scrapes are then bulk loaded together, with the
+    latest table set to the last scrape of each batch. The checkpoint is
+    written after every batch commits, so an interrupted replay picks up
+    where it left off.
+    """
+    rowsPerBatch = rowsPerBatch if rowsPerBatch is not None else batchRows
+    checkpoint = checkpoint if checkpoint is not None else checkpointFile
+    since = _readCheckpoint(checkpoint) if resume else None
+    sources = discover(stream, since=since)
+    logger.info("Replaying {0} payloads{1}...".format(
+        len(sources),
+        " after {0}".format(since) if since is not None else ""))
+    if not sources:
+        return
+
+    # Start the workers before connecting so they do not inherit the socket
+    pool = multiprocessing.Pool(workers)
+    try:
+        previous = dict(
+            (datum['symbol'], pg.networkStatusFingerprint(datum))
+            for datum in pg.fetchLatestNetworkStatus())
+        latest = None
+        pending = []
+        scrapes = 0
+        rows = 0
+        started = time.time()
+        results = _parseAll(pool, sources, workers)
+        for index, (scrapeTime, data) in enumerate(results):
+            if data is None:
+                data = latest.retimed(scrapeTime)
+            changed, previous = _dedupe(previous, data)
+            pending.extend(changed)
+            latest = data
+            scrapes += 1
+            if len(pending) >= rowsPerBatch or index == len(sources) - 1:
+                pg.loadNetworkStatusHistory(pending, latest)
+                _writeCheckpoint(checkpoint, scrapeTime)
+                rows += len(pending)
+                pending = []
+                elapsed = max(time.time() - started, 1e-9)
+                logger.info(
+                    "Loaded {0}/{1} payloads through {2} ({3} rows, "
+                    "{4:.1f} payloads/s, {5:.0f} rows/s).".format(
+                        scrapes, len(sources), scrapeTime, rows,
+                        scrapes / elapsed, rows / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    """Run a replay from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--stream", default="api",
+        help="archive stream (and legacy file prefix) to replay")
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="parse processes (defaults to the number of CPUs)")
+    parser.add_argument(
+        "--batch-rows", type=int, default=batchRows,
+        help="changed rows to collect before each bulk load")
+    parser.add_argument(
+        "--checkpoint", default=checkpointFile,
+        help="file recording the last payload loaded")
+    parser.add_argument(
+        "--restart", action="store_true",
+        help="ignore the checkpoint and replay everything")
+    args = parser.parse_args(argv)
+    replay(
+        stream=args.stream, workers=args.workers,
+        rowsPerBatch=args.batch_rows, checkpoint=args.checkpoint,
+        resume=not args.restart)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+""" Module for maintaining and querying network status rollups. """
+import argparse
+from datetime import datetime
+from datetime import timedelta
+import logging
+import pg
+import sys
+
+# Network status columns summarised in each rollup bucket
+_metrics = ('difficulty', 'hash_rate', 'avg_hash_rate')
+
+
+def _aggregates():
+    """Build the rollup columns for the block counts and every metric."""
+    result = [
+        ('samples', "count(*)", "sum(samples)"),
+        ('first_scrape_time', "min(scrape_time)", "min(first_scrape_time)"),
+        ('last_scrape_time', "max(scrape_time)", "max(last_scrape_time)"),
+        ('min_blocks', "min(current_blocks)", "min(min_blocks)"),
+        ('max_blocks', "max(current_blocks)", "max(max_blocks)")
+    ]
+    for metric in _metrics:
+        result.extend([
+            ('min_{0}'.format(metric), "min({0})".format(metric),
+                "min(min_{0})".format(metric)),
+            ('max_{0}'.format(metric), "max({0})".format(metric),
+                "max(max_{0})".format(metric)),
+            ('sum_{0}'.format(metric), "sum({0})".format(metric),
+                "sum(sum_{0})".format(metric)),
+            ('count_{0}'.format(metric), "count({0})".format(metric),
+                "sum(count_{0})".format(metric))
+        ])
+    return result
+
+
+# Rollup columns with the aggregate that fills them from raw network status
+# rows and the one that combines finer rollup rows
+aggregates = _aggregates()
+
+# Rollups from coarsest to finest as (table key, unit, bucket width)
+rollups = [
+    ('network_status_daily', 'day', timedelta(days=1)),
+    ('network_status_hourly', 'hour', timedelta(hours=1))
+]
+
+
+def _refresh(tableKey, unit, buckets, params, cursor):
+    """Recompute the rollup buckets listed by a (symbol, bucket) query.
+
+    Hourly buckets are computed from raw network status and daily buckets
+    from the hourly rollup, so hourly buckets must be refreshed first.
+    """
+    if tableKey == 'network_status_hourly':
+        sourceTable = pg.tables['network_status']
+        timeColumn = 'scrape_time'
+        expressions = [raw for column, raw, combined in aggregates]
+    else:
+        sourceTable = pg.tables['network_status_hourly']
+        timeColumn = 'bucket'
+        expressions = [combined for column, raw, combined in aggregates]
+    columns = [column for column, raw, combined in aggregates]
+    cursor.execute("""
+        INSERT INTO {0} (symbol, bucket, {1})
+        SELECT src.symbol, b.bucket, {2}
+        FROM ({3}) b
+        JOIN {4} src
+            ON src.symbol = b.symbol
+            AND src.{5} >= b.bucket
+            AND src.{5} < b.bucket + interval '1 {6}'
+        GROUP BY src.symbol, b.bucket
+        ON CONFLICT (symbol, bucket) DO UPDATE
+        SET {7}, db_update_time = current_timestamp""".format(
+        pg.tables[tableKey],
+        ", ".join(columns),
+        ", ".join(expressions),
+        buckets,
+        sourceTable,
+        timeColumn,
+        unit,
+        ", ".join(
+            "{0} = EXCLUDED.{0}".format(column) for column in columns)),
+        params)
+
+
+def refreshFromStaging(stagingTable, cursor):
+    """Refresh the buckets touched by rows in a network status staging table.
+
+    Called by pg inside its insert transaction, after the staged rows have
+    been merged into network_status.
+    """
+    for tableKey, unit, width in reversed(rollups):
+        _refresh(tableKey, unit, """
+            SELECT DISTINCT symbol, date_trunc('{0}', scrape_time) AS bucket
+            FROM {1}""".format(unit, stagingTable), None, cursor)
+
+
+def _floor(value, unit):
+    """Start of the bucket containing a time."""
+    if unit == 'day':
+        return datetime(value.year, value.month, value.day)
+    return datetime(value.year, value.month, value.day, value.hour)
+
+
+def rebuild(start, end, symbols=None):
+    """Rebuild all rollup buckets overlapping a time range from scratch."""
+    start = _floor(start, 'day')
+    end = _floor(end, 'day') + timedelta(days=1) \
+        if end != _floor(end, 'day') else end
+    params = {'start': start, 'end': end, 'symbols': symbols}
+    symbolFilter = "AND symbol = ANY(%(symbols)s::varchar[])" \
+        if symbols is not None else ""
+    cursor = pg.dictCursor()
+    for tableKey, unit, width in rollups:
+        cursor.execute("""
+            DELETE FROM {0}
+            WHERE bucket >= %(start)s AND bucket < %(end)s
+            {1}""".format(pg.tables[tableKey], symbolFilter), params)
+    for tableKey, unit, width in reversed(rollups):
+        _refresh(tableKey, unit, """
+            SELECT DISTINCT symbol, date_trunc('{0}', scrape_time) AS bucket
+            FROM {1}
+            WHERE scrape_time >= %(start)s AND scrape_time < %(end)s
+            {2}""".format(unit, pg.tables['network_status'], symbolFilter),
+            params, cursor)
+    cursor.connection.commit()
+    logging.info("Rebuilt rollups from {0} to {1}.".format(start, end))
+
+
+def _aligned(value, unit):
+    """Whether a time falls on a bucket boundary."""
+    return value == _floor(value, unit)
+
+
+def chooseRollup(start, end, minBuckets=1):
+    """Pick the coarsest rollup whose buckets fit a time range exactly.
+
+    A rollup fits when both ends of the range fall on its bucket boundaries
+    and the range spans at least minBuckets of its buckets. Returns a
+    (table key, unit) pair, or None when only raw data will do.
+    """
+    for tableKey, unit, width in rollups:
+        if _aligned(start, unit) and _aligned(end, unit) and \
+                end - start >= width * minBuckets:
+            return tableKey, unit
+    return None
+
+
+def _summary(source):
+    """Select the query helper's output columns from rollup shaped rows."""
+    columns = [
+        "bucket", "samples", "first_scrape_time", "last_scrape_time",
+        "min_blocks", "max_blocks"]
+    for metric in _metrics:
+        columns.extend([
+            "min_{0}".format(metric),
+            "max_{0}".format(metric),
+            "sum_{0} / NULLIF(count_{0}, 0) AS avg_{0}".format(metric)])
+    return """SELECT {0}
+        FROM {1}""".format(", ".join(columns), source)
+
+
+def queryRange(symbol, start, end, minBuckets=1):
+    """Get per-bucket statistics for a symbol from the coarsest fitting rollup.
+
+    Ranges that no rollup fits are aggregated by hour from raw network
+    status on the fly.
+    """
+    params = {'symbol': symbol, 'start': start, 'end': end}
+    choice = chooseRollup(start, end, minBuckets)
+    if choice is not None:
+        source = "{0}".format(pg.tables[choice[0]])
+        timeColumn = "bucket"
+    else:
+        source = """(SELECT symbol,
+                date_trunc('hour', scrape_time) AS bucket, {0}
+            FROM {1}
+            WHERE symbol = %(symbol)s
+            AND scrape_time >= %(start)s AND scrape_time < %(end)s
+            GROUP BY symbol, date_trunc('hour', scrape_time)) raw""".format(
+            ", ".join("{0} AS {1}".format(raw, column)
+                      for column, raw, combined in aggregates),
+            pg.tables['network_status'])
+        timeColumn = "first_scrape_time"
+    cursor = pg.dictCursor()
+    cursor.execute("""{0}
+        WHERE symbol = %(symbol)s
+        AND {1} >= %(start)s AND {1} < %(end)s
+        ORDER BY bucket""".format(_summary(source), timeColumn), params)
+    data = [dict(row) for row in cursor]
+    cursor.connection.commit()
+    return data
+
+
+def main(argv=None):
+    """Rebuild rollups for a time range from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("start", help="start of the range (YYYY-MM-DD)")
+    parser.add_argument("end", help="end of the range (YYYY-MM-DD)")
+    parser.add_argument(
+        "--symbol", action="append", dest="symbols",
+        help="only rebuild this symbol (may be repeated)")
+    args = parser.parse_args(argv)
+    rebuild(
+        datetime.strptime(args.start, "%Y-%m-%d"),
+        datetime.strptime(args.end, "%Y-%m-%d"),
+        symbols=args.symbols)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,42 +1,473 @@
 """ Core scraper for coinchoose.com. """
+import anomaly
+import archive
+import argparse
 import coinchoose
-from datetime import datetime
+import collections
 import logging
-import os
+import metrics
 import pg
+import random
+import signal
 import sys
+import threading
+import time
 import traceback
 
 # Configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s:%(message)s',
-    datefmt='%m/%d/%Y %I:%M:%S %p')
-
-
-def saveToFile(content, prefix, extension):
-    """Save given entity to a file."""
-    f = open("{0}/data/{1}_{2}.{3}".format(
-        os.path.dirname(os.path.abspath(__file__)),
-        prefix,
-        int((datetime.utcnow() - datetime(1970, 1, 1)).total_seconds()),
-        extension),
-        'w')
-    f.write(content)
-    f.close()
-
-
-logging.info("""Starting scrape...""")
-jsonDump = coinchoose.requestLatest()
-scrapeTime = datetime.utcnow()
-logging.info("""JSON request successful. Saving to file...""")
-saveToFile(jsonDump, 'api', 'json')
-logging.info("""Done. Parsing latest currencies...""")
-currencies = coinchoose.parseLatestCurrencies(jsonDump)
-logging.info("""Done. Inserting latest currencies into DB...""")
-pg.insertLatestCurrencies(currencies)
-logging.info("""Done. Parsing latest network status...""")
-networkStatus = coinchoose.parseLatestNetworkStatus(
-    jsonDump, scrapeTime=scrapeTime)
-logging.info("""Done. Inserting latest network status into DB...""")
-pg.insertLatestNetworkStatus(networkStatus)
+defaultInterval = 60
+defaultJitter = 0
+# Scrapes that may wait in front of the parse and store stages of the
+# pipelined runner; once a stage's queue is full the stage feeding it waits
+pipelineDepth = 2
+# Seconds between warnings while a stage waits for the next one
+stallWarning = 60
+# Scrapes that may wait to be archived before fetching waits for the disk
+archiveQueueSize = 64
+# Collect scrapes in the local spool and store them in group commits
+groupCommit = False
+
+# Set when the daemon has been asked to shut down
+stopEvent = threading.Event()
+
+# Content hash of each base's payload in the last stored scrape
+_lastDigests = {}
+
+
+def saveToFile(content, prefix, scrapeTime=None, digest=None):
+    """Save given entity to the payload archive."""
+    archive.append(content, scrapeTime=scrapeTime, name=prefix, digest=digest)
+
+
+def _mergeBySymbol(rowLists):
+    """Merge row lists, keeping the first row seen for each symbol."""
+    merged = []
+    seen = set()
+    for rows in rowLists:
+        for row in rows:
+            if row['symbol'] not in seen:
+                seen.add(row['symbol'])
+                merged.append(row)
+    return merged
+
+
+def scrape():
+    """Run a single scrape from request through to the database."""
+    metrics.startScrape()
+    success = False
+    try:
+        _scrape()
+        success = True
+    finally:
+        metrics.finishScrape(success)
+
+
+def _fetch():
+    """Fetch every base and hash the payloads."""
+    logging.info("""Starting scrape...""")
+    with metrics.timer("fetch"):
+        results = coinchoose.requestLatestBases()
+        digests = dict(
+            (base, archive.payloadDigest(jsonDump))
+            for base, jsonDump, scrapeTime in results)
+    return {'results': results, 'digests': digests}
+
+
+def _archive(scrape):
+    """Save a scrape's payloads to the archive."""
+    logging.info("""Saving to archive...""")
+    with metrics.timer("archive"):
+        for base, jsonDump, scrapeTime in scrape['results']:
+            prefix = 'api' if base == "BTC" else "api_{0}".format(base)
+            saveToFile(
+                jsonDump, prefix, scrapeTime=scrapeTime,
+                digest=scrape['digests'][base])
+
+
+def _parse(scrape):
+    """Parse a scrape's payloads into merged currency and status rows."""
+    logging.info("""Parsing latest currencies and network status...""")
+    with metrics.timer("parse"):
+        currencyLists = []
+        networkStatusLists = []
+        for base, jsonDump, scrapeTime in scrape['results']:
+            currencies, networkStatus = coinchoose.parseLatest(
+                jsonDump, scrapeTime=scrapeTime)
+            currencyLists.append(currencies)
+            networkStatusLists.append(networkStatus)
+        # Network status does not depend on the base, so each symbol is only
+        # stored once per scrape
+        scrape['currencies'] = _mergeBySymbol(currencyLists)
+        scrape['networkStatus'] = _mergeBySymbol(networkStatusLists)
+    metrics.increment(
+        "rows_received_total", len(scrape['currencies']), kind="currency")
+    metrics.increment(
+        "rows_received_total", len(scrape['networkStatus']),
+        kind="network_status")
+    _detect(scrape)
+
+
+def _detect(scrape):
+    """Run anomaly detection on a scrape, parsed or not.
+
+    Detection never fails the scrape.
+    """
+    try:
+        with metrics.timer("detect"):
+            if 'networkStatus' in scrape:
+                anomaly.observe(scrape['networkStatus'])
+            else:
+                anomaly.checkStalls(scrape['results'][0][2])
+            anomaly.save()
+    except Exception:
+        logging.error("Anomaly detection failed:\n{0}".format(
+            traceback.format_exc()))
+
+
+def _store(scrape):
+    """Store a scrape, or just its scrape time if nothing changed."""
+    if groupCommit:
+        _spool(scrape)
+        return
+    # When every payload matches the last stored scrape, parsing would give
+    # the same rows again, so only the scrape time needs recording
+    if scrape['digests'] == _lastDigests:
+        logging.info("""Payloads unchanged. Recording scrape time...""")
+        metrics.increment("scrapes_unchanged_total")
+        with metrics.timer("touch_network_status"):
+            pg.touchLatestNetworkStatus(scrape['results'][0][2])
+        return
+    _lastDigests.clear()
+    if 'networkStatus' not in scrape:
+        _parse(scrape)
+    logging.info("""Inserting latest currencies into DB...""")
+    with metrics.timer("insert_currencies"):
+        pg.insertLatestCurrencies(scrape['currencies'])
+    logging.info("""Done. Inserting latest network status into DB...""")
+    with metrics.timer("insert_network_status"):
+        pg.insertLatestNetworkStatus(scrape['networkStatus'])
+    _lastDigests.update(scrape['digests'])
+
+
+def _spool(scrape):
+    """Add a scrape to the group commit spool, flushing it when due.
+
+    In this mode the last spooled payloads stand in for the last stored
+    ones. A failed flush leaves the spool in place to be retried.
+    """
+    # The spool pulls in replay and multiprocessing, so only group commits
+    # load it
+    import spool
+    with metrics.timer("spool"):
+        if scrape['digests'] == _lastDigests and spool.hasRecords():
+            spool.appendRepeat(scrape['results'][0][2])
+        else:
+            _lastDigests.clear()
+            if 'networkStatus' not in scrape:
+                _parse(scrape)
+            spool.append(scrape['currencies'], scrape['networkStatus'])
+            _lastDigests.update(scrape['digests'])
+    try:
+        with metrics.timer("flush"):
+            spool.flushIfDue()
+    except Exception:
+        logging.error("Could not flush the spool. Keeping it:\n{0}".format(
+            traceback.format_exc()))
+        pg.disconnect()
+
+
+def _flushSpool():
+    """Flush whatever is spooled before stopping, if group commit is on."""
+    if not groupCommit:
+        return
+    import spool
+    try:
+        spool.flush()
+    except Exception:
+        logging.error("Could not flush the spool. Keeping it:\n{0}".format(
+            traceback.format_exc()))
+
+
+def _scrape():
+    """Fetch, archive, parse and store one scrape, timing each stage."""
+    scrape = _fetch()
+    _archive(scrape)
+    if scrape['digests'] != _lastDigests:
+        _parse(scrape)
+    else:
+        _detect(scrape)
+    _store(scrape)
+
+
+class _StageQueue(object):
+
+    """Bounded FIFO between pipeline stages.
+
+    When the queue is full, put waits for room, so a stage that falls
+    behind holds back the stages feeding it and no scrape is lost.
+    """
+
+    def __init__(self, size):
+        """Start empty and open."""
+        self.size = size
+        self.items = collections.deque()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, timeout=None):
+        """Add an item, waiting for room.
+
+        Returns False, without adding the item, if the queue is still full
+        after timeout seconds.
+        """
+        with self.condition:
+            deadline = time.time() + timeout if timeout is not None else None
+            while len(self.items) >= self.size:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """Take the oldest item, or None once closed and drained."""
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            item = self.items.popleft() if self.items else None
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        """Let consumers finish once the queue is drained."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def _handOn(queue, scrape, stage):
+    """Queue a scrape for a stage, waiting as long as the stage is behind."""
+    started = time.time()
+    while not queue.put(scrape, timeout=stallWarning):
+        logging.warning(
+            "Stage {0} is behind. Scrape from {1} has waited {2:.0f}s for "
+            "it.".format(stage, scrape['results'][0][2],
+                         time.time() - started))
+    metrics.increment(
+        "pipeline_wait_seconds_total", time.time() - started, stage=stage)
+
+
+def _archiveWorker(archiveQueue):
+    """Archive every fetched scrape."""
+    while True:
+        scrape = archiveQueue.get()
+        if scrape is None:
+            return
+        metrics.attach(scrape['metrics'])
+        try:
+            _archive(scrape)
+        except Exception:
+            logging.error("Archiving failed:\n{0}".format(
+                traceback.format_exc()))
+        metrics.attach(None)
+
+
+def _parseWorker(parseQueue, storeQueue):
+    """Parse fetched scrapes and pass them on to be stored."""
+    previousDigests = None
+    while True:
+        scrape = parseQueue.get()
+        if scrape is None:
+            storeQueue.close()
+            return
+        metrics.attach(scrape['metrics'])
+        try:
+            # A repeat of the scrape before is usually stored with a touch,
+            # so parsing is left to the store stage in case it is needed
+            if scrape['digests'] != previousDigests:
+                _parse(scrape)
+            else:
+                _detect(scrape)
+            previousDigests = scrape['digests']
+        except Exception:
+            logging.error("Parsing failed:\n{0}".format(
+                traceback.format_exc()))
+            metrics.finishScrape(False, scrape['metrics'])
+            continue
+        finally:
+            metrics.attach(None)
+        _handOn(storeQueue, scrape, "store")
+
+
+def _storeWorker(storeQueue):
+    """Store parsed scrapes in the order they were fetched."""
+    while True:
+        scrape = storeQueue.get()
+        if scrape is None:
+            _flushSpool()
+            pg.disconnect()
+            return
+        metrics.attach(scrape['metrics'])
+        success = False
+        try:
+            _store(scrape)
+            success = True
+        except Exception:
+            logging.error("Storing failed:\n{0}".format(
+                traceback.format_exc()))
+            # Hand the connection back so the pool can check it
+            pg.disconnect()
+        finally:
+            metrics.finishScrape(success, scrape['metrics'])
+
+
+def _requestStop(signum, frame):
+    """Signal handler asking the daemon to stop after the current scrape."""
+    logging.info("Received signal {0}. Stopping...".format(signum))
+    stopEvent.set()
+
+
+def runDaemon(interval=defaultInterval, jitter=defaultJitter):
+    """Scrape on a fixed cadence until stopped.
+
+    Ticks are scheduled from a fixed anchor so the time spent scraping does
+    not accumulate as drift. A scrape that overruns causes the ticks it
+    overlapped to be skipped rather than queued. Each tick is delayed by a
+    random amount of up to jitter seconds.
+    """
+    signal.signal(signal.SIGTERM, _requestStop)
+    signal.signal(signal.SIGINT, _requestStop)
+    nextTick = time.time()
+    while not stopEvent.is_set():
+        delay = nextTick + random.uniform(0, jitter) - time.time()
+        if delay > 0 and stopEvent.wait(delay):
+            break
+        try:
+            scrape()
+        except Exception:
+            logging.error("Scrape failed:\n{0}".format(
+                traceback.format_exc()))
+            # Hand the connection back so the pool can check it
+            pg.disconnect()
+        nextTick += interval
+        now = time.time()
+        if nextTick <= now:
+            skipped = int((now - nextTick) // interval) + 1
+            logging.warning("Scrape overran. Skipping {0} tick(s).".format(
+                skipped))
+            nextTick += skipped * interval
+    _flushSpool()
+    pg.disconnect()
+    pg.closePool()
+    logging.info("""Daemon stopped.""")
+
+
+def runPipeline(interval=defaultInterval, jitter=defaultJitter):
+    """Scrape on a fixed cadence, overlapping the stages of each scrape.
+
+    Each stage runs on its own thread with a bounded queue in front of it.
+    Fetching keeps to the same anchored ticks as runDaemon, and a slow merge
+    only delays it once pipelineDepth scrapes are queued in front of both
+    the parse and store stages. Past that, fetching waits and the ticks it
+    misses are skipped, so every fetched scrape is stored, in the order it
+    was fetched.
+    """
+    signal.signal(signal.SIGTERM, _requestStop)
+    signal.signal(signal.SIGINT, _requestStop)
+    if metrics.profile:
+        logging.warning("Profiling is not supported by the pipeline.")
+        metrics.profile = False
+    archiveQueue = _StageQueue(archiveQueueSize)
+    parseQueue = _StageQueue(pipelineDepth)
+    storeQueue = _StageQueue(pipelineDepth)
+    workers = [
+        threading.Thread(target=_archiveWorker, args=(archiveQueue,)),
+        threading.Thread(target=_parseWorker, args=(parseQueue, storeQueue)),
+        threading.Thread(target=_storeWorker, args=(storeQueue,))
+    ]
+    for worker in workers:
+        worker.start()
+    nextTick = time.time()
+    while not stopEvent.is_set():
+        delay = nextTick + random.uniform(0, jitter) - time.time()
+        if delay > 0 and stopEvent.wait(delay):
+            break
+        record = metrics.startScrape()
+        try:
+            scrape = _fetch()
+        except Exception:
+            logging.error("Fetch failed:\n{0}".format(
+                traceback.format_exc()))
+            metrics.finishScrape(False, record)
+        else:
+            metrics.attach(None)
+            scrape['metrics'] = record
+            archiveQueue.put(scrape)
+            _handOn(parseQueue, scrape, "parse")
+        nextTick += interval
+        now = time.time()
+        if nextTick <= now:
+            skipped = int((now - nextTick) // interval) + 1
+            logging.warning("Fetch overran. Skipping {0} tick(s).".format(
+                skipped))
+            nextTick += skipped * interval
+    archiveQueue.close()
+    parseQueue.close()
+    for worker in workers:
+        worker.join()
+    pg.closePool()
+    logging.info("""Pipeline stopped.""")
+
+
+def main(argv=None):
+    """Run the scraper from the command line."""
+    global groupCommit
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--bases", default=",".join(coinchoose.bases),
+        help="comma separated list of bases to fetch in each scrape")
+    parser.add_argument(
+        "--daemon", action="store_true",
+        help="keep running and scrape on a fixed cadence")
+    parser.add_argument(
+        "--interval", type=float, default=defaultInterval,
+        help="seconds between scrapes in daemon mode")
+    parser.add_argument(
+        "--jitter", type=float, default=defaultJitter,
+        help="maximum random delay added to each tick in daemon mode")
+    parser.add_argument(
+        "--pipeline", action="store_true",
+        help="in daemon mode, overlap fetch, archive, parse and store")
+    parser.add_argument(
+        "--group-commit", action="store_true",
+        help="spool scrapes locally and store them in batches")
+    parser.add_argument(
+        "--metrics-dir", default=metrics.metricsDir,
+        help="directory for the Prometheus text file and scrape log")
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="save a cProfile of each scrape in the metrics directory")
+    args = parser.parse_args(argv)
+    coinchoose.bases = args.bases.split(",")
+    metrics.metricsDir = args.metrics_dir
+    metrics.profile = args.profile
+    groupCommit = args.group_commit
+    if args.daemon and args.pipeline:
+        runPipeline(interval=args.interval, jitter=args.jitter)
+    elif args.daemon:
+        runDaemon(interval=args.interval, jitter=args.jitter)
+    else:
+        scrape()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s:%(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    main(sys.argv[1:])
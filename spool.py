@@ -0,0 +1,255 @@
+""" Local spool of parsed scrapes for group commits to the database. """
+import asof
+import collections
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import json
+import logging
+import os
+import pg
+import replay
+import threading
+import time
+
+# Configuration variables
+spoolDir = "{0}/data/spool".format(os.path.dirname(os.path.abspath(__file__)))
+# fsync the spool after every append
+syncWrites = False
+# Flush once this many network status rows are spooled, or once the oldest
+# spooled scrape is this many seconds old
+flushRows = 10000
+flushAge = 300
+
+# Spooled network status rows are stored as lists in this column order, with
+# decimals as strings so they round trip exactly
+_decimalColumns = ('difficulty', 'reward', 'avg_hash_rate')
+_timeFormat = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Spool state, loaded from the spool file on first use
+_lock = threading.RLock()
+_state = None
+
+
+def _spoolPath():
+    """Path of the spool file."""
+    return "{0}/scrapes.jsonl".format(spoolDir)
+
+
+def _encodeRow(datum):
+    """Encode a network status row for the spool."""
+    row = []
+    for column in pg.networkStatusColumns:
+        value = datum[column]
+        if value is None:
+            row.append(None)
+        elif column == 'scrape_time':
+            row.append(value.strftime(_timeFormat))
+        elif column in _decimalColumns:
+            row.append("{0}".format(value))
+        else:
+            row.append(value)
+    return row
+
+
+def _decodeRow(row):
+    """Decode a spooled network status row."""
+    datum = dict(zip(pg.networkStatusColumns, row))
+    datum['scrape_time'] = datetime.strptime(
+        datum['scrape_time'], _timeFormat)
+    for column in _decimalColumns:
+        if datum[column] is not None:
+            datum[column] = Decimal(datum[column])
+    for column in ('current_blocks', 'hash_rate'):
+        if datum[column] is not None:
+            datum[column] = long(datum[column])
+    return datum
+
+
+def _load():
+    """Read the spool's state, cutting off any partially written record."""
+    global _state
+    if _state is not None:
+        return _state
+    _state = {'records': 0, 'rows': 0, 'oldest': None, 'lastRows': 0}
+    if not os.path.exists(_spoolPath()):
+        return _state
+    f = open(_spoolPath(), 'r+b')
+    good = 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            break
+        good += len(line)
+        _count(record)
+    f.truncate(good)
+    f.close()
+    return _state
+
+
+def _count(record):
+    """Add a record to the spool's state."""
+    if _state['oldest'] is None:
+        _state['oldest'] = record['spooled']
+    if not record.get('repeat'):
+        _state['lastRows'] = len(record['network_status'])
+    _state['records'] += 1
+    _state['rows'] += _state['lastRows']
+
+
+def _write(record):
+    """Append a record to the spool file."""
+    _load()
+    if not os.path.isdir(spoolDir):
+        os.makedirs(spoolDir)
+    f = open(_spoolPath(), 'ab')
+    f.write((json.dumps(record) + "\n").encode('utf-8'))
+    f.flush()
+    if syncWrites:
+        os.fsync(f.fileno())
+    f.close()
+    _count(record)
+
+
+def append(currencies, networkStatus):
+    """Spool one scrape's parsed currencies and network status."""
+    with _lock:
+        _write({
+            'spooled': time.time(),
+            'currencies': [
+                [datum[column] for column in pg.currencyColumns]
+                for datum in currencies],
+            'network_status': [_encodeRow(datum) for datum in networkStatus]
+        })
+
+
+def appendRepeat(scrapeTime):
+    """Spool a scrape whose rows match the previous spooled scrape's."""
+    with _lock:
+        if not hasRecords():
+            raise Exception("Nothing spooled to repeat.")
+        _write({
+            'spooled': time.time(),
+            'repeat': True,
+            'scrape_time': scrapeTime.strftime(_timeFormat)
+        })
+
+
+def hasRecords():
+    """Whether anything is waiting in the spool."""
+    with _lock:
+        return _load()['records'] > 0
+
+
+def pending():
+    """Get (scrapes, network status rows, age in seconds) of the spool."""
+    with _lock:
+        state = _load()
+        age = time.time() - state['oldest'] \
+            if state['oldest'] is not None else 0
+        return state['records'], state['rows'], age
+
+
+def _iterScrapes():
+    """Iterate over spooled (currencies, network status) pairs in order."""
+    if not os.path.exists(_spoolPath()):
+        return
+    f = open(_spoolPath(), 'rb')
+    currencies = None
+    networkStatus = None
+    try:
+        for line in f:
+            record = json.loads(line.decode('utf-8'))
+            if record.get('repeat'):
+                scrapeTime = datetime.strptime(
+                    record['scrape_time'], _timeFormat)
+                networkStatus = [dict(datum, scrape_time=scrapeTime)
+                                 for datum in networkStatus]
+            else:
+                currencies = [dict(zip(pg.currencyColumns, row))
+                              for row in record['currencies']]
+                networkStatus = [_decodeRow(row)
+                                 for row in record['network_status']]
+            yield currencies, networkStatus
+    finally:
+        f.close()
+
+
+def _storedBefore():
+    """Fingerprints of each spooled symbol's history before the spool.
+
+    A repeated flush finds the same rows here, whatever it or another
+    writer stored since, so it deduplicates the spool the same way.
+    """
+    first = None
+    symbols = set()
+    for scrapeCurrencies, networkStatus in _iterScrapes():
+        for datum in networkStatus:
+            symbols.add(datum['symbol'])
+            if first is None or datum['scrape_time'] < first:
+                first = datum['scrape_time']
+    if first is None:
+        return {}
+    symbols = sorted(symbols)
+    before = first - timedelta(microseconds=1)
+    return dict(
+        (symbol, pg.networkStatusFingerprint(row))
+        for symbol, row in zip(symbols, asof.lookup(
+            (symbol, before) for symbol in symbols))
+        if row is not None)
+
+
+def flush():
+    """Load everything spooled into the database in one transaction.
+
+    Scrapes are deduplicated one after another, starting from each
+    symbol's history just before the first spooled scrape, exactly as
+    inserting them one by one would, so history gets the same rows. Rows
+    already in history are skipped by the load, so a flush repeated after
+    one that crashed before emptying the spool stores nothing twice, and
+    rows another writer stored meanwhile do not hide spooled ones. The
+    spool is only emptied once the transaction commits; if the database
+    cannot be reached it is left to keep growing. Returns the number of
+    scrapes flushed.
+    """
+    with _lock:
+        scrapes, rows, age = pending()
+        if not scrapes:
+            return 0
+        previous = _storedBefore()
+        history = []
+        latest = None
+        currencies = {}
+        currencyHistory = collections.OrderedDict()
+        for scrapeCurrencies, networkStatus in _iterScrapes():
+            changed, previous = replay._dedupe(previous, networkStatus)
+            history.extend(changed)
+            latest = networkStatus
+            for datum in scrapeCurrencies:
+                currencies[datum['symbol']] = datum
+                currencyHistory[tuple(
+                    datum[column] for column in pg.currencyColumns)] = datum
+        if latest is not None:
+            pg.loadScrapes(
+                list(currencies.values()), list(currencyHistory.values()),
+                history, latest)
+
+        # A crash before this point means the same scrapes are flushed
+        # again, from the same starting point, and add nothing
+        os.remove(_spoolPath())
+        global _state
+        _state = None
+        logging.info("Flushed {0} spooled scrapes ({1} new rows).".format(
+            scrapes, len(history)))
+        return scrapes
+
+
+def flushIfDue():
+    """Flush if the spool has reached its row or age threshold."""
+    scrapes, rows, age = pending()
+    if scrapes and (rows >= flushRows or age >= flushAge):
+        return flush()
+    return 0
@@ -16,6 +16,7 @@ CREATE TABLE IF NOT EXISTS currency_historical (
     PRIMARY KEY (symbol, name, algo)
 );
 
+-- Partitioned by month of scrape_time; pg.py creates partitions as needed
 CREATE TABLE IF NOT EXISTS network_status (
     scrape_time TIMESTAMP,
     symbol VARCHAR(10),
@@ -25,9 +26,11 @@ CREATE TABLE IF NOT EXISTS network_status (
     hash_rate DECIMAL,
     avg_hash_rate DECIMAL,
     db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
-    PRIMARY KEY (scrape_time, symbol)
-);
-CREATE UNIQUE INDEX ON network_status (symbol, scrape_time);
+    PRIMARY KEY (symbol, scrape_time)
+) PARTITION BY RANGE (scrape_time);
+-- Time-range scans across symbols (exports, rollup rebuilds, as-of index
+-- refreshes); rows arrive in scrape_time order, so a BRIN index stays tiny
+CREATE INDEX ON network_status USING brin (scrape_time);
 
 CREATE TABLE IF NOT EXISTS network_status_latest (
     scrape_time TIMESTAMP,
@@ -39,5 +42,54 @@ CREATE TABLE IF NOT EXISTS network_status_latest (
     avg_hash_rate DECIMAL,
     db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
     PRIMARY KEY (symbol)
+-- Rows are updated in place; leave room on each page so updates stay HOT
+) WITH (fillfactor = 70);
+
+-- Rollups maintained by pg.py (see rollup.py); averages are sum_x / count_x
+CREATE TABLE IF NOT EXISTS network_status_hourly (
+    symbol VARCHAR(10),
+    bucket TIMESTAMP,
+    samples INTEGER,
+    first_scrape_time TIMESTAMP,
+    last_scrape_time TIMESTAMP,
+    min_blocks BIGINT,
+    max_blocks BIGINT,
+    min_difficulty DECIMAL,
+    max_difficulty DECIMAL,
+    sum_difficulty DECIMAL,
+    count_difficulty INTEGER,
+    min_hash_rate DECIMAL,
+    max_hash_rate DECIMAL,
+    sum_hash_rate DECIMAL,
+    count_hash_rate INTEGER,
+    min_avg_hash_rate DECIMAL,
+    max_avg_hash_rate DECIMAL,
+    sum_avg_hash_rate DECIMAL,
+    count_avg_hash_rate INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY (symbol, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS network_status_daily (
+    symbol VARCHAR(10),
+    bucket TIMESTAMP,
+    samples INTEGER,
+    first_scrape_time TIMESTAMP,
+    last_scrape_time TIMESTAMP,
+    min_blocks BIGINT,
+    max_blocks BIGINT,
+    min_difficulty DECIMAL,
+    max_difficulty DECIMAL,
+    sum_difficulty DECIMAL,
+    count_difficulty INTEGER,
+    min_hash_rate DECIMAL,
+    max_hash_rate DECIMAL,
+    sum_hash_rate DECIMAL,
+    count_hash_rate INTEGER,
+    min_avg_hash_rate DECIMAL,
+    max_avg_hash_rate DECIMAL,
+    sum_avg_hash_rate DECIMAL,
+    count_avg_hash_rate INTEGER,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY (symbol, bucket)
 );
-CREATE UNIQUE INDEX ON network_status_latest (symbol, current_blocks, difficulty, hash_rate, avg_hash_rate);
\ No newline at end of file
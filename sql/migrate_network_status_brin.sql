@@ -0,0 +1,8 @@
+-- Add the BRIN index on network_status (scrape_time) from create.sql to an
+-- existing database. It serves the time-range scans of exports, rollup
+-- rebuilds and as-of index refreshes, and stays tiny because rows arrive in
+-- scrape_time order. Run it before or after
+-- migrate_network_status_partitions.sql; on a partitioned table the index is
+-- created on every partition.
+CREATE INDEX IF NOT EXISTS network_status_scrape_time_idx
+    ON network_status USING brin (scrape_time);
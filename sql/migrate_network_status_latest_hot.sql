@@ -0,0 +1,27 @@
+-- Prepare an existing network_status_latest table for in-place updates: leave
+-- free space on each page and drop the index over the value columns, so that
+-- updating a row's values never touches an index and can be a HOT update.
+-- The primary key on symbol is all pg.py needs.
+BEGIN;
+
+ALTER TABLE network_status_latest SET (fillfactor = 70);
+
+DO $$
+DECLARE
+    idx REGCLASS;
+BEGIN
+    FOR idx IN
+        SELECT i.indexrelid::regclass
+        FROM pg_index i
+        WHERE i.indrelid = 'network_status_latest'::regclass
+        AND NOT i.indisprimary
+    LOOP
+        EXECUTE format('DROP INDEX %s', idx);
+    END LOOP;
+END
+$$;
+
+COMMIT;
+
+-- Rewrite the table so existing pages get the new fillfactor
+VACUUM FULL network_status_latest;
@@ -0,0 +1,78 @@
+-- Convert an existing unpartitioned network_status table into the partitioned
+-- layout from create.sql. The old table is kept, with all of its rows, as a
+-- single partition covering everything before the month after its last scrape;
+-- pg.py creates monthly partitions from there on.
+BEGIN;
+
+ALTER TABLE network_status RENAME TO network_status_legacy;
+ALTER INDEX network_status_pkey RENAME TO network_status_legacy_pkey;
+
+-- The old table is keyed on (scrape_time, symbol), with a separate unique
+-- index on (symbol, scrape_time). Key it like the new partitions, reusing that
+-- index when it is there, so every partition has one key index in the order
+-- ON CONFLICT (symbol, scrape_time) and per-symbol lookups use.
+DO $$
+DECLARE
+    idx NAME;
+BEGIN
+    ALTER TABLE network_status_legacy
+        DROP CONSTRAINT network_status_legacy_pkey;
+    SELECT c.relname
+    INTO idx
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = 'network_status_legacy'::regclass
+    AND i.indisunique
+    AND i.indpred IS NULL
+    AND i.indexprs IS NULL
+    AND i.indnatts = 2
+    AND i.indkey[0] = (
+        SELECT attnum
+        FROM pg_attribute
+        WHERE attrelid = 'network_status_legacy'::regclass
+        AND attname = 'symbol')
+    AND i.indkey[1] = (
+        SELECT attnum
+        FROM pg_attribute
+        WHERE attrelid = 'network_status_legacy'::regclass
+        AND attname = 'scrape_time')
+    LIMIT 1;
+    IF idx IS NULL THEN
+        ALTER TABLE network_status_legacy
+            ADD CONSTRAINT network_status_legacy_pkey
+            PRIMARY KEY (symbol, scrape_time);
+    ELSE
+        EXECUTE format('ALTER TABLE network_status_legacy
+            ADD CONSTRAINT network_status_legacy_pkey
+            PRIMARY KEY USING INDEX %I', idx);
+    END IF;
+END
+$$;
+
+CREATE TABLE network_status (
+    scrape_time TIMESTAMP,
+    symbol VARCHAR(10),
+    current_blocks BIGINT,
+    difficulty DECIMAL,
+    reward DECIMAL,
+    hash_rate DECIMAL,
+    avg_hash_rate DECIMAL,
+    db_update_time TIMESTAMP WITH TIME ZONE DEFAULT current_timestamp,
+    PRIMARY KEY (symbol, scrape_time)
+) PARTITION BY RANGE (scrape_time);
+
+DO $$
+DECLARE
+    bound TIMESTAMP;
+BEGIN
+    SELECT date_trunc('month', coalesce(max(scrape_time),
+        now() AT TIME ZONE 'UTC')) + interval '1 month'
+    INTO bound
+    FROM network_status_legacy;
+    EXECUTE format('ALTER TABLE network_status
+        ATTACH PARTITION network_status_legacy
+        FOR VALUES FROM (MINVALUE) TO (%L)', bound);
+END
+$$;
+
+COMMIT;
@@ -0,0 +1,94 @@
+""" Tests for the analytics module. """
+import analytics
+from datetime import datetime
+import math
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class AnalyticsTest(unittest.TestCase):
+
+    """Testing suite for analytics module."""
+
+    def _rows(self):
+        """Irregularly spaced rows with NULLs and a retarget."""
+        hour = 3600 * 1000000.0
+        nan = float('nan')
+        return {
+            'scrape_time': [0, hour, 3 * hour, 4 * hour, 30 * hour],
+            'current_blocks': [100, 110, nan, 140, 200],
+            'difficulty': [2, 2, 2, nan, 3],
+            'reward': [50, 50, 50, 50, 50],
+            'hash_rate': [10, nan, 30, 20, 40]
+        }
+
+    def testDerived(self):
+        """Test derived values across gaps and NULLs."""
+        history = analytics.History('ALF', capacity=2)
+        history.append(self._rows())
+        self.assertEqual(len(history), 5)
+        rates = history['block_rate']
+        self.assertTrue(numpy.isnan(rates[0]))
+        self.assertTrue(numpy.isnan(rates[2]))
+        for index, rate in ((1, 10), (3, 10), (4, 60 / 26.0)):
+            self.assertAlmostEqual(rates[index], rate)
+        deltas = history['difficulty_delta']
+        self.assertEqual(list(deltas[1:3]), [0, 0])
+        self.assertTrue(numpy.isnan(deltas[3]))
+        self.assertEqual(deltas[4], 0.5)
+        self.assertEqual(list(history['hash_rate_mean'][:4]),
+                         [10, 10, 20, 20])
+        self.assertEqual(history['hash_rate_mean'][4], 40)
+        self.assertTrue(numpy.isnan(history['hash_rate_trend'][3]))
+        self.assertEqual(history['hash_rate_trend'][4], 1)
+        self.assertAlmostEqual(
+            history['coins_per_mhs_day'][0],
+            50 * 1e6 * 86400 / (2 * math.pow(2, 32)))
+
+    def testIncremental(self):
+        """Test that appending row by row matches one bulk append."""
+        rows = self._rows()
+        bulk = analytics.History('ALF')
+        bulk.append(rows)
+        incremental = analytics.History('ALF', capacity=1)
+        for index in range(len(rows['scrape_time'])):
+            incremental.append(dict(
+                (name, values[index:index + 1])
+                for name, values in rows.items()))
+        # Rows already held are ignored
+        self.assertEqual(incremental.append(rows), 0)
+        for name in analytics.columns + analytics.derived:
+            numpy.testing.assert_array_equal(incremental[name], bulk[name])
+
+        histories = {}
+        analytics.update(histories, [{
+            'symbol': 'GLC',
+            'scrape_time': datetime(2014, 1, 1),
+            'current_blocks': long(300011),
+            'difficulty': None,
+            'reward': 100,
+            'hash_rate': long(0)
+        }])
+        self.assertEqual(
+            histories['GLC'].lastScrapeTime(), datetime(2014, 1, 1))
+        self.assertTrue(numpy.isnan(
+            analytics.summary(histories)['GLC']['coins_per_mhs_day']))
+
+    def testFromText(self):
+        """Test that COPY output splits into per-symbol arrays."""
+        groups = analytics._fromText(
+            u"ALF\t0\t1\t2\t50\t\\N\n"
+            u"ALF\t1\t2\t2\t50\t3\n"
+            u"GLC\t0\t5\t1\t100\t0\n")
+        self.assertEqual(sorted(groups), ['ALF', 'GLC'])
+        self.assertEqual(list(groups['ALF']['current_blocks']), [1, 2])
+        self.assertTrue(numpy.isnan(groups['ALF']['hash_rate'][0]))
+        self.assertEqual(list(groups['GLC']['reward']), [100])
+
+if __name__ == "__main__":
+    unittest.main()
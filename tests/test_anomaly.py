@@ -0,0 +1,85 @@
+""" Tests for the anomaly module. """
+import anomaly
+from datetime import datetime
+from datetime import timedelta
+import shutil
+import tempfile
+import unittest
+
+
+class AnomalyTest(unittest.TestCase):
+
+    """Testing suite for anomaly module."""
+
+    def setUp(self):
+        """Point the snapshot at scratch space and collect events."""
+        self.snapshotPathOriginal = anomaly.snapshotPath
+        self.sinksOriginal = anomaly.sinks
+        self.directory = tempfile.mkdtemp()
+        anomaly.snapshotPath = "{0}/anomaly.json".format(self.directory)
+        self.events = []
+        anomaly.sinks = [self.events.append]
+        anomaly._state = None
+
+    def tearDown(self):
+        """Remove scratch space."""
+        shutil.rmtree(self.directory)
+        anomaly.snapshotPath = self.snapshotPathOriginal
+        anomaly.sinks = self.sinksOriginal
+        anomaly._state = None
+
+    def _row(self, minute, **values):
+        """A network status row for ALF, minutes into 2014."""
+        datum = {
+            'symbol': 'ALF',
+            'scrape_time': datetime(2014, 1, 1) + timedelta(minutes=minute),
+            'current_blocks': long(1000 + minute),
+            'difficulty': 1.5 + (minute % 2) * 0.01,
+            'hash_rate': long(10000 + (minute % 3) * 100)
+        }
+        datum.update(values)
+        return datum
+
+    def testWelford(self):
+        """Test that early samples give the exact mean and variance."""
+        stats = [0, 0.0, 0.0]
+        for value in (2, 4, 4, 4, 5, 5, 7, 9):
+            anomaly._update(stats, value)
+        self.assertAlmostEqual(stats[1], 5)
+        self.assertAlmostEqual(stats[2], 4)
+
+    def testEvents(self):
+        """Test jumps, collapses and stalls, and the snapshot round trip."""
+        for minute in range(20):
+            self.assertEqual(anomaly.observe([self._row(minute)]), [])
+        anomaly.observe([self._row(20, difficulty=3.0)])
+        anomaly.observe([self._row(21, hash_rate=long(100))])
+        self.assertEqual(
+            [event['kind'] for event in self.events],
+            ['difficulty_jump', 'hash_rate_collapse'])
+
+        # Rows already seen are ignored
+        self.assertEqual(
+            anomaly.observe([self._row(21, hash_rate=long(1))]), [])
+
+        # Statistics survive a restart
+        anomaly.save()
+        anomaly._state = None
+        self.assertEqual(anomaly._load()['ALF']['difficulty'][0], 22)
+
+        # Stalls are raised once, on unchanged scrapes too, and clear
+        # when blocks advance
+        stalled = self._row(60, current_blocks=long(1021))
+        self.assertEqual(anomaly.observe([stalled]), [])
+        events = anomaly.checkStalls(
+            stalled['scrape_time'] + timedelta(hours=1))
+        self.assertEqual([event['kind'] for event in events],
+                         ['blocks_stalled'])
+        self.assertEqual(anomaly.checkStalls(
+            stalled['scrape_time'] + timedelta(hours=2)), [])
+        self.assertEqual(
+            [event['kind'] for event in anomaly.observe([self._row(200)])],
+            ['blocks_resumed'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Tests for the archive module. """
+import archive
+from datetime import datetime
+from datetime import timedelta
+import glob
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class ArchiveTest(unittest.TestCase):
+
+    """Testing suite for archive module."""
+
+    def setUp(self):
+        """Point the archive at a scratch directory."""
+        self.archiveDirOriginal = archive.archiveDir
+        self.segmentMaxBytesOriginal = archive.segmentMaxBytes
+        archive.archiveDir = tempfile.mkdtemp()
+        archive._lastRecords.clear()
+        f = io.open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(archive.__file__))), 'r',
+            encoding='utf-8')
+        self.jsonDump = f.read()
+        f.close()
+
+    def tearDown(self):
+        """Remove the scratch directory."""
+        shutil.rmtree(archive.archiveDir)
+        archive.archiveDir = self.archiveDirOriginal
+        archive.segmentMaxBytes = self.segmentMaxBytesOriginal
+        archive._lastRecords.clear()
+
+    def testAppendAndRead(self):
+        """Test that payloads round trip and repeats are stored once."""
+        start = datetime(2014, 1, 1)
+        other = self.jsonDump.replace(u"Alphacoin", u"Betacoin")
+        payloads = [self.jsonDump, self.jsonDump, other, self.jsonDump]
+        for index, payload in enumerate(payloads):
+            archive.append(payload, start + timedelta(minutes=index))
+        records = list(archive.iterRecords())
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0].offset, records[1].offset)
+        self.assertNotEqual(records[1].offset, records[3].offset)
+        self.assertEqual(
+            [payload for scrapeTime, payload in archive.iterPayloads()],
+            payloads)
+        self.assertEqual(archive.streams(), ["api"])
+
+    def testSeekAndRotate(self):
+        """Test time range reads across rotated segments."""
+        archive.segmentMaxBytes = 1
+        start = datetime(2014, 1, 1, 0, 0, 0, 250)
+        for index in range(10):
+            archive.append(
+                u"[{0}]".format(index), start + timedelta(hours=index))
+        self.assertEqual(len(glob.glob("{0}/api/segment_*.gz".format(
+            archive.archiveDir))), 10)
+        result = list(archive.iterPayloads(
+            start=start + timedelta(hours=3),
+            end=start + timedelta(hours=6)))
+        self.assertEqual(result, [
+            (start + timedelta(hours=index), u"[{0}]".format(index))
+            for index in range(3, 6)])
+
+        # A partially written index entry is ignored, then cut off
+        f = open(archive._indexPath("api"), 'ab')
+        f.write(b"\0" * 5)
+        f.close()
+        self.assertEqual(len(list(archive.iterRecords())), 10)
+        archive._lastRecords.clear()
+        archive.append(u"[10]", start + timedelta(hours=10))
+        self.assertEqual(
+            list(archive.iterPayloads(start=start + timedelta(hours=9)))[-1],
+            (start + timedelta(hours=10), u"[10]"))
+
+if __name__ == "__main__":
+    unittest.main()
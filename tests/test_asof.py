@@ -0,0 +1,140 @@
+""" Tests for the asof module. """
+import asof
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import pg
+import unittest
+
+
+class AsofTest(unittest.TestCase):
+
+    """Testing suite for asof module."""
+
+    def setUp(self):
+        """Setup tables for test."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(
+            (key, "{0}_test".format(table))
+            for key, table in self.tablesOriginal.items())
+        pg.clearCache()
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.connection.commit()
+
+    def tearDown(self):
+        """Teardown test tables."""
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.connection.commit()
+        pg.tables = self.tablesOriginal
+        pg.clearCache()
+
+    def testLookup(self):
+        """Test that the query and the index agree, and the index follows."""
+        start = datetime(2014, 1, 1)
+        for minute in range(3):
+            pg.insertLatestNetworkStatus([{
+                'symbol': symbol,
+                'scrape_time': start + timedelta(minutes=minute),
+                'current_blocks': long(1000 + (
+                    minute if symbol == 'GLC' else 0)),
+                'difficulty': Decimal(1),
+                'reward': Decimal(50),
+                'hash_rate': long(10),
+                'avg_hash_rate': Decimal(10)
+            } for symbol in ('ALF', 'GLC')])
+        pairs = [
+            ('ALF', start - timedelta(seconds=1)),
+            ('ALF', start + timedelta(hours=1)),
+            ('GLC', start + timedelta(seconds=90)),
+            ('GLC', start + timedelta(minutes=2)),
+            ('XXX', start),
+            ('GLC', start + timedelta(seconds=90))]
+        rows = asof.lookup(pairs)
+        self.assertEqual(rows[0], None)
+        self.assertEqual(rows[1]['scrape_time'], start)
+        self.assertEqual(rows[2]['current_blocks'], 1001)
+        self.assertEqual(rows[3]['current_blocks'], 1002)
+        self.assertEqual(rows[4], None)
+        self.assertEqual(rows[5], rows[2])
+
+        index = asof.Index()
+        index.watch()
+        try:
+            self.assertEqual(index.lookupMany(pairs), rows)
+            pg.insertLatestNetworkStatus([{
+                'symbol': 'GLC',
+                'scrape_time': start + timedelta(minutes=3),
+                'current_blocks': long(1003),
+                'difficulty': Decimal(1),
+                'reward': Decimal(50),
+                'hash_rate': long(10),
+                'avg_hash_rate': Decimal(10)
+            }])
+            self.assertTrue(index.stale)
+            self.assertEqual(index.lookup(
+                'GLC', start + timedelta(hours=1))['current_blocks'], 1003)
+            self.assertEqual(len(index.times['GLC']), 4)
+        finally:
+            index.unwatch()
+
+    def testLateRows(self):
+        """Test that refresh catches up symbols lagging behind the others."""
+        start = datetime(2014, 1, 1)
+        cur = pg.cursor()
+
+        def store(symbol, minutes):
+            for minute in minutes:
+                cur.execute("""INSERT INTO {0}
+                    (symbol, scrape_time, current_blocks)
+                    VALUES (%s, %s, %s)""".format(
+                    pg.tables['network_status']),
+                    (symbol, start + timedelta(minutes=minute),
+                     1000 + minute))
+            cur.connection.commit()
+        store('ALF', [0])
+        store('GLC', [0, 1, 2, 3])
+        index = asof.Index()
+        chosen = asof.Index(['ALF', 'XXX'])
+        self.assertEqual(index.refresh(), 5)
+        self.assertEqual(chosen.refresh(), 1)
+
+        # ALF's rows arrive after GLC's newer ones (a spool flush, say)
+        store('ALF', [1, 2])
+        store('XXX', [0])
+        store('YYY', [4])
+        self.assertEqual(index.refresh(), 3)
+        self.assertEqual(index.lookup(
+            'ALF', start + timedelta(minutes=5))['current_blocks'], 1002)
+        self.assertEqual(index.lookup('XXX', start), None)
+        self.assertEqual(sorted(index.times), ['ALF', 'GLC', 'YYY'])
+        self.assertEqual(chosen.refresh(), 3)
+        self.assertEqual(chosen.lookup('XXX', start)['current_blocks'], 1000)
+        self.assertEqual(index.refresh(), 0)
+
+    def testIndexOrder(self):
+        """Test that rows indexed out of order are still found."""
+        start = datetime(2014, 1, 1)
+        index = asof.Index()
+        index.stale = False
+        index._add([
+            {'symbol': 'ALF', 'scrape_time': start + timedelta(minutes=2),
+             'current_blocks': 3},
+            {'symbol': 'ALF', 'scrape_time': start, 'current_blocks': 1},
+            {'symbol': 'ALF', 'scrape_time': start + timedelta(minutes=1),
+             'current_blocks': 2}])
+        self.assertEqual(index.times['ALF'], [
+            start, start + timedelta(minutes=1),
+            start + timedelta(minutes=2)])
+        self.assertEqual(index.lookup(
+            'ALF', start + timedelta(seconds=90))['current_blocks'], 2)
+        self.assertEqual(index.lookup('ALF', start - timedelta(1)), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+""" Tests for the coinchoose module. """
+import archive
+import coinchoose
+from datetime import datetime
+from decimal import Decimal
+import json
+import os
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+
+
+class CoinchooseTest(unittest.TestCase):
+
+    """"Testing suite for coinchoose module."""
+
+    def testRequestLatest(self):
+        """Test requestLatest."""
+        jsonDump = coinchoose.requestLatest()
+        archive.append(jsonDump, name="test_api")
+        json.loads(jsonDump)
+
+    def testConditionalRequest(self):
+        """Test that a repeated request is revalidated with its ETag."""
+        seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                seen.append(self.headers.get('If-None-Match'))
+                if seen[-1] == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", '"v1"')
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"[]")
+
+            def log_message(self, format, *args):
+                pass
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        original = (coinchoose.baseUrl, coinchoose.requestRate,
+                    coinchoose.requestBurst)
+        coinchoose.baseUrl = "http://127.0.0.1:{0}".format(
+            server.server_address[1])
+        coinchoose.requestRate, coinchoose.requestBurst = 1000, 1000
+        try:
+            self.assertEqual(coinchoose.requestLatest(), u"[]")
+            self.assertEqual(coinchoose.requestLatest(), u"[]")
+        finally:
+            server.shutdown()
+            server.server_close()
+            coinchoose.baseUrl, coinchoose.requestRate, \
+                coinchoose.requestBurst = original
+            coinchoose._validators.clear()
+        self.assertEqual(seen, [None, '"v1"'])
+
+    def testParseLatestCurrencies(self):
+        """Method for testing parseLatestCurrencies."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(coinchoose.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data = coinchoose.parseLatestCurrencies(jsonDump)
+        self.assertEqual(len(data), 59)
+        expectedFirst = {
+            'symbol': 'ALF',
+            'name': 'Alphacoin',
+            'algo': 'scrypt'
+        }
+        self.assertEqual(data[0], expectedFirst)
+        expectedLast = {
+            'symbol': 'GLC',
+            'name': 'GlobalCoin',
+            'algo': 'scrypt'
+        }
+        self.assertEqual(data[-1], expectedLast)
+
+    def testParseLatestNetworkStatus(self):
+        """Method for testing parseLatestNetworkStatus."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(coinchoose.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        data = coinchoose.parseLatestNetworkStatus(jsonDump, scrapeTime=now)
+        self.assertEqual(len(data), 59)
+        expectedFirst = {
+            'symbol': 'ALF',
+            'scrape_time': now,
+            'current_blocks': long(655258),
+            'difficulty': Decimal("1.52109832"),
+            'reward': Decimal(50),
+            'hash_rate': long(10308452),
+            'avg_hash_rate': Decimal("10308452.0000")
+        }
+        self.assertEqual(data[0], expectedFirst)
+        expectedLast = {
+            'symbol': 'GLC',
+            'scrape_time': now,
+            'current_blocks': long(300011),
+            'difficulty': Decimal("0.768"),
+            'reward': Decimal(100),
+            'hash_rate': long(0),
+            'avg_hash_rate': Decimal("0")
+        }
+        self.assertEqual(data[-1], expectedLast)
+
+    def testParseLatest(self):
+        """Method for testing parseLatest."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(coinchoose.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        currencies, networkStatus = coinchoose.parseLatest(
+            jsonDump, scrapeTime=now)
+        self.assertEqual(
+            currencies, coinchoose.parseLatestCurrencies(jsonDump))
+        self.assertEqual(
+            networkStatus,
+            coinchoose.parseLatestNetworkStatus(jsonDump, scrapeTime=now))
+        self.assertEqual(coinchoose.parseLatest("[ ]"), ([], []))
+        for rawDatum in coinchoose.iterRecords(jsonDump):
+            self.assertFalse([key for key in rawDatum if key.isdigit()])
+
+    def testParseLatestBatch(self):
+        """Method for testing parseLatestBatch."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(coinchoose.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        expected = coinchoose.parseLatestNetworkStatus(
+            jsonDump, scrapeTime=now)
+        batch = coinchoose.parseLatestBatch(jsonDump, scrapeTime=now)
+        self.assertEqual(len(batch), 59)
+        self.assertEqual(list(batch), expected)
+        self.assertEqual(list(batch.retimed(now)), expected)
+        self.assertEqual(
+            batch.column('current_blocks'),
+            [datum['current_blocks'] for datum in expected])
+        self.assertEqual(batch.floatColumn('difficulty')[0], 1.52109832)
+        self.assertEqual(batch.floatColumn('hash_rate')[-1], 0.0)
+        self.assertTrue(
+            batch.symbols[0] is
+            coinchoose.parseLatestBatch(jsonDump).symbols[0])
+
+        # Selecting and extending keep rows and columns aligned
+        picked = batch.select([2, 0])
+        self.assertEqual(list(picked), [expected[2], expected[0]])
+        picked.extend(batch.select([5]))
+        self.assertEqual(
+            list(picked), [expected[2], expected[0], expected[5]])
+        self.assertEqual(list(batch.select([])), [])
+        self.assertEqual(len(batch), 59)
+
+        # Floats only, with nulls and integers beyond 64 bits
+        batch = coinchoose.NetworkStatusBatch(scrapeTime=now, exact=False)
+        batch.append({
+            'symbol': 'BTC', 'currentBlocks': None, 'difficulty': "0.5",
+            'reward': None, 'networkhashrate': str(pow(10, 21)),
+            'avgHash': 0})
+        self.assertEqual(list(batch), [{
+            'symbol': 'BTC',
+            'scrape_time': now,
+            'current_blocks': None,
+            'difficulty': 0.5,
+            'reward': None,
+            'hash_rate': pow(10, 21),
+            'avg_hash_rate': 0.0
+        }])
+        other = coinchoose.NetworkStatusBatch(scrapeTime=now, exact=False)
+        other.append({
+            'symbol': 'LTC', 'currentBlocks': 5, 'difficulty': "2",
+            'reward': "50", 'networkhashrate': 7, 'avgHash': None})
+        other.extend(batch)
+        self.assertEqual(other.column('hash_rate'), [7, pow(10, 21)])
+        self.assertEqual(other.column('avg_hash_rate'), [None, 0.0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+""" Tests for the export module. """
+from datetime import datetime
+from datetime import timedelta
+import export
+import os
+import pg
+import shutil
+import struct
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ExportTest(unittest.TestCase):
+
+    """Testing suite for export module."""
+
+    def setUp(self):
+        """Point the export at a scratch directory."""
+        self.exportDirOriginal = export.exportDir
+        export.exportDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the scratch directory."""
+        shutil.rmtree(export.exportDir)
+        export.exportDir = self.exportDirOriginal
+
+    def testCopyWriter(self):
+        """Test that COPY output lands in appendable partitions."""
+        day = 1388534400000000
+        hour = 3600000000
+        writer = export._CopyWriter()
+        text = u"ALF\t{0}\t655258\t1.5\t50\t10308452\t\\N\n" \
+            u"ALF\t{1}\t\\N\t1.75\t50\t10308452\t12.5\n" \
+            u"ALF\t{2}\t655260\t2\t50\t0\t0\n" \
+            u"GLC\t{0}\t300011\t0.768\t100\t0\t0\n".format(
+                day, day + hour, day + 24 * hour)
+        writer.write(text[:20].encode('utf-8'))
+        writer.write(text[20:])
+        writer.flush()
+        self.assertEqual(writer.rows, 4)
+        self.assertEqual(writer.last, {
+            u"ALF": day + 24 * hour, u"GLC": day})
+        partitions = [(symbol, str(date)) for symbol, date, path
+                      in export.iterPartitions()]
+        self.assertEqual(partitions, [
+            ("ALF", "2014-01-01"), ("ALF", "2014-01-02"),
+            ("GLC", "2014-01-01")])
+
+        # Appending to an existing partition grows the columns in place
+        writer = export._CopyWriter()
+        writer.write(u"ALF\t{0}\t655259\t1.75\t50\t1\t1\n".format(
+            day + 2 * hour))
+        writer.flush()
+        path = export._partitionPath("ALF", datetime(2014, 1, 1).date())
+        f = open("{0}/current_blocks.npy".format(path), 'rb')
+        self.assertEqual(export._rowCount(f), 3)
+        f.seek(export._headerSize)
+        self.assertEqual(
+            struct.unpack("<3q", f.read()),
+            (655258, export.nullInteger, 655259))
+        f.close()
+        if numpy is not None:
+            data = export.openPartition(path)
+            self.assertEqual(list(data['difficulty']), [1.5, 1.75, 1.75])
+            self.assertTrue(numpy.isnan(data['avg_hash_rate'][0]))
+
+    def testRollBack(self):
+        """Test that an interrupted export leaves no partial partitions."""
+        day = 1388534400000000
+        hour = 3600000000
+        writer = export._CopyWriter()
+        writer.write(u"ALF\t{0}\t655258\t1.5\t50\t10308452\t\\N\n".format(
+            day))
+        writer.flush()
+        export._writeState({u"ALF": day})
+        path = export._partitionPath("ALF", datetime(2014, 1, 1).date())
+
+        # Fail partway through the columns of the second partition
+        appendColumnOriginal = export._appendColumn
+        calls = []
+
+        def failingAppend(*args):
+            calls.append(args)
+            if len(calls) == len(export.columns) + 2:
+                raise IOError("disk full")
+            appendColumnOriginal(*args)
+        export._appendColumn = failingAppend
+        try:
+            journal = export._Journal({u"ALF": day})
+            writer = export._CopyWriter(journal)
+            writer.write(
+                u"ALF\t{0}\t655259\t1.5\t50\t1\t1\n"
+                u"GLC\t{0}\t300011\t0.768\t100\t0\t0\n".format(
+                    day + hour))
+            self.assertRaises(IOError, writer.flush)
+            journal.close()
+        finally:
+            export._appendColumn = appendColumnOriginal
+        self.assertEqual(export._columnRows(
+            "{0}/scrape_time.npy".format(path)), 2)
+        export._rollBack()
+        for column, descr in export.columns:
+            self.assertEqual(export._columnRows(
+                "{0}/{1}.npy".format(path, column)), 1)
+        self.assertEqual(
+            [symbol for symbol, date, partition in export.iterPartitions()],
+            ["ALF"])
+        self.assertFalse(os.path.exists(export._journalPath()))
+
+        # Once the state has moved on the export is kept
+        journal = export._Journal({u"ALF": day})
+        writer = export._CopyWriter(journal)
+        writer.write(u"ALF\t{0}\t655259\t1.5\t50\t1\t1\n".format(
+            day + hour))
+        writer.flush()
+        journal.close()
+        export._writeState({u"ALF": day + hour})
+        export._rollBack()
+        self.assertEqual(export._columnRows(
+            "{0}/difficulty.npy".format(path)), 2)
+        self.assertFalse(os.path.exists(export._journalPath()))
+
+    def testLateRows(self):
+        """Test that rows stored after newer ones of other symbols follow."""
+        tablesOriginal = pg.tables
+        pg.tables = dict(
+            (key, "{0}_test".format(table))
+            for key, table in tablesOriginal.items())
+        cur = pg.cursor()
+        cur.execute("""CREATE TABLE IF NOT EXISTS
+            {0} (LIKE {1} INCLUDING ALL)""".format(
+            pg.tables['network_status'], tablesOriginal['network_status']))
+        cur.connection.commit()
+        start = datetime(2014, 1, 1)
+
+        def store(symbol, minutes):
+            for minute in minutes:
+                cur.execute("""INSERT INTO {0}
+                    (symbol, scrape_time, current_blocks)
+                    VALUES (%s, %s, %s)""".format(
+                    pg.tables['network_status']),
+                    (symbol, start + timedelta(minutes=minute),
+                     1000 + minute))
+            cur.connection.commit()
+        try:
+            store('ALF', [0])
+            store('GLC', [0, 1, 2])
+            self.assertEqual(export.export(), 4)
+
+            # ALF's rows arrive after GLC's newer ones (a spool flush, say)
+            store('ALF', [1, 2])
+            store('XXX', [3])
+            self.assertEqual(export.export(), 3)
+            self.assertEqual(export.export(), 0)
+        finally:
+            cur.execute("""DROP TABLE IF EXISTS {0}""".format(
+                pg.tables['network_status']))
+            cur.connection.commit()
+            pg.tables = tablesOriginal
+        path = export._partitionPath("ALF", start.date())
+        self.assertEqual(export._columnRows(
+            "{0}/current_blocks.npy".format(path)), 3)
+
+if __name__ == "__main__":
+    unittest.main()
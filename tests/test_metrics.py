@@ -0,0 +1,62 @@
+""" Tests for the metrics module. """
+import json
+import metrics
+import shutil
+import tempfile
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+
+    """Testing suite for metrics module."""
+
+    def setUp(self):
+        """Point the metrics at a scratch directory."""
+        self.metricsDirOriginal = metrics.metricsDir
+        metrics.metricsDir = tempfile.mkdtemp()
+        metrics.reset()
+
+    def tearDown(self):
+        """Remove the scratch directory."""
+        shutil.rmtree(metrics.metricsDir)
+        metrics.metricsDir = self.metricsDirOriginal
+        metrics.reset()
+
+    def testScrapeRecord(self):
+        """Test that a scrape's stages and counts are exported."""
+        metrics.increment("rows_received_total", 5, kind="network_status")
+        metrics.startScrape()
+        with metrics.timer("parse"):
+            metrics.increment("rows_received_total", 59, kind="network_status")
+        metrics.increment("http_responses_total", status=200)
+        record = metrics.finishScrape()
+        self.assertEqual(record['success'], True)
+        self.assertEqual(list(record['stages']), ["parse"])
+        self.assertEqual(
+            record['counts']['rows_received_total{kind="network_status"}'],
+            59)
+        text = metrics.prometheusText()
+        self.assertTrue(
+            'coinchoose_rows_received_total{kind="network_status"} 64.0'
+            in text)
+        self.assertTrue(
+            "# TYPE coinchoose_http_responses_total counter" in text)
+        self.assertTrue(
+            'coinchoose_last_scrape_stage_seconds{stage="parse"}' in text)
+        f = open(metrics.textfilePath(), 'r')
+        self.assertEqual(f.read(), text)
+        f.close()
+        f = open(metrics.jsonPath(), 'r')
+        self.assertEqual(json.loads(f.readline())['counts'],
+                         record['counts'])
+        f.close()
+
+        # Stages from the previous scrape are not carried over
+        metrics.startScrape()
+        self.assertEqual(metrics.finishScrape(success=False)['stages'], {})
+        self.assertFalse('stage="parse"}' in "".join(
+            line for line in metrics.prometheusText().splitlines()
+            if line.startswith("coinchoose_last_scrape_stage")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,542 @@
+""" Tests for the pg module. """
+import coinchoose
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import os
+import pg
+import psycopg2 as pg2
+import unittest
+
+
+class PgTest(unittest.TestCase):
+
+    """Testing suite for pg module."""
+
+    def setUp(self):
+        """Setup tables for test."""
+        # Swap and sub configuration variables
+        self.tablesOriginal = pg.tables
+        pg.tables = {}
+        for key, table in self.tablesOriginal.iteritems():
+            pg.tables[key] = "{0}_test".format(table)
+        self.batchLimitOriginal = pg.batchLimit
+        pg.batchLimit = 20
+        pg.clearCache()
+
+        # Create test tables
+        cur = pg.cursor()
+        for key, table in pg.tables.iteritems():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.connection.commit()
+
+    def tearDown(self):
+        """Teardown test tables."""
+        # Drop test tables
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.connection.commit()
+
+        # Undo swap / sub
+        pg.tables = self.tablesOriginal
+        pg.batchLimit = self.batchLimitOriginal
+        pg.clearCache()
+
+    def testLoadStaging(self):
+        """Test that both load modes fill staging identically."""
+        now = datetime.utcnow()
+        data = [
+            {
+                'symbol': u'A\tB\\C',
+                'scrape_time': now,
+                'current_blocks': long(index),
+                'difficulty': Decimal("1.5"),
+                'reward': None,
+                'hash_rate': index / 3.0,
+                'avg_hash_rate': Decimal("0.25")
+            } for index in range(pg.batchLimit * 2 + 1)]
+        cur = pg.dictCursor()
+        loadModeOriginal = pg.loadMode
+        contents = []
+        try:
+            for mode in ("insert", "copy"):
+                pg.loadMode = mode
+                stagingTable = pg._staging(pg.tables['network_status'], cur)
+                pg._loadStaging(
+                    stagingTable, pg.networkStatusColumns, data, cur)
+                cur.execute("""SELECT {0}
+                    FROM {1}
+                    ORDER BY current_blocks""".format(
+                    ", ".join(pg.networkStatusColumns), stagingTable))
+                contents.append(cur.fetchall())
+                cur.connection.rollback()
+        finally:
+            pg.loadMode = loadModeOriginal
+        self.assertEqual(len(contents[1]), len(data))
+        self.assertEqual(contents[0], contents[1])
+
+    def testInsertLatestCurrencies(self):
+        """Test insertLatestCurrencies function."""
+        fileString = "{0}/example/api.json"
+        f = open(fileString.format(
+            os.path.dirname(os.path.abspath(pg.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data = coinchoose.parseLatestCurrencies(jsonDump)
+        pg.insertLatestCurrencies(data)
+
+        # Test out some basic count statistics
+        cur = pg.dictCursor()
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 59)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency_historical']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 59)
+
+        # Test out contents of first and last row
+        expectedFirst = {
+            'symbol': 'ALF',
+            'name': 'Alphacoin',
+            'algo': 'scrypt'
+        }
+        cur.execute("""SELECT symbol, name, algo
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['currency'], 'ALF'))
+        datumFirst = cur.fetchone()
+        self.assertEqual(datumFirst, expectedFirst)
+        expectedLast = {
+            'symbol': 'GLC',
+            'name': 'GlobalCoin',
+            'algo': 'scrypt'
+        }
+        cur.execute("""SELECT symbol, name, algo
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['currency'], 'GLC'))
+        datumLast = cur.fetchone()
+        self.assertEqual(datumLast, expectedLast)
+
+        # Update the data in a way that modifies what's in the DB
+        updatedData = [
+            {
+                'symbol': 'ALF',
+                'name': 'XXAlphacoinXX',
+                'algo': 'scrypt'
+            },
+            {
+                'symbol': 'GLC',
+                'name': 'GlobalCoin',
+                'algo': 'SHA-256'
+            }
+        ]
+        pg.insertLatestCurrencies(updatedData)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 59)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency_historical']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 61)
+        cur.execute("""SELECT symbol, name, algo
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['currency'], 'ALF'))
+        newDatumFirst = cur.fetchone()
+        self.assertEqual(newDatumFirst, updatedData[0])
+        cur.execute("""SELECT symbol, name, algo
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['currency'], 'GLC'))
+        newDatumFirst = cur.fetchone()
+        self.assertEqual(newDatumFirst, updatedData[1])
+
+    def testInsertLatestNetworkStatus(self):
+        """Test insertLatestNetworkStatus function."""
+        fileString = "{0}/example/api.json"
+        f = open(fileString.format(
+            os.path.dirname(os.path.abspath(pg.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        data = coinchoose.parseLatestNetworkStatus(jsonDump, scrapeTime=now)
+        pg.insertLatestNetworkStatus(data)
+
+        # Test out some basic count statistics
+        cur = pg.dictCursor()
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 59)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status_latest']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 59)
+
+        # Test out contents of first and last row
+        expectedFirst = {
+            'symbol': 'ALF',
+            'scrape_time': now,
+            'current_blocks': long(655258),
+            'difficulty': Decimal("1.52109832"),
+            'reward': Decimal(50),
+            'hash_rate': long(10308452),
+            'avg_hash_rate': Decimal("10308452.0000")
+        }
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status'], 'ALF'))
+        datumFirst = cur.fetchone()
+        self.assertEqual(datumFirst, expectedFirst)
+        expectedLast = {
+            'symbol': 'GLC',
+            'scrape_time': now,
+            'current_blocks': long(300011),
+            'difficulty': Decimal("0.768"),
+            'reward': Decimal(100),
+            'hash_rate': long(0),
+            'avg_hash_rate': Decimal("0")
+        }
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status'], 'GLC'))
+        datumLast = cur.fetchone()
+        self.assertEqual(datumLast, expectedLast)
+
+        # Update the data in a way that modifies some of  what's in the DB
+        updatedData = [
+            {
+                'symbol': 'ALF',
+                'scrape_time': now + timedelta(days=1),
+                'current_blocks': long(655258),
+                'difficulty': Decimal("1.52109832"),
+                'reward': Decimal(50),
+                'hash_rate': long(10308452),
+                'avg_hash_rate': Decimal("10308452.0000")
+            },
+            {
+                'symbol': 'GLC',
+                'scrape_time': now + timedelta(days=1),
+                'current_blocks': long(300155),
+                'difficulty': Decimal("1.234"),
+                'reward': Decimal(100),
+                'hash_rate': long(20),
+                'avg_hash_rate': Decimal("20.34")
+            }
+        ]
+        pg.insertLatestNetworkStatus(updatedData)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 60)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status_latest']))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 2)
+
+        cur.execute("""SELECT COUNT(*) cnt
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status'], 'ALF'))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 1)
+        cur.execute("""SELECT COUNT(*) cnt
+            FROM {0}
+            WHERE symbol ='{1}'""".format(
+            pg.tables['network_status'], 'GLC'))
+        row = cur.fetchone()
+        self.assertEqual(row['cnt'], 2)
+
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status'], 'ALF'))
+        newDatumFirst = cur.fetchone()
+        self.assertEqual(newDatumFirst, expectedFirst)
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'
+            ORDER BY scrape_time
+            DESC LIMIT 1""".format(
+            pg.tables['network_status'], 'GLC'))
+        newDatumLast = cur.fetchone()
+        self.assertEqual(newDatumLast, updatedData[-1])
+
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status_latest'], 'ALF'))
+        newDatumFirst = cur.fetchone()
+        self.assertEqual(newDatumFirst, updatedData[0])
+        cur.execute("""SELECT
+                symbol, scrape_time, current_blocks, difficulty,
+                reward, hash_rate, avg_hash_rate
+            FROM {0}
+            WHERE symbol = '{1}'""".format(
+            pg.tables['network_status_latest'], 'GLC'))
+        newDatumLast = cur.fetchone()
+        self.assertEqual(newDatumLast, updatedData[-1])
+
+    def testInPlaceLatest(self):
+        """Test that only changed values in the latest table are rewritten."""
+        now = datetime.utcnow()
+        data = [{
+            'symbol': symbol,
+            'scrape_time': now,
+            'current_blocks': long(1000),
+            'difficulty': Decimal(1),
+            'reward': Decimal(50),
+            'hash_rate': long(10),
+            'avg_hash_rate': long(10)
+        } for symbol in ('ALF', 'GLC', 'XXX')]
+        pg.insertLatestNetworkStatus(data)
+        cur = pg.dictCursor()
+        query = """SELECT symbol, scrape_time, current_blocks,
+                xmin::text AS version
+            FROM {0}""".format(pg.tables['network_status_latest'])
+
+        # Without the change cache every row is staged again; only GLC
+        # changes, XXX has left the feed and ALF just moves on
+        later = now + timedelta(minutes=1)
+        pg.clearCache()
+        data = [dict(datum, scrape_time=later) for datum in data[:2]]
+        data[1]['current_blocks'] += 1
+        pg.insertLatestNetworkStatus(data)
+        cur.execute(query)
+        before = dict((row['symbol'], row) for row in cur)
+        cur.connection.commit()
+        self.assertEqual(sorted(before), ['ALF', 'GLC'])
+        self.assertEqual(before['ALF']['scrape_time'], later)
+        self.assertEqual(before['GLC']['current_blocks'], 1001)
+
+        # Staging the same scrape again rewrites nothing
+        pg.clearCache()
+        pg.insertLatestNetworkStatus(data)
+        cur.execute(query)
+        after = dict((row['symbol'], row['version']) for row in cur)
+        cur.connection.commit()
+        self.assertEqual(after, dict(
+            (symbol, row['version']) for symbol, row in before.items()))
+
+    def testDuplicateSymbols(self):
+        """Test that a batch naming a symbol twice keeps its newest row."""
+        pg.insertLatestCurrencies([
+            {'symbol': 'ALF', 'name': 'Alphacoin', 'algo': 'sha256'},
+            {'symbol': 'ALF', 'name': 'Alphacoin', 'algo': 'scrypt'}])
+        now = datetime.utcnow()
+        later = now + timedelta(minutes=1)
+        pg.insertLatestNetworkStatus([{
+            'symbol': 'ALF',
+            'scrape_time': at,
+            'current_blocks': long(blocks),
+            'difficulty': Decimal(1),
+            'reward': Decimal(50),
+            'hash_rate': long(10),
+            'avg_hash_rate': long(10)
+        } for at, blocks in ((later, 1001), (now, 1000))])
+        cur = pg.dictCursor()
+        cur.execute("""SELECT algo FROM {0}""".format(
+            pg.tables['currency']))
+        self.assertEqual([row['algo'] for row in cur], ['scrypt'])
+        cur.execute("""SELECT scrape_time, current_blocks FROM {0}""".format(
+            pg.tables['network_status_latest']))
+        self.assertEqual(
+            [(row['scrape_time'], row['current_blocks']) for row in cur],
+            [(later, 1001)])
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        self.assertEqual(cur.fetchone()['cnt'], 2)
+        cur.connection.commit()
+
+    def testChangeCache(self):
+        """Test that cached rows are skipped and stale entries recovered."""
+        fileString = "{0}/example/api.json"
+        f = open(fileString.format(
+            os.path.dirname(os.path.abspath(pg.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        currencies, data = coinchoose.parseLatest(jsonDump, scrapeTime=now)
+        pg.insertLatestCurrencies(currencies)
+        pg.insertLatestNetworkStatus(data)
+
+        # A repeat scrape is answered entirely from the cache
+        hits = pg.cacheStats['hits']
+        later = now + timedelta(minutes=1)
+        for datum in data:
+            datum['scrape_time'] = later
+        pg.insertLatestCurrencies(currencies)
+        pg.insertLatestNetworkStatus(data)
+        self.assertEqual(pg.cacheStats['hits'] - hits, 2 * len(data))
+        cur = pg.dictCursor()
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        self.assertEqual(cur.fetchone()['cnt'], 59)
+        cur.execute("""SELECT COUNT(*) cnt
+            FROM {0}
+            WHERE scrape_time = %s""".format(
+            pg.tables['network_status_latest']), (later,))
+        self.assertEqual(cur.fetchone()['cnt'], 59)
+
+        # Change the database behind the cache's back
+        cur.execute("""UPDATE {0}
+            SET difficulty = 0
+            WHERE symbol = 'ALF'""".format(pg.tables['network_status_latest']))
+        cur.execute("""DELETE FROM {0}
+            WHERE symbol = 'GLC'""".format(pg.tables['currency']))
+        cur.connection.commit()
+        stale = pg.cacheStats['stale']
+        pg.insertLatestCurrencies(currencies)
+        pg.insertLatestNetworkStatus(data)
+        self.assertEqual(pg.cacheStats['stale'] - stale, 2)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        self.assertEqual(cur.fetchone()['cnt'], 60)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency']))
+        self.assertEqual(cur.fetchone()['cnt'], 59)
+
+    def testInsertBatch(self):
+        """Test that batches reach the staging table still column-wise."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(pg.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        batch = coinchoose.parseLatestBatch(jsonDump, scrapeTime=now)
+        staged = []
+        copyRowsOriginal = pg._copyRows
+
+        def copyRows(stagingTable, columns, data, cursor):
+            staged.append(data)
+            return copyRowsOriginal(stagingTable, columns, data, cursor)
+        pg._copyRows = copyRows
+        try:
+            pg.insertLatestNetworkStatus(batch)
+
+            # Only the row changed behind the cache's back is staged again
+            cur = pg.dictCursor()
+            cur.execute("""UPDATE {0}
+                SET difficulty = 0
+                WHERE symbol = 'ALF'""".format(
+                pg.tables['network_status_latest']))
+            cur.connection.commit()
+            hits = pg.cacheStats['hits']
+            pg.insertLatestNetworkStatus(
+                batch.retimed(now + timedelta(minutes=1)))
+            self.assertEqual(pg.cacheStats['hits'] - hits, 59)
+        finally:
+            pg._copyRows = copyRowsOriginal
+        self.assertEqual(
+            [type(data) for data in staged],
+            [coinchoose.NetworkStatusBatch] * 2)
+        self.assertEqual([len(data) for data in staged], [59, 1])
+        self.assertEqual(staged[1].symbols, ['ALF'])
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        self.assertEqual(cur.fetchone()['cnt'], 60)
+        cur.execute("""SELECT COUNT(*) cnt
+            FROM {0}
+            WHERE scrape_time = %s""".format(
+            pg.tables['network_status_latest']),
+            (now + timedelta(minutes=1),))
+        self.assertEqual(cur.fetchone()['cnt'], 59)
+        cur.connection.commit()
+
+        # An inexact batch hits the cache warmed from the stored Decimals
+        pg.clearCache()
+        batch = coinchoose.parseLatestBatch(
+            jsonDump, scrapeTime=now + timedelta(minutes=2), exact=False)
+        hits = pg.cacheStats['hits']
+        pg.insertLatestNetworkStatus(batch)
+        self.assertEqual(pg.cacheStats['hits'] - hits, 59)
+
+    def testPartitionHelpers(self):
+        """Test the month arithmetic behind partition management."""
+        month = pg._monthStart(datetime(2014, 11, 30, 23, 59))
+        self.assertEqual(month, datetime(2014, 11, 1))
+        self.assertEqual(pg._addMonths(month, 2), datetime(2015, 1, 1))
+        self.assertEqual(pg._addMonths(month, -11), datetime(2013, 12, 1))
+        self.assertEqual(
+            pg._partitionName("network_status", month),
+            "network_status_p201411")
+        # The unpartitioned test tables are left alone
+        self.assertEqual(pg.ensurePartitions([datetime.utcnow()]), [])
+        pg.cursor().connection.rollback()
+
+    def testPreparedStatements(self):
+        """Test that merge statements are prepared once per connection."""
+        fileString = "{0}/example/api.json"
+        f = open(fileString.format(
+            os.path.dirname(os.path.abspath(pg.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        now = datetime.utcnow()
+        currencies, data = coinchoose.parseLatest(jsonDump, scrapeTime=now)
+        cur = pg.dictCursor()
+        prepared = []
+        for minute in range(3):
+            for datum in data:
+                datum['scrape_time'] = now + timedelta(minutes=minute)
+            data[0]['current_blocks'] += 1
+            pg.insertLatestCurrencies(currencies)
+            pg.insertLatestNetworkStatus(data)
+            cur.execute("""SELECT name FROM pg_prepared_statements""")
+            prepared.append(set(row['name'] for row in cur))
+            cur.connection.commit()
+
+        # Later scrapes reuse the statements already prepared
+        self.assertTrue(pg._resolve('merge_network_status')[1] in prepared[0])
+        self.assertTrue(
+            pg._resolve('touch_network_status_latest')[1] in prepared[1])
+        self.assertEqual(prepared[1], prepared[2])
+        self.assertTrue(
+            pg._resolve('merge_currency')[0].find(pg.tables['currency']) >= 0)
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['network_status']))
+        self.assertEqual(cur.fetchone()['cnt'], 61)
+        cur.connection.commit()
+
+    def testReconnect(self):
+        """Test that a transaction survives losing its connection."""
+        data = [{'symbol': 'ALF', 'name': 'Alphacoin', 'algo': 'scrypt'}]
+        retries = pg.poolStats['retries']
+        # Kill this thread's connection from another session, so it still
+        # looks open until the next statement fails
+        other = pg2.connect(**pg.connectionParams())
+        other.cursor().execute("""SELECT pg_terminate_backend(%s)""", (
+            pg.connect().get_backend_pid(),))
+        other.close()
+        pg.insertLatestCurrencies(data)
+        self.assertEqual(pg.poolStats['retries'] - retries, 1)
+        cur = pg.dictCursor()
+        cur.execute("""SELECT COUNT(*) cnt FROM {0}""".format(
+            pg.tables['currency']))
+        self.assertEqual(cur.fetchone()['cnt'], 1)
+        cur.connection.commit()
+        stats = pg.poolStatistics()
+        self.assertTrue(stats['in_use'] >= 1)
+        self.assertTrue(stats['open'] <= pg.poolSize)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+""" Tests for the query module. """
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import pg
+import query
+import threading
+import unittest
+
+
+class QueryTest(unittest.TestCase):
+
+    """Testing suite for query module."""
+
+    def setUp(self):
+        """Setup tables for test."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(
+            (key, "{0}_test".format(table))
+            for key, table in self.tablesOriginal.items())
+        pg.clearCache()
+        query.cache.clear()
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.connection.commit()
+
+    def tearDown(self):
+        """Teardown test tables."""
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.connection.commit()
+        pg.tables = self.tablesOriginal
+        pg.clearCache()
+        query.cache.clear()
+
+    def testCache(self):
+        """Test LRU eviction and invalidation by dependency."""
+        lru = query._Cache(2, 60)
+        lru.put("a", 1, [("status", "ALF")])
+        lru.put("b", 2, [("status", "GLC")])
+        self.assertEqual(lru.get("a"), 1)
+        lru.put("c", 3, [("status", "GLC")])
+        self.assertEqual(lru.get("b"), None)
+        lru.invalidate([("status", "GLC")])
+        self.assertEqual(lru.get("c"), None)
+        self.assertEqual(lru.get("a"), 1)
+        lru.ttl = -1
+        lru.put("a", 1, [])
+        self.assertEqual(lru.get("a"), None)
+
+    def testInvalidation(self):
+        """Test that inserts invalidate only the symbols they change."""
+        now = datetime(2014, 1, 1)
+        data = [{
+            'symbol': symbol,
+            'scrape_time': now,
+            'current_blocks': long(1000),
+            'difficulty': Decimal(1),
+            'reward': Decimal(50),
+            'hash_rate': long(10),
+            'avg_hash_rate': Decimal(10)
+        } for symbol in ('ALF', 'GLC')]
+        pg.insertLatestCurrencies([
+            {'symbol': 'ALF', 'name': 'Alphacoin', 'algo': 'scrypt'},
+            {'symbol': 'GLC', 'name': 'GlobalCoin', 'algo': 'scrypt'}])
+        pg.insertLatestNetworkStatus(data)
+        self.assertEqual(
+            [row['symbol'] for row in query.latestByAlgo('scrypt')],
+            ['ALF', 'GLC'])
+        self.assertEqual(
+            query.latestBySymbol(
+                ['ALF', 'GLC', 'XXX'])['ALF']['current_blocks'],
+            1000)
+
+        # Change GLC only: ALF stays cached with a new scrape time
+        later = now + timedelta(minutes=1)
+        data = [dict(datum, scrape_time=later) for datum in data]
+        data[1]['current_blocks'] += 1
+        pg.insertLatestNetworkStatus(data)
+        misses = query.cache.stats['misses']
+        latest = query.latestBySymbol(['ALF', 'GLC', 'XXX'])
+        self.assertEqual(query.cache.stats['misses'] - misses, 1)
+        self.assertEqual(latest['ALF']['scrape_time'], later)
+        self.assertEqual(latest['GLC']['current_blocks'], 1001)
+        self.assertFalse('XXX' in latest)
+        self.assertEqual(
+            query.latestByAlgo('scrypt')[1]['current_blocks'], 1001)
+        self.assertEqual(
+            [row['samples'] for row in query.history(
+                'GLC', now, now + timedelta(hours=1),
+                step=timedelta(hours=1))],
+            [2])
+        self.assertEqual(len(query.history('ALF', now, later)), 1)
+
+    def testReaderThreads(self):
+        """Test that reader threads give their connections back."""
+        poolSize, poolTimeout = pg.poolSize, pg.poolTimeout
+        inUse = pg.poolStatistics()['in_use']
+        pg.poolSize, pg.poolTimeout = inUse + 1, 1
+        failures = []
+
+        def read():
+            try:
+                query.cache.clear()
+                query.latestBySymbol()
+            except Exception as e:
+                failures.append(e)
+        try:
+            for attempt in range(pg.poolSize + 2):
+                reader = threading.Thread(target=read)
+                reader.start()
+                reader.join()
+        finally:
+            pg.poolSize, pg.poolTimeout = poolSize, poolTimeout
+        self.assertEqual(failures, [])
+        self.assertEqual(pg.poolStatistics()['in_use'], inUse)
+
+if __name__ == "__main__":
+    unittest.main()
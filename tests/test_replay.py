@@ -0,0 +1,110 @@
+""" Tests for the replay module. """
+import archive
+import coinchoose
+from datetime import datetime
+import os
+import replay
+import shutil
+import tempfile
+import unittest
+
+
+class ReplayTest(unittest.TestCase):
+
+    """Testing suite for replay module."""
+
+    def setUp(self):
+        """Point the data and archive directories at scratch space."""
+        self.dataDirOriginal = replay.dataDir
+        self.archiveDirOriginal = archive.archiveDir
+        replay.dataDir = tempfile.mkdtemp()
+        archive.archiveDir = "{0}/archive".format(replay.dataDir)
+        archive._lastRecords.clear()
+
+    def tearDown(self):
+        """Remove scratch space."""
+        shutil.rmtree(replay.dataDir)
+        replay.dataDir = self.dataDirOriginal
+        archive.archiveDir = self.archiveDirOriginal
+        archive._lastRecords.clear()
+
+    def testDiscover(self):
+        """Test that files and archive entries are found in time order."""
+        for epoch in (1388534400, 1388534520):
+            f = open("{0}/api_{1}.json".format(replay.dataDir, epoch), 'w')
+            f.write("[]")
+            f.close()
+        f = open("{0}/api_LTC_1388534460.json".format(replay.dataDir), 'w')
+        f.write("[]")
+        f.close()
+        archive.append(u"[]", datetime(2014, 1, 1, 0, 1))
+        archive.append(u"[]", datetime(2014, 1, 1, 0, 3))
+        archive.append(u"[]", datetime(2014, 1, 1, 0, 4))
+        sources = replay.discover()
+        self.assertEqual(
+            [(kind, scrapeTime) for kind, scrapeTime, location in sources], [
+                ("file", datetime(2014, 1, 1, 0, 0)),
+                ("archive", datetime(2014, 1, 1, 0, 1)),
+                ("file", datetime(2014, 1, 1, 0, 2)),
+                ("archive", datetime(2014, 1, 1, 0, 3)),
+                ("repeat", datetime(2014, 1, 1, 0, 4))])
+        sources = replay.discover(since=datetime(2014, 1, 1, 0, 3))
+        self.assertEqual(
+            [(kind, scrapeTime) for kind, scrapeTime, location in sources],
+            [("archive", datetime(2014, 1, 1, 0, 4))])
+        scrapeTime, batch = replay._parseSource(sources[0])
+        self.assertEqual(scrapeTime, datetime(2014, 1, 1, 0, 4))
+        self.assertEqual(list(batch), [])
+
+    def testParseAll(self):
+        """Test that parsing stays a bounded number of chunks ahead."""
+        submitted = []
+
+        class Result(object):
+            def __init__(self, chunk):
+                self.chunk = chunk
+
+            def get(self):
+                return [replay._parseSource(source) for source in self.chunk]
+
+        class Pool(object):
+            def map_async(self, function, chunk, size):
+                submitted.append(chunk)
+                return Result(chunk)
+
+        sources = [("repeat", datetime(2014, 1, 1, 0, minute), None)
+                   for minute in range(50)]
+        chunkSizeOriginal = replay.chunkSize
+        replay.chunkSize = 4
+        try:
+            results = replay._parseAll(Pool(), sources, 2)
+            self.assertEqual(next(results), (sources[0][1], None))
+            self.assertEqual(len(submitted), replay.chunksAhead * 2)
+            self.assertEqual(
+                [(sources[0][1], None)] + list(results),
+                [(scrapeTime, None) for kind, scrapeTime, location in sources])
+            self.assertEqual(len(submitted), 13)
+        finally:
+            replay.chunkSize = chunkSizeOriginal
+
+    def testDedupe(self):
+        """Test that only changed rows are picked for history."""
+        f = open("{0}/example/api.json".format(
+            os.path.dirname(os.path.abspath(replay.__file__))), 'r')
+        jsonDump = f.read()
+        f.close()
+        data = coinchoose.parseLatestNetworkStatus(jsonDump)
+        changed, previous = replay._dedupe({}, data)
+        self.assertEqual(len(changed), 59)
+        changed, previous = replay._dedupe(previous, data)
+        self.assertEqual(changed, [])
+        altered = [dict(datum) for datum in data]
+        altered[0]['difficulty'] = None
+        altered[1]['current_blocks'] += 1
+        changed, previous = replay._dedupe(previous, altered[:-1])
+        self.assertEqual(changed, altered[:2])
+        changed, previous = replay._dedupe(previous, data)
+        self.assertEqual(changed, [data[0], data[1], data[-1]])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+""" Tests for the rollup module. """
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import pg
+import rollup
+import unittest
+
+
+class RollupTest(unittest.TestCase):
+
+    """Testing suite for rollup module."""
+
+    def setUp(self):
+        """Setup tables for test."""
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(
+            (key, "{0}_test".format(table))
+            for key, table in self.tablesOriginal.items())
+        self.maintainRollupsOriginal = pg.maintainRollups
+        pg.maintainRollups = True
+        pg.clearCache()
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.connection.commit()
+
+    def tearDown(self):
+        """Teardown test tables."""
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.connection.commit()
+        pg.tables = self.tablesOriginal
+        pg.maintainRollups = self.maintainRollupsOriginal
+        pg.clearCache()
+
+    def testChooseRollup(self):
+        """Test that the coarsest fitting rollup is picked."""
+        day = datetime(2014, 1, 1)
+        self.assertEqual(
+            rollup.chooseRollup(day, day + timedelta(days=7)),
+            ('network_status_daily', 'day'))
+        self.assertEqual(
+            rollup.chooseRollup(day, day + timedelta(days=1), minBuckets=2),
+            ('network_status_hourly', 'hour'))
+        self.assertEqual(
+            rollup.chooseRollup(
+                day + timedelta(hours=3), day + timedelta(days=1)),
+            ('network_status_hourly', 'hour'))
+        self.assertEqual(
+            rollup.chooseRollup(day, day + timedelta(minutes=90)), None)
+
+    def testIncrementalRollups(self):
+        """Test that inserts keep rollups equal to a rebuild."""
+        start = datetime(2014, 1, 1, 23, 30)
+        for minute in range(0, 60, 10):
+            pg.insertLatestNetworkStatus([{
+                'symbol': 'ALF',
+                'scrape_time': start + timedelta(minutes=minute),
+                'current_blocks': long(1000 + minute),
+                'difficulty': Decimal(minute + 1),
+                'reward': Decimal(50),
+                'hash_rate': long(10),
+                'avg_hash_rate': None
+            }])
+        day = datetime(2014, 1, 1)
+        hourly = rollup.queryRange('ALF', day, day + timedelta(days=2), 48)
+        self.assertEqual([row['samples'] for row in hourly], [3, 3])
+        self.assertEqual(hourly[0]['min_blocks'], 1000)
+        self.assertEqual(hourly[1]['max_blocks'], 1050)
+        self.assertEqual(hourly[0]['avg_difficulty'], Decimal(11))
+        self.assertEqual(hourly[0]['avg_avg_hash_rate'], None)
+        daily = rollup.queryRange('ALF', day, day + timedelta(days=2))
+        self.assertEqual([row['samples'] for row in daily], [3, 3])
+        raw = rollup.queryRange('ALF', start, start + timedelta(minutes=45))
+        self.assertEqual([row['samples'] for row in raw], [3, 2])
+        rollup.rebuild(day, day + timedelta(days=2))
+        self.assertEqual(
+            rollup.queryRange('ALF', day, day + timedelta(days=2), 48), hourly)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+""" Tests for the scrape module. """
+import scrape
+import threading
+import unittest
+
+
+class ScrapeTest(unittest.TestCase):
+
+    """Testing suite for scrape module."""
+
+    def testStageQueue(self):
+        """Test that a full stage queue holds producers back in order."""
+        queue = scrape._StageQueue(2)
+        self.assertTrue(queue.put(1))
+        self.assertTrue(queue.put(2))
+        self.assertFalse(queue.put(3, timeout=0.01))
+        waiting = threading.Thread(target=queue.put, args=(3,))
+        waiting.start()
+        self.assertEqual(queue.get(), 1)
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        queue.close()
+        self.assertEqual([queue.get(), queue.get(), queue.get()],
+                         [2, 3, None])
+
+if __name__ == "__main__":
+    unittest.main()
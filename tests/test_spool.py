@@ -0,0 +1,167 @@
+""" Tests for the spool module. """
+from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+import pg
+import shutil
+import spool
+import tempfile
+import unittest
+
+
+class SpoolTest(unittest.TestCase):
+
+    """Testing suite for spool module."""
+
+    def setUp(self):
+        """Point the spool at scratch space and setup tables for test."""
+        self.spoolDirOriginal = spool.spoolDir
+        spool.spoolDir = tempfile.mkdtemp()
+        spool._state = None
+        self.tablesOriginal = pg.tables
+        pg.tables = dict(
+            (key, "{0}_test".format(table))
+            for key, table in self.tablesOriginal.items())
+        pg.clearCache()
+        cur = pg.cursor()
+        for key, table in pg.tables.items():
+            cur.execute("""CREATE TABLE IF NOT EXISTS
+                {0} (LIKE {1} INCLUDING ALL)""".format(
+                table, self.tablesOriginal[key]))
+        cur.connection.commit()
+
+    def tearDown(self):
+        """Remove scratch space and teardown test tables."""
+        shutil.rmtree(spool.spoolDir)
+        spool.spoolDir = self.spoolDirOriginal
+        spool._state = None
+        cur = pg.cursor()
+        for table in pg.tables.values():
+            cur.execute("""DROP TABLE IF EXISTS
+                {0}""".format(table))
+        cur.connection.commit()
+        pg.tables = self.tablesOriginal
+        pg.clearCache()
+
+    def _scrapes(self):
+        """Three scrapes of two symbols, where only GLC changes."""
+        start = datetime(2014, 1, 1)
+        currencies = [
+            {'symbol': 'ALF', 'name': 'Alphacoin', 'algo': 'scrypt'},
+            {'symbol': 'GLC', 'name': 'GlobalCoin', 'algo': 'scrypt'}]
+        scrapes = []
+        for minute in range(3):
+            scrapes.append((currencies, [{
+                'symbol': symbol,
+                'scrape_time': start + timedelta(minutes=minute),
+                'current_blocks': long(1000 + (
+                    minute if symbol == 'GLC' else 0)),
+                'difficulty': Decimal("1.52109832"),
+                'reward': Decimal(50),
+                'hash_rate': long(10),
+                'avg_hash_rate': None if symbol == 'GLC' else Decimal(0)
+            } for symbol in ('ALF', 'GLC')]))
+        return scrapes
+
+    def testRoundTrip(self):
+        """Test that spooled scrapes read back exactly, after a crash."""
+        scrapes = self._scrapes()
+        spool.append(*scrapes[0])
+        spool.appendRepeat(scrapes[1][1][0]['scrape_time'])
+        f = open(spool._spoolPath(), 'ab')
+        f.write(b'{"spooled": 1, "curr')
+        f.close()
+        spool._state = None
+        self.assertEqual(spool.pending()[:2], (2, 4))
+        spool.append(*scrapes[2])
+        read = list(spool._iterScrapes())
+        self.assertEqual(read[0], scrapes[0])
+        self.assertEqual(
+            read[1][1], [dict(datum, scrape_time=scrapes[1][1][0][
+                'scrape_time']) for datum in scrapes[0][1]])
+        self.assertEqual(read[2], scrapes[2])
+
+    def testFlush(self):
+        """Test that a flush stores what one insert per scrape would."""
+        scrapes = self._scrapes()
+        for currencies, networkStatus in scrapes:
+            spool.append(currencies, networkStatus)
+        self.assertEqual(spool.flush(), 3)
+        self.assertFalse(spool.hasRecords())
+        cur = pg.dictCursor()
+        cur.execute("""SELECT symbol, COUNT(*) cnt
+            FROM {0}
+            GROUP BY symbol
+            ORDER BY symbol""".format(pg.tables['network_status']))
+        self.assertEqual(
+            [(row['symbol'], row['cnt']) for row in cur],
+            [('ALF', 1), ('GLC', 3)])
+        cur.execute("""SELECT MAX(scrape_time) latest
+            FROM {0}""".format(pg.tables['network_status_latest']))
+        self.assertEqual(
+            cur.fetchone()['latest'], scrapes[-1][1][0]['scrape_time'])
+        cur.connection.commit()
+
+    def testFlushAgain(self):
+        """Test that flushing the same scrapes twice stores them once."""
+        scrapes = self._scrapes()
+        # ALF repeats and then changes
+        scrapes[2][1][0]['difficulty'] = Decimal(2)
+        pg.insertLatestCurrencies(scrapes[0][0])
+        pg.insertLatestNetworkStatus(scrapes[0][1])
+        for attempt in range(2):
+            # As if the first flush crashed after committing
+            for currencies, networkStatus in scrapes[1:]:
+                spool.append(currencies, networkStatus)
+            spool.flush()
+        cur = pg.dictCursor()
+        cur.execute("""SELECT symbol, COUNT(*) cnt
+            FROM {0}
+            GROUP BY symbol
+            ORDER BY symbol""".format(pg.tables['network_status']))
+        self.assertEqual(
+            [(row['symbol'], row['cnt']) for row in cur],
+            [('ALF', 2), ('GLC', 3)])
+        cur.connection.commit()
+
+    def testFlushOvertaken(self):
+        """Test that spooled scrapes are stored after newer live ones."""
+        scrapes = self._scrapes()
+        pg.insertLatestCurrencies(scrapes[0][0])
+        pg.insertLatestNetworkStatus(scrapes[0][1])
+        for currencies, networkStatus in scrapes[1:]:
+            spool.append(currencies, networkStatus)
+
+        # Another writer stores a later scrape before the spool is flushed
+        pg.insertLatestNetworkStatus([
+            dict(datum, scrape_time=datum['scrape_time'] + timedelta(
+                minutes=5), current_blocks=long(2000))
+            for datum in scrapes[2][1]])
+        spool.flush()
+        cur = pg.dictCursor()
+        cur.execute("""SELECT symbol, COUNT(*) cnt
+            FROM {0}
+            GROUP BY symbol
+            ORDER BY symbol""".format(pg.tables['network_status']))
+        self.assertEqual(
+            [(row['symbol'], row['cnt']) for row in cur],
+            [('ALF', 2), ('GLC', 4)])
+        cur.connection.commit()
+
+    def testCurrencyHistory(self):
+        """Test that currencies sharing a name and algo are all kept."""
+        scrapes = self._scrapes()
+        currencies = [
+            {'symbol': 'ALF', 'name': 'Coin', 'algo': 'scrypt'},
+            {'symbol': 'GLC', 'name': 'Coin', 'algo': 'scrypt'}]
+        spool.append(currencies, scrapes[0][1])
+        spool.flush()
+        cur = pg.dictCursor()
+        cur.execute("""SELECT symbol
+            FROM {0}
+            ORDER BY symbol""".format(pg.tables['currency_historical']))
+        self.assertEqual([row['symbol'] for row in cur], ['ALF', 'GLC'])
+        cur.connection.commit()
+
+if __name__ == "__main__":
+    unittest.main()